@@ -56,6 +56,9 @@ setup(
         test=[
             'zope.testrunner',
         ],
+        manifest=[
+            'tomli; python_version < "3.11"',
+        ],
     ),
 
     zip_safe=False,
@@ -12,158 +12,2336 @@
 #
 ##############################################################################
 """%(program)s -- create a ZEO instance.
-Usage: %(program)s home [[host:]port] [options]
+Usage: %(program)s home [[host:]port | socket-path] [options]
+       %(program)s --manifest fleet.toml [options]
 
 Given an "instance home directory" <home> and some configuration
-options (all of which have default values), create the following:
+options (all of which have default values), create the following.
+The server listens on port 9999 by default.  An address containing a
+slash, like var/zeo.sock, is a Unix domain socket (relative to <home>),
+which is faster for clients on the same host.
 
 <home>/etc/zeo.conf     -- ZEO config file
 <home>/var/             -- Directory for data files: Data.fs etc.
 <home>/log/             -- Directory for log files: zeo.log and zeoctl.log
 <home>/bin/runzeo       -- the zeo server runner
 <home>/bin/zeoctl       -- start/stop script (a shim for zeoctl.py)
+<home>/etc/zeoclient.conf -- client config (with --client-config,
+                            --shared-blobs or --tls)
+<home>/bin/zeobench     -- benchmark script (with --bench)
+<home>/bin/zeocompress  -- storage compression script (with --compress)
+<home>/bin/zeometrics   -- metrics exporter (with --metrics)
+<home>/bin/zeostatus    -- fast status check (with --fast-scripts)
+<home>/etc/zeo-NAME.service -- systemd unit (with --service systemd)
+<home>/bin/zeoindex     -- index check and rebuild script (with --index)
+<home>/bin/zeopack      -- pack script, with systemd units and a crontab
+                           entry in <home>/etc (with --pack)
 
 Options:
     -h, --help         -- Display this help and exit
     -b, --blobs        -- Directory for Blobs. By default, it will create
                           a blobs directory at <home>/var/blobs unless a
                           path is provided -b path/to/blobs
+    -p, --profile      -- Tuning profile for zeo.conf: small, read-heavy,
+                          write-heavy or auto.  auto derives the values
+                          from the CPU count, RAM and target filesystem
+                          of the host running %(program)s.  Without a
+                          profile, conservative defaults are written.
+    -s, --storages     -- Number of storages to serve (named 1..N), or a
+                          comma separated list of storage names.  The
+                          first storage lives in <home>/var, the others
+                          in <home>/var/<name>, each with its own Data.fs
+                          and blob directory.
+    -t, --storage-type -- Storage to generate: filestorage (the default),
+                          zlibstorage (a compressed FileStorage, needs
+                          zc.zlibstorage), demostorage (in-memory changes
+                          over a Data.fs left unchanged, for throw-away
+                          test servers) or mappingstorage (in memory only).
+    -z, --compress     -- Compress the storages' records, wrapping them
+                          in zc.zlibstorage (the only compressor built
+                          in, and the default), and write
+                          <home>/bin/zeocompress to compress existing
+                          Data.fs files in place.
+    --storage-dir      -- NAME=PATH, place storage NAME's Data.fs (and
+                          default blob directory) in PATH instead, e.g.
+                          on a different disk.  May be repeated.
+    -m, --manifest     -- Create every instance listed in a TOML manifest
+                          instead of a single <home>.  Each [[instance]]
+                          table takes home, address, blobs, profile,
+                          storages and storage-dir (a table of NAME =
+                          PATH); a [defaults] table applies to all.
+    -j, --jobs         -- Number of instances created in parallel from a
+                          manifest (default: based on the CPU count).
+    -n, --instances    -- Create N sibling instances <home>/zeo1 ..
+                          <home>/zeoN, one server process each, on free
+                          ports starting at the given port (0 lets the
+                          system choose), and write a client configuration
+                          for all of them to <home>/zeoclient.conf.
+    --secondaries      -- Create a zc.zrs replicated <home>/primary and N
+                          read-only <home>/secondary1 .. <home>/secondaryN
+                          serving copies of its file storages, on free
+                          ports starting at the given port (the primary's
+                          ZEO port, its replication ports, then the
+                          secondaries').  <home>/zeoclient.conf sends
+                          read-only connections to the secondaries.
+                          The servers need zc.zrs installed.
+    --blob-layout     -- Blob directory layout, bushy (the ZODB default)
+                          or lawn.  Implies --blobs.
+    --blob-mounts      -- Comma separated mount points to spread the blob
+                          directories of the storages over, round-robin.
+                          Storage NAME of instance <home> keeps its blobs
+                          in <mount>/<basename of home>/NAME.
+    --shared-blobs     -- Write <home>/etc/zeoclient.conf for application
+                          servers on this host, reading blobs directly
+                          from the server's blob directories
+                          (shared-blob-dir) instead of over the network.
+    --client-config    -- Write <home>/etc/zeoclient.conf for application
+                          servers, with object and blob cache sizes
+                          derived from the storage sizes and this host's
+                          RAM, and a persistent cache so restarted
+                          clients keep their working set.
+    --client-var       -- Directory for the clients' persistent cache
+                          files (default <home>/var/zeoclient).  Implies
+                          --client-config.
+    --bench            -- Also write <home>/bin/zeobench, which runs
+                          read, write, commit, conflict or blob workloads
+                          against the server with concurrent clients and
+                          reports throughput and latencies as JSON.
+    --metrics          -- Also write <home>/bin/zeometrics, a Prometheus
+                          exporter for the server's connection, commit,
+                          conflict and storage size statistics.  It
+                          listens on 127.0.0.1:9180 unless [host:]port is
+                          given.  Instances of --instances, --secondaries
+                          or a manifest sharing an address get the free
+                          ports from it on.
+    --pack             -- Also write <home>/bin/zeopack, which packs the
+                          storages keeping DAYS days of history (default
+                          7) and logs how long that took, and a systemd
+                          service and timer and a crontab entry to run
+                          it in the pack window.
+    --pack-window      -- When packs may run: "[Day] HH:MM-HH:MM", by
+                          default Sun 01:00-05:00.  Without a day, packs
+                          run daily.  Each instance starts at its own
+                          time within the window.
+    --service          -- systemd: also write <home>/etc/zeo-NAME.service,
+                          a systemd unit running bin/runzeo without
+                          zdaemon, with CPU pinning, nice level, I/O
+                          priority, open file and memory limits taken
+                          from the profile.  Sibling instances are
+                          pinned to different cores.
+    --fast-scripts     -- Make bin/runzeo and bin/zeoctl start faster:
+                          precompile the bytecode of ZEO and its
+                          dependencies, run Python in isolated mode if
+                          ZEO can be imported that way, and answer
+                          "zeoctl status" with bin/zeostatus, which
+                          asks zdrun directly without loading ZEO.
+    --reconcile        -- Update existing files that differ from what
+                          would be written, instead of warning.  Hashes
+                          of the files written are kept in
+                          <home>/etc/.mkzeoinstance.manifest, so files
+                          that are still up to date are skipped without
+                          reading them.
+    --dry-run          -- Show what --reconcile would change, as unified
+                          diffs, without changing anything.
+    --fsync            -- Also flush the directories the files were
+                          written to to disk.  The files themselves are
+                          always flushed before they replace old ones.
+    --index            -- Also write <home>/bin/zeoindex, which checks
+                          the Data.fs.index files and rebuilds missing
+                          or stale ones with progress reports, and run
+                          it from <home>/bin/runzeo before the server
+                          starts.
+    --warm             -- SIZE, like 512MB: have bin/zeoindex read the
+                          last SIZE of each Data.fs into the page cache
+                          before the server starts.  Implies --index,
+                          unless SIZE is 0.
+    --tls              -- Encrypt the connections: have the server use
+                          TLS, with the certificates in <home>/etc/ssl
+                          or the given directory, and accept only
+                          clients with a certificate signed by its CA.
+                          Missing certificates are created with openssl:
+                          a CA (ca.pem, ca.key) and a server and client
+                          certificate signed by it (server.pem,
+                          client.pem), with ECDSA P-256 keys, which are
+                          quick to handshake with.  Also writes
+                          <home>/etc/zeoclient.conf, using the client
+                          certificate.
+    --log-level        -- Level of the server's log (default info).
+    --log-rotate       -- Rotate log/zeo.log when it reaches a size, like
+                          100MB, or hourly, daily or weekly.
+    --log-keep         -- Number of rotated log files kept (default 7).
+    --log-json         -- Write the server's log as one JSON object per
+                          line.
+    --log-queue        -- Have the server's threads hand log records to
+                          a queue, written to the log by a thread of its
+                          own, so they never wait for the disk.
+    --probe            -- Before creating the instance, measure the fsync
+                          latency, append throughput and file creation
+                          rate of the filesystems that will hold the
+                          storages and blobs, and print them.  Warn if
+                          they are too slow for the profile, and stop
+                          if they are far too slow.  With slow fsyncs,
+                          the profile is tuned as for a network
+                          filesystem.
+    --container        -- Write the instance for a container, with
+                          <home>/Dockerfile building an image that runs
+                          the server from /srv/<name of home>, its var,
+                          blobs and log directories being volumes, and
+                          <home>/compose.yaml publishing the port and
+                          keeping /tmp on a tmpfs.  With --instances or
+                          --secondaries, <home>/compose.yaml runs them
+                          all.  -b puts the blobs on a volume of their
+                          own.  --metrics and --bench are refused, as
+                          nothing in the image runs them.
+    --relocatable      -- Don't write the instance's location or Python
+                          into its files: the scripts find the instance
+                          from where they are and use python3 from $PATH
+                          (or $PYTHON), and zeo.conf reads it from
+                          $INSTANCE_HOME.  The instance, with its data
+                          and indexes, can then be moved or copied
+                          (e.g. with cp --reflink) and used as it is.
+                          Options writing a client configuration, like
+                          --client-config or --tls, are refused.
 
-The script will not overwrite existing files; instead, it will issue a
-warning if an existing file is found that differs from the file that
-would be written if it didn't exist.
+Unless --reconcile is given, the script will not overwrite existing
+files; instead, it will issue a warning if an existing file is found
+that differs from the file that would be written if it didn't exist.
 """
 
 # WARNING!  Several templates and functions here are reused by ZRS.
 # So be careful with changes.
 
-import argparse
+# Importing this module should stay cheap: tools import it just for the
+# templates.  Import anything heavier than the modules below, and
+# ZODB and zdaemon in particular, where it's used.
+
+import functools
 import os
+import re
 import stat
 import sys
+import time
+import zlib
+
+
+PROGRAM = os.path.basename(sys.argv[0])
+
+ZEO_CONF_TEMPLATE = """\
+# ZEO configuration file
+
+%(imports)s%%define INSTANCE %(conf_home)s
+
+<zeo>
+  address %(conf_address)s
+  read-only %(read_only)s
+  invalidation-queue-size %(invalidation_queue_size)s
+%(invalidation_age)s  # pid-filename $INSTANCE/var/ZEO.pid
+  # monitor-address PORT
+  %(transaction_timeout)s
+%(client_cache_hint)s%(ssl)s</zeo>
+
+%(storages)s
+<eventlog>
+  level %(log_level)s
+  <logfile>
+    path $INSTANCE/log/zeo.log
+%(log_options)s  </logfile>
+</eventlog>
+
+<runner>
+  program $INSTANCE/bin/runzeo
+  socket-name $INSTANCE/var/%(package)s.zdsock
+  daemon true
+  forever false
+  backoff-limit 10
+  exit-codes 0, 2
+  directory $INSTANCE
+  default-to-interactive true
+  # user zope
+%(runner_interpreter)s
+  # This logfile should match the one in the %(package)s.conf file.
+  # It is used by zdctl's logtail command, zdrun/zdctl doesn't write it.
+  logfile $INSTANCE/log/%(package)s.log
+</runner>
+"""
+
+FILESTORAGE_TEMPLATE = """\
+<filestorage %(name)s>
+  path %(path)s
+  %(blob_dir)s
+</filestorage>
+"""
+
+# A FileStorage whose records are compressed by zc.zlibstorage.
+ZLIBSTORAGE_TEMPLATE = """\
+<zlibstorage %(name)s>
+  <filestorage>
+    path %(path)s
+    %(blob_dir)s
+  </filestorage>
+</zlibstorage>
+"""
+
+# Changes are kept in memory on top of Data.fs; they are lost when the
+# server stops.  The base isn't read-only, so that it is created on a
+# fresh instance, but DemoStorage never writes to it.
+DEMOSTORAGE_TEMPLATE = """\
+<demostorage %(name)s>
+  <filestorage base>
+    path %(path)s
+    %(blob_dir)s
+  </filestorage>
+</demostorage>
+"""
+
+# Everything is kept in memory and lost when the server stops.
+MAPPINGSTORAGE_TEMPLATE = """\
+<mappingstorage %(name)s>
+</mappingstorage>
+"""
+
+# Storage wrappers selected with --compress: the section wrapping the
+# storage section, the package to %import for it and the Python wrapper
+# bin/zeocompress uses to rewrite existing records.
+COMPRESSORS = {
+    'zlib': ('<zlibstorage %(name)s>\n%(storage)s</zlibstorage>\n',
+             'zc.zlibstorage', 'zc.zlibstorage.ZlibStorage'),
+}
+
+# A zc.zrs primary (with replicate-to) or secondary (with
+# replicate-from) wrapping a storage section, for --secondaries.
+ZRS_TEMPLATE = """\
+<zrs %(name)s>
+%(replication)s%(storage)s</zrs>
+"""
+
+# Seconds between the no-op messages secondaries send, so idle
+# replication connections aren't dropped by firewalls.
+ZRS_KEEP_ALIVE_DELAY = 60
+
+# Storage section templates by --storage-type, with the package to
+# %import for them (or None).  Register more with
+# ZEOInstanceBuilder.register_storage_type.
+STORAGE_TYPES = {
+    'filestorage': (FILESTORAGE_TEMPLATE, None),
+    'zlibstorage': (ZLIBSTORAGE_TEMPLATE, 'zc.zlibstorage'),
+    'demostorage': (DEMOSTORAGE_TEMPLATE, None),
+    'mappingstorage': (MAPPINGSTORAGE_TEMPLATE, None),
+}
+
+ZEOCLIENT_CONF_TEMPLATE = """\
+# ZEO client configuration for %(description)s
+#
+# Each <zodb> section connects to one storage of one server process.
+# Spread the application's databases (or application servers) over the
+# servers so that the load is shared by all of them.
+
+%(clients)s"""
+
+# type is zeoclient, or ZEO's own clientstorage (which needs
+# %import ZEO) where the connection is encrypted.
+ZEOCLIENT_TEMPLATE = """\
+<zodb %(name)s>
+  <%(type)s>
+    server %(server)s
+    storage %(storage)s
+%(options)s  </%(type)s>
+</zodb>
+"""
+
+ZEOBENCH_TEMPLATE = """\
+#!%(python)s
+# %(PACKAGE)s instance benchmark script
+\"\"\"Benchmark the %(PACKAGE)s server of this instance.
+
+Runs a workload with several concurrent client connections against the
+address in etc/%(package)s.conf and prints the results as JSON:
+
+  write     -- transactions that each store several new objects
+  read      -- loads of objects written during setup, bypassing the
+               client cache so every load reaches the server
+  commit    -- tiny transactions, to measure commit latency
+  conflict  -- all clients update the same object, retrying conflicts
+  blob      -- transactions that each store one blob
+
+Start the server (bin/zeoctl start) before running the benchmark.  The
+objects it writes are removed from the database when it is done; the
+next pack reclaims their space.
+\"\"\"
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+
+%(script_home)sCONFIG_FILE = INSTANCE_HOME + "/etc/%(package)s.conf"
+WORKLOADS = ('write', 'read', 'commit', 'conflict', 'blob')
+TLS = %(tls_files)s
+
+
+def server_config(config_file):
+    from ZEO.runzeo import ZEOOptions
+    options = ZEOOptions()
+    options.realize(['-C', config_file])
+    address = options.address
+    if isinstance(address, tuple) and address[0] in ('', '0.0.0.0', '::'):
+        address = ('localhost', address[1])
+    return address, [storage.name for storage in options.storages]
+
+
+def ssl_context():
+    if not TLS:
+        return None
+    import ssl
+    context = ssl.create_default_context(cafile=TLS['authenticate'])
+    context.load_cert_chain(TLS['certificate'], TLS['key'])
+    return context
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def setup(address, options):
+    import transaction
+    import ZEO
+    from BTrees.OOBTree import OOBTree
+    from persistent.mapping import PersistentMapping
+
+    db = ZEO.DB(address, storage=options.storage, ssl=options.ssl)
+    try:
+        with db.transaction() as conn:
+            bench = conn.root()['zeobench'] = PersistentMapping()
+            bench['objects'] = objects = OOBTree()
+            for i in range(options.objects):
+                objects[i] = PersistentMapping(data=b'x' * options.size)
+            bench['counter'] = PersistentMapping(value=0)
+            for index in range(options.clients):
+                bench[('client', index)] = OOBTree()
+        with db.transaction() as conn:
+            objects = conn.root()['zeobench']['objects']
+            oids = [objects[i]._p_oid for i in range(options.objects)]
+    finally:
+        transaction.abort()
+        db.close()
+    return oids
+
+
+def teardown(address, options):
+    import transaction
+    import ZEO
+
+    db = ZEO.DB(address, storage=options.storage, ssl=options.ssl)
+    try:
+        with db.transaction() as conn:
+            conn.root().pop('zeobench', None)
+    finally:
+        transaction.abort()
+        db.close()
+
+
+def run_client(index, address, options, oids, results, blob_data):
+    import transaction
+    import ZEO
+    from persistent.mapping import PersistentMapping
+    from ZODB.blob import Blob
+    from ZODB.POSException import ConflictError
+
+    latencies = []
+    conflicts = 0
+    if options.workload == 'read':
+        storage = ZEO.client(address, storage=options.storage, cache_size=0,
+                             ssl=options.ssl)
+        try:
+            for i in range(options.transactions):
+                oid = oids[(index + i) %% len(oids)]
+                start = time.perf_counter()
+                storage.load(oid)
+                latencies.append(time.perf_counter() - start)
+        finally:
+            storage.close()
+        results.append((latencies, conflicts))
+        return
+
+    blob_dir = None
+    if options.workload == 'blob':
+        blob_dir = tempfile.mkdtemp(prefix='zeobench-')
+    db = ZEO.DB(address, storage=options.storage, blob_dir=blob_dir,
+                ssl=options.ssl)
+    tm = transaction.TransactionManager()
+    conn = db.open(tm)
+    try:
+        bench = conn.root()['zeobench']
+        mine = bench[('client', index)]
+        for i in range(options.transactions):
+            while True:
+                tm.begin()
+                if options.workload == 'write':
+                    for j in range(10):
+                        mine[i, j] = PersistentMapping(
+                            data=b'x' * options.size)
+                elif options.workload == 'commit':
+                    mine['value'] = i
+                elif options.workload == 'conflict':
+                    bench['counter']['value'] += 1
+                else:
+                    mine[i] = blob = Blob()
+                    with blob.open('w') as f:
+                        f.write(blob_data)
+                start = time.perf_counter()
+                try:
+                    tm.commit()
+                except ConflictError:
+                    tm.abort()
+                    conflicts += 1
+                    continue
+                latencies.append(time.perf_counter() - start)
+                break
+    finally:
+        tm.abort()
+        conn.close()
+        db.close()
+        if blob_dir:
+            shutil.rmtree(blob_dir, ignore_errors=True)
+    results.append((latencies, conflicts))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-w', '--workload', choices=WORKLOADS,
+                        default='write')
+    parser.add_argument('-c', '--clients', type=int, default=4,
+                        help='Number of concurrent client connections')
+    parser.add_argument('-t', '--transactions', type=int, default=200,
+                        help='Transactions (or loads) per client')
+    parser.add_argument('-o', '--objects', type=int, default=1000,
+                        help='Objects written during setup')
+    parser.add_argument('-s', '--size', type=int, default=512,
+                        help='Object payload size in bytes')
+    parser.add_argument('-b', '--blob-size', type=int, default=1 << 20,
+                        help='Blob size in bytes for the blob workload')
+    parser.add_argument('-S', '--storage', default=None,
+                        help='Storage to use (default: the first one)')
+    parser.add_argument('-C', '--config', default=CONFIG_FILE)
+    options = parser.parse_args(args)
+    options.objects = max(options.objects, 100)
+    options.ssl = ssl_context()
+
+    address, storages = server_config(options.config)
+    if options.storage is None:
+        options.storage = storages[0]
+
+    oids = setup(address, options)
+    try:
+        blob_data = os.urandom(options.blob_size)
+        results = []
+        threads = [threading.Thread(target=run_client,
+                                    args=(index, address, options, oids,
+                                          results, blob_data))
+                   for index in range(options.clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        teardown(address, options)
+
+    latencies = [latency for client, _ in results for latency in client]
+    report = {
+        'workload': options.workload,
+        'address': (address if isinstance(address, str)
+                    else '{}:{}'.format(*address)),
+        'storage': options.storage,
+        'clients': options.clients,
+        'failed_clients': options.clients - len(results),
+        'seconds': round(elapsed, 3),
+        'operations': len(latencies),
+        'operations_per_second': round(len(latencies) / elapsed, 1),
+        'conflicts': sum(conflicts for _, conflicts in results),
+    }
+    key = 'load' if options.workload == 'read' else 'commit'
+    for name, fraction in (('p50', 0.5), ('p99', 0.99)):
+        value = percentile(latencies, fraction)
+        report['%%s_latency_%%s_ms' %% (key, name)] = (
+            None if value is None else round(value * 1000, 3))
+    if options.workload == 'blob':
+        report['blob_mb_per_second'] = round(
+            len(latencies) * options.blob_size / elapsed / (1 << 20), 2)
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\\n')
+    return 0 if len(results) == options.clients else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+"""
+
+ZEOMETRICS_TEMPLATE = """\
+#!%(python)s
+# %(PACKAGE)s instance metrics exporter
+\"\"\"Export %(PACKAGE)s server statistics in the Prometheus text format.
+
+Serves http://%(metrics_address)s/metrics.  Every scrape asks the server
+for its status (the "ruok" request zeo-nagios uses as well) and adds the
+sizes of the storage files.  Only the standard library is used, so the
+exporter starts quickly and stays small.
+\"\"\"
+
+import http.server
+import json
+import os
+import socket
+import struct
+import sys
+import time
+
+
+%(script_home)sSERVER = %(metrics_server)s
+LISTEN = %(metrics_listen)s
+STORAGE_FILES = %(storage_files)s
+TLS = %(tls_files)s
+
+COUNTERS = (
+    ('loads', 'zeo_loads_total', 'Objects loaded'),
+    ('stores', 'zeo_stores_total', 'Objects stored'),
+    ('commits', 'zeo_commits_total', 'Transactions committed'),
+    ('aborts', 'zeo_aborts_total', 'Transactions aborted'),
+    ('conflicts', 'zeo_conflicts_total', 'Write conflicts'),
+    ('conflicts_resolved', 'zeo_conflicts_resolved_total',
+     'Write conflicts resolved by the server'),
+)
+GAUGES = (
+    ('connections', 'zeo_connections', 'Connected clients'),
+    ('waiting', 'zeo_commit_lock_waiting', 'Clients waiting for the lock'),
+    ('active_txns', 'zeo_active_transactions', 'Transactions in progress'),
+)
+
+
+def recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise OSError('connection closed by server')
+        data += chunk
+    return data
+
+
+def recv_message(sock):
+    size, = struct.unpack('>I', recv_exactly(sock, 4))
+    return recv_exactly(sock, size)
+
+
+def server_status():
+    if isinstance(SERVER, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        sock = socket.socket(
+            socket.AF_INET6 if ':' in SERVER[0] else socket.AF_INET,
+            socket.SOCK_STREAM)
+    sock.settimeout(5)
+    if TLS:
+        import ssl
+        context = ssl.create_default_context(cafile=TLS['authenticate'])
+        context.load_cert_chain(TLS['certificate'], TLS['key'])
+        sock = context.wrap_socket(sock, server_hostname=SERVER[0])
+    try:
+        sock.connect(SERVER)
+        sock.sendall(b'\\x00\\x00\\x00\\x04ruok')
+        recv_message(sock)  # protocol version
+        return json.loads(recv_message(sock).decode('ascii'))
+    finally:
+        sock.close()
+
+
+def metric(lines, name, kind, help, samples):
+    lines.append('# HELP {} {}'.format(name, help))
+    lines.append('# TYPE {} {}'.format(name, kind))
+    for labels, value in samples:
+        lines.append('{}{} {}'.format(name, labels, value))
+
+
+def render():
+    lines = []
+    try:
+        status = server_status()
+    except (OSError, ValueError):
+        status = None
+    metric(lines, 'zeo_up', 'gauge', 'Whether the server answered',
+           [('', 0 if status is None else 1)])
+    status = status or {}
+    storages = sorted(status)
+    label = '{{storage="{}"}}'.format
+    for key, name, help in COUNTERS:
+        metric(lines, name, 'counter', help,
+               [(label(s), status[s].get(key, 0)) for s in storages])
+    for key, name, help in GAUGES:
+        metric(lines, name, 'gauge', help,
+               [(label(s), status[s].get(key, 0)) for s in storages])
+    now = time.time()
+    metric(lines, 'zeo_commit_lock_held_seconds', 'gauge',
+           'How long the commit lock has been held',
+           [(label(s), round(now - status[s]['lock_time'], 3)
+             if status[s].get('lock_time') else 0) for s in storages])
+    sizes = []
+    for name, path in sorted(STORAGE_FILES.items()):
+        try:
+            sizes.append((label(name), os.stat(path).st_size))
+        except OSError:
+            pass
+    metric(lines, 'zeo_storage_size_bytes', 'gauge',
+           'Size of the storage data file', sizes)
+    return ('\\n'.join(lines) + '\\n').encode('utf-8')
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    if sys.argv[1:] == ['--once']:
+        sys.stdout.write(render().decode('utf-8'))
+        return
+    http.server.HTTPServer(LISTEN, Handler).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
+"""
+
+ZEOCOMPRESS_TEMPLATE = """\
+#!%(python)s
+# %(PACKAGE)s instance storage compression script
+\"\"\"Compress the records of this instance's existing storage files.
+
+Rewrites each Data.fs record by record through %(compress_wrapper)s into
+a new file, so memory use stays flat however large the storage is, then
+swaps the new file in and keeps the original as Data.fs.uncompressed
+(unless --no-backup is given).  Records that are already compressed are
+copied as they are, so running it twice is harmless.  Blob files aren't
+compressed and are left in place.
+
+Stop the server (bin/zeoctl stop) before running this script.
+\"\"\"
+
+import argparse
+import importlib
+import os
+import sys
+import time
+
+
+%(script_home)sSTORAGE_FILES = %(storage_files)s
+WRAPPER = %(compress_wrapper)r
+
+
+def compress(path, backup=True, progress=sys.stdout):
+    from ZODB.FileStorage import FileStorage
+
+    module, name = WRAPPER.rsplit('.', 1)
+    wrapper = getattr(importlib.import_module(module), name)
+
+    new_path = path + '.compressing'
+    for suffix in ('', '.index', '.lock', '.tmp'):
+        if os.path.exists(new_path + suffix):
+            os.remove(new_path + suffix)
+
+    size = os.path.getsize(path)
+    source = FileStorage(path, read_only=True)
+    destination = wrapper(FileStorage(new_path))
+    start = last = time.time()
+    count = 0
+    try:
+        for trans in source.iterator():
+            destination.tpc_begin(trans, trans.tid, trans.status)
+            for record in trans:
+                destination.restore(record.oid, record.tid, record.data,
+                                    '', record.data_txn, trans)
+            destination.tpc_vote(trans)
+            destination.tpc_finish(trans)
+            count += 1
+            if time.time() - last > 5:
+                last = time.time()
+                progress.write('{}: {} transactions, {:.0f}%% done\\n'.format(
+                    path, count, 100.0 * trans._tpos / size))
+                progress.flush()
+    finally:
+        source.close()
+        destination.close()
+
+    if backup:
+        os.replace(path, path + '.uncompressed')
+    for suffix in ('.index', '.tmp'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    os.replace(new_path, path)
+    if os.path.exists(new_path + '.index'):
+        os.replace(new_path + '.index', path + '.index')
+    for suffix in ('.lock', '.tmp'):
+        if os.path.exists(new_path + suffix):
+            os.remove(new_path + suffix)
+    progress.write('{}: {} transactions, {} -> {} bytes in {:.1f}s\\n'.format(
+        path, count, size, os.path.getsize(path), time.time() - start))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-S', '--storage', action='append',
+                        help='Storage to compress (default: all)')
+    parser.add_argument('--no-backup', action='store_true',
+                        help="Don't keep the uncompressed file")
+    options = parser.parse_args(args)
+
+    for name in options.storage or sorted(STORAGE_FILES):
+        path = STORAGE_FILES[name]
+        if os.path.exists(path):
+            compress(path, backup=not options.no_backup)
+        else:
+            sys.stdout.write('{}: no data file, skipped\\n'.format(path))
+
+
+if __name__ == '__main__':
+    main()
+"""
+
+
+ZEO_SERVICE_TEMPLATE = """\
+# systemd service running the %(PACKAGE)s server in %(instance_home)s
+#
+# Install and start it with:
+#   systemctl link %(instance_home)s/etc/%(service_unit)s.service
+#   systemctl enable --now %(service_unit)s.service
+#
+# systemd supervises bin/runzeo, which execs the server, so neither
+# zdaemon nor bin/zeoctl is involved; don't use both.
+
+[Unit]
+Description=%(PACKAGE)s server in %(instance_home)s
+After=network.target
+
+[Service]
+Type=simple
+ExecStart=%(instance_home)s/bin/runzeo
+# SIGUSR2 makes the server reopen its log files.
+ExecReload=/bin/kill -USR2 $MAINPID
+Restart=on-failure
+RestartSec=5
+WorkingDirectory=%(instance_home)s
+# User=zope
+%(service_resources)s
+[Install]
+WantedBy=multi-user.target
+"""
+
+ZEOPACK_TEMPLATE = """\
+#!%(python)s
+# %(PACKAGE)s instance pack script
+\"\"\"Pack the storages of this instance's %(PACKAGE)s server.
+
+Removes object revisions older than the retention period (%(pack_days)s
+days unless --days is given) from each storage in turn, and appends how
+long each pack took to log/zeopack.log.  The server must be running.
+etc/%(pack_unit)s.timer or etc/zeopack.cron run this on a schedule.
+\"\"\"
+
+import argparse
+import os
+import sys
+import time
+
+
+%(script_home)sCONFIG_FILE = INSTANCE_HOME + "/etc/%(package)s.conf"
+LOG_FILE = INSTANCE_HOME + "/log/zeopack.log"
+STORAGE_FILES = %(storage_files)s
+DAYS = %(pack_days)s
+TLS = %(tls_files)s
+
+
+def server_config(config_file):
+    from ZEO.runzeo import ZEOOptions
+    options = ZEOOptions()
+    options.realize(['-C', config_file])
+    address = options.address
+    if isinstance(address, tuple) and address[0] in ('', '0.0.0.0', '::'):
+        address = ('localhost', address[1])
+    return address, [storage.name for storage in options.storages]
+
+
+def ssl_context():
+    if not TLS:
+        return None
+    import ssl
+    context = ssl.create_default_context(cafile=TLS['authenticate'])
+    context.load_cert_chain(TLS['certificate'], TLS['key'])
+    return context
+
+
+def file_size(name):
+    try:
+        return os.path.getsize(STORAGE_FILES[name])
+    except (KeyError, OSError):
+        return None
+
+
+def pack(address, name, days, timeout):
+    from ZEO.ClientStorage import ClientStorage
+    storage = ClientStorage(address, storage=name, wait_timeout=timeout,
+                            read_only=True, ssl=ssl_context())
+    try:
+        storage.pack(time.time() - days * 86400, wait=True)
+    finally:
+        storage.close()
+
+
+def log(line):
+    line = '{} {}\\n'.format(time.strftime('%%Y-%%m-%%dT%%H:%%M:%%S'), line)
+    with open(LOG_FILE, 'a') as f:
+        f.write(line)
+    sys.stdout.write(line)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-d', '--days', type=float, default=DAYS,
+                        help='Keep revisions from this many days')
+    parser.add_argument('-S', '--storage', action='append',
+                        help='Storage to pack (default: all)')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='Seconds to wait for the server')
+    options = parser.parse_args(args)
+
+    address, storages = server_config(CONFIG_FILE)
+    failed = 0
+    for name in options.storage or storages:
+        before = file_size(name)
+        start = time.time()
+        try:
+            pack(address, name, options.days, options.timeout)
+        except Exception as e:
+            failed += 1
+            status = 'failed: {}'.format(e)
+        else:
+            status = 'ok'
+        log('storage={} days={:g} seconds={:.1f} size-before={} '
+            'size-after={} status={}'.format(
+                name, options.days, time.time() - start, before,
+                file_size(name), status))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+"""
+
+ZEOPACK_SERVICE_TEMPLATE = """\
+# systemd service packing the %(PACKAGE)s storages in %(instance_home)s
+#
+# Install and schedule it with:
+#   systemctl link %(instance_home)s/etc/%(pack_unit)s.service
+#   systemctl enable --now %(instance_home)s/etc/%(pack_unit)s.timer
+
+[Unit]
+Description=Pack the %(PACKAGE)s storages in %(instance_home)s
+
+[Service]
+Type=oneshot
+ExecStart=%(instance_home)s/bin/zeopack
+# User=zope
+# Packing is background work; keep it from slowing down requests.
+Nice=10
+IOSchedulingClass=idle
+"""
+
+ZEOPACK_TIMER_TEMPLATE = """\
+# systemd timer running %(pack_unit)s.service in the pack window
+
+[Unit]
+Description=Pack the %(PACKAGE)s storages in %(instance_home)s regularly
+
+[Timer]
+OnCalendar=%(pack_calendar)s
+AccuracySec=1min
+
+[Install]
+WantedBy=timers.target
+"""
+
+ZEOPACK_CRON_TEMPLATE = """\
+# crontab entry packing the %(PACKAGE)s storages in %(instance_home)s,
+# for hosts without systemd.  Install it with:
+#   (crontab -l; cat %(instance_home)s/etc/zeopack.cron) | crontab -
+%(pack_cron)s %(instance_home)s/bin/zeopack >/dev/null
+"""
+
+
+ZEOINDEX_TEMPLATE = """\
+#!%(python)s
+# %(PACKAGE)s instance index script
+\"\"\"Check, rebuild and warm up the indexes of this instance's storages.
+
+FileStorage keeps an index of each Data.fs in Data.fs.index.  When the
+index is missing or out of date (after a crash or a restore), the server
+scans the whole file, or its unindexed tail, before serving clients.
+With --rebuild, that scan is done here, with progress reports, and the
+index is saved for the server; this needs the server to be stopped.
+--warm reads the end of each Data.fs, where the most recent records
+are, and the index into the page cache.
+\"\"\"
+
+import argparse
+import os
+import pickle
+import struct
+import sys
+import time
+
+
+%(script_home)sSTORAGE_FILES = %(storage_files)s
+WARM = %(index_warm)r
+
+# Transaction header layout, as in ZODB.FileStorage.format.
+TRANS_HDR = '>8sQcHHH'
+TRANS_HDR_LEN = 23
+
+
+def parse_size(value):
+    value = str(value).strip().upper()
+    for unit, factor in (('GB', 1 << 30), ('MB', 1 << 20), ('KB', 1 << 10)):
+        if value.endswith(unit):
+            return int(value[:-2]) * factor
+    return int(value)
+
+
+def ends_transaction(path, pos):
+    if pos == 4:
+        return True
+    with open(path, 'rb') as f:
+        f.seek(pos - 8)
+        length = struct.unpack('>Q', f.read(8))[0]
+        start = pos - 8 - length
+        if start < 4:
+            return False
+        f.seek(start)
+        header = f.read(TRANS_HDR_LEN)
+    if len(header) != TRANS_HDR_LEN:
+        return False
+    return struct.unpack(TRANS_HDR, header)[1] == length
+
+
+def check(path):
+    \"\"\"Return (status, indexed position) for the index of path.
+
+    Only the position saved with the index is read, not the index
+    itself, so checking is cheap even for large storages.
+    \"\"\"
+    if not os.path.exists(path + '.index'):
+        return 'missing', None
+    try:
+        with open(path + '.index', 'rb') as f:
+            pos = pickle.Unpickler(f).load()
+    except Exception:
+        return 'invalid', None
+    size = os.path.getsize(path)
+    if (not isinstance(pos, int) or not 4 <= pos <= size
+            or not ends_transaction(path, pos)):
+        return 'invalid', None
+    return ('stale' if pos < size else 'ok'), pos
+
+
+class ProgressFile:
+
+    def __init__(self, file, path, size, out):
+        self._file = file
+        self._path = path
+        self._size = size or 1
+        self._out = out
+        self._last = time.time()
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def seek(self, pos, whence=0):
+        if whence == 0 and time.time() - self._last >= 5:
+            self._last = time.time()
+            self._out.write('{}: {:.0f}%% indexed\\n'.format(
+                self._path, 100.0 * pos / self._size))
+            self._out.flush()
+        return self._file.seek(pos, whence)
+
+
+def rebuild(path, status, pos, out=sys.stdout):
+    import zc.lockfile
+    from ZODB.FileStorage.FileStorage import read_index
+    from ZODB.fsIndex import fsIndex
+
+    try:
+        lock = zc.lockfile.LockFile(path + '.lock')
+    except zc.lockfile.LockError:
+        out.write('{}: in use, index not rebuilt\\n'.format(path))
+        return False
+    try:
+        index = None
+        if status == 'stale':
+            # Only scan what was added since the index was saved.
+            index = fsIndex.load(path + '.index').get('index')
+        if not isinstance(index, fsIndex):
+            index, pos = fsIndex(), 4
+        with open(path, 'rb') as f:
+            pos = read_index(
+                ProgressFile(f, path, os.path.getsize(path), out), path,
+                index, {}, start=pos, read_only=True)[0]
+        index.save(pos, path + '.index.index_tmp')
+        os.replace(path + '.index.index_tmp', path + '.index')
+    finally:
+        lock.close()
+    return True
+
+
+def warm(path, nbytes):
+    for name, limit in ((path + '.index', None), (path, nbytes)):
+        if not os.path.exists(name):
+            continue
+        with open(name, 'rb', buffering=0) as f:
+            if limit is not None:
+                f.seek(max(0, os.path.getsize(name) - limit))
+            while f.read(1 << 20):
+                pass
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-S', '--storage', action='append',
+                        help='Storage to check (default: all)')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Rebuild missing, invalid or stale indexes')
+    parser.add_argument('--warm', default=WARM,
+                        help='Read this much of the end of each Data.fs')
+    options = parser.parse_args(args)
+
+    out = sys.stdout
+    failed = 0
+    for name in options.storage or sorted(STORAGE_FILES):
+        path = STORAGE_FILES[name]
+        if not os.path.exists(path):
+            out.write('{}: no data file, skipped\\n'.format(path))
+            continue
+        start = time.time()
+        status, pos = check(path)
+        if status != 'ok' and options.rebuild:
+            try:
+                if rebuild(path, status, pos, out):
+                    status = 'rebuilt'
+            except Exception as e:
+                status = 'not rebuilt: {}'.format(e)
+        if status not in ('ok', 'rebuilt'):
+            failed += 1
+        out.write('{}: index {} in {:.1f}s\\n'.format(
+            path, status, time.time() - start))
+        nbytes = parse_size(options.warm) if options.warm else 0
+        if nbytes:
+            start = time.time()
+            warm(path, nbytes)
+            out.write('{}: warmed up in {:.1f}s\\n'.format(
+                path, time.time() - start))
+        out.flush()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+"""
+
+ZEOSTATUS_TEMPLATE = """\
+#!%(python)s -IS
+# %(PACKAGE)s instance status script
+\"\"\"Print the status of this instance's %(PACKAGE)s server, like zeoctl.
+
+Asks zdrun over its control socket directly, using only the standard
+library, so it is fast enough for frequent health checks.  Exits with
+status 3 if the daemon manager isn't running.
+\"\"\"
+
+import re
+import socket
+import sys
+
+
+SOCKET_NAME = "%(instance_home)s/var/%(package)s.zdsock"
+
+
+def send_action(action):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(SOCKET_NAME)
+        sock.sendall(action.encode() + b"\\n")
+        sock.shutdown(socket.SHUT_WR)
+        response = b""
+        while True:
+            data = sock.recv(1000)
+            if not data:
+                break
+            response += data
+        return response.decode()
+    except OSError:
+        return None
+    finally:
+        sock.close()
+
+
+def main(args=None):
+    args = sys.argv[1:] if args is None else args
+    if args[:1] == ['status']:
+        args = args[1:]
+    if args not in ([], ['-l']):
+        print("status argument must be absent or -l")
+        return 1
+    response = send_action("status") or ""
+    match = re.search(r"(?m)^application=(\\d+)$", response)
+    if not match:
+        print("daemon manager not running")
+        return 3
+    pid = int(match.group(1))
+    if pid:
+        print("program running; pid=%%d" %% pid)
+    else:
+        print("daemon manager running; daemon process not running")
+    if args == ['-l']:
+        print(response)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+"""
+
+ZEOCTL_TEMPLATE = """\
+#!/bin/sh
+# %(PACKAGE)s instance control script
+
+# The following two lines are for chkconfig.  On Red Hat Linux (and
+# some other systems), you can copy or symlink this script into
+# /etc/rc.d/init.d/ and then use chkconfig(8) to automatically start
+# %(PACKAGE)s at boot time.
+
+# chkconfig: 345 90 10
+# description: start a %(PACKAGE)s server
+
+%(script_env)s
+PYTHONPATH="$ZODB3_HOME"
+export PYTHONPATH INSTANCE_HOME
+
+%(zeoctl_hook)sexec %(python_cmd)s -m ZEO.zeoctl -C "$CONFIG_FILE" ${1+"$@"}
+"""
+
+
+RUNZEO_TEMPLATE = """\
+#!/bin/sh
+# %(PACKAGE)s instance start script
+
+%(script_env)s
+PYTHONPATH="$ZODB3_HOME"
+export PYTHONPATH INSTANCE_HOME
+
+%(runzeo_hook)sexec %(python_cmd)s %(runzeo_main)s -C "$CONFIG_FILE" ${1+"$@"}
+"""
+
+# Where bin/zeoctl and bin/runzeo find the instance and Python: where
+# they were created or, with --relocatable, where they are run.
+SCRIPT_ENV_TEMPLATE = """\
+PYTHON="%(python)s"
+INSTANCE_HOME="%(instance_home)s"
+ZODB3_HOME="%(zodb_home)s"
+
+CONFIG_FILE="%(instance_home)s/etc/%(package)s.conf"
+"""
+
+RELOCATABLE_SCRIPT_ENV_TEMPLATE = """\
+# The instance may have been moved or copied since it was created.
+PYTHON="${PYTHON:-python3}"
+INSTANCE_HOME="$(cd "$(dirname "$(readlink -f "$0")")/.." && pwd)"
+ZODB3_HOME=""
+
+CONFIG_FILE="$INSTANCE_HOME/etc/%(package)s.conf"
+"""
+
+# The same for the Python scripts; zeo.conf reads INSTANCE_HOME from
+# the environment.
+SCRIPT_HOME_TEMPLATE = """\
+INSTANCE_HOME = "%(instance_home)s"
+"""
+
+RELOCATABLE_SCRIPT_HOME_TEMPLATE = """\
+# The instance may have been moved or copied since it was created.
+INSTANCE_HOME = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+os.environ['INSTANCE_HOME'] = INSTANCE_HOME
+"""
+
+# The interpreter of relocatable Python scripts.
+RELOCATABLE_PYTHON = '/usr/bin/env python3'
+
+# The interpreter zdaemon runs the server with.  Without them, it's
+# the one running bin/zeoctl.
+RUNNER_INTERPRETER_TEMPLATE = """\
+  python %(python)s
+  zdrun %(zdaemon_home)s/zdaemon/zdrun.py
+"""
+
+# Build context of a --container image.  The instance's var, blobs and
+# log directories are volumes.
+DOCKERFILE_TEMPLATE = """\
+# %(PACKAGE)s server image
+#
+# Build and run it with compose.yaml: docker compose up -d --build
+FROM %(container_image)s
+
+# The owner of the instance files on the host (unless that's root), so
+# that the TLS keys mounted from it are readable.
+RUN pip install --no-cache-dir %(container_requirements)s \\
+ && useradd --system --non-unique --uid %(container_uid)s \\
+      --home-dir %(instance_home)s %(package)s \\
+ && mkdir -p %(container_directories)s \\
+ && chown -R %(package)s %(container_volumes)s
+
+COPY bin/ %(instance_home)s/bin/
+COPY etc/ %(instance_home)s/etc/
+
+USER %(package)s
+WORKDIR %(instance_home)s
+EXPOSE %(address)s
+VOLUME %(container_volumes)s
+
+CMD ["%(instance_home)s/bin/runzeo"]
+"""
+
+DOCKERIGNORE_TEMPLATE = """\
+# Data and keys stay out of the image.
+var
+blobs
+log
+etc/ssl
+etc/%(reconcile_manifest)s
+etc/%(lock_file)s
+"""
+
+# Named volumes keep Data.fs and the blobs out of the containers'
+# copy-on-write layers.  The server spools transactions being committed
+# to temporary files, which a tmpfs /tmp keeps in memory; uploaded blobs
+# are spooled in the blob directory, so they can be renamed into place.
+COMPOSE_TEMPLATE = """\
+# Compose file for %(description)s
+#
+# Start with: docker compose up -d --build
+
+services:
+%(services)s
+volumes:
+%(volumes)s"""
+
+COMPOSE_SERVICE_TEMPLATE = """\
+  %(service)s:
+    build: %(build)s
+    restart: unless-stopped
+    ports:
+      - "%(publish)s"
+    volumes:
+%(volumes)s    tmpfs:
+      - /tmp
+    # Give the server time to close the storages cleanly.
+    stop_grace_period: 1m
+"""
+
+ZEO_DEFAULT_BLOB_DIR = '$INSTANCE/var/blobs'
+
+ZEO_DEFAULT_METRICS_ADDRESS = '127.0.0.1:9180'
+
+# Default retention and window for scheduled packs (with --pack).  The
+# window is "[Day] HH:MM-HH:MM" local time; without a day, packs run daily.
+ZEO_DEFAULT_PACK_DAYS = 7
+ZEO_DEFAULT_PACK_WINDOW = 'Sun 01:00-05:00'
+
+PACK_WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+PACK_WINDOW = re.compile(
+    r'^(?:([A-Za-z]{3})\s+)?(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})$')
+
+# Blob directory layouts understood by ZODB.  bushy nests directories by
+# oid byte and scales to any number of blobs; lawn keeps one directory
+# per oid, which is faster on filesystems that handle huge directories.
+BLOB_LAYOUTS = ('bushy', 'lawn')
+
+# Tuning values selected with --profile.  ``None`` leaves the setting to
+# the ZEO (or systemd) default.  Large invalidation queues let
+# reconnecting clients keep their caches instead of verifying them; a
+# transaction timeout keeps a stalled client from holding the commit lock
+# indefinitely.  cpus, nice, io_priority, memory_high and nofile are the
+# resource controls of the --service unit.
+PROFILES = {
+    'small': {
+        'invalidation_queue_size': 100,
+        'invalidation_age': None,
+        'transaction_timeout': None,
+        'client_cache_size': '20MB',
+        'cpus': 1,
+        'nice': 0,
+        'io_priority': 4,
+        'memory_high': '512MB',
+        'nofile': 4096,
+    },
+    'read-heavy': {
+        'invalidation_queue_size': 10000,
+        'invalidation_age': 3600,
+        'transaction_timeout': 300,
+        'client_cache_size': '1GB',
+        'cpus': 2,
+        'nice': -5,
+        'io_priority': 2,
+        'memory_high': '4GB',
+        'nofile': 65536,
+    },
+    'write-heavy': {
+        'invalidation_queue_size': 2000,
+        'invalidation_age': 600,
+        'transaction_timeout': 60,
+        'client_cache_size': '256MB',
+        'cpus': 2,
+        'nice': -5,
+        'io_priority': 0,
+        'memory_high': '2GB',
+        'nofile': 65536,
+    },
+}
+
+# Service managers supported by --service.
+SERVICES = ('systemd',)
+
+# Resource controls of the --service unit without a profile.
+SERVICE_DEFAULTS = {
+    'cpus': None,
+    'nice': 0,
+    'io_priority': 4,
+    'memory_high': None,
+    'nofile': 65536,
+}
+
+# The longest Unix domain socket path most systems accept.
+UNIX_PATH_MAX = 107
+
+# Log levels accepted by --log-level, as ZConfig names them.
+LOG_LEVELS = ('critical', 'error', 'warn', 'info', 'blather', 'debug',
+              'trace', 'all')
+
+# --log-rotate periods, as the "when" of a ZConfig <logfile>.  Weekly
+# rotation happens on Sunday night.
+LOG_ROTATIONS = {'hourly': 'H', 'daily': 'midnight', 'weekly': 'W6'}
+
+ZEO_DEFAULT_LOG_KEEP = 7
+
+# How bin/runzeo starts the server: directly, or (with --log-queue)
+# through runzeo() below.
+RUNZEO_MAIN = '-m ZEO.runzeo'
+RUNZEO_QUEUE_MAIN = "-c 'from zope.mkzeoinstance import runzeo; runzeo()'"
+
+# Default directory of the certificates used with --tls.
+ZEO_DEFAULT_TLS_DIR = '$INSTANCE/etc/ssl'
+
+# Certificates (and keys) --tls creates if they are missing: a CA, and
+# a server and a client certificate signed by it.  ECDSA P-256 keys are
+# used because their signatures are far cheaper than RSA ones of the
+# same strength, which keeps the server's cost per handshake low.
+TLS_CERTIFICATES = {
+    'ca': ('ZEO CA', 3650),
+    'server': ('ZEO server', 825),
+    'client': ('ZEO client', 825),
+}
+TLS_CURVE = 'prime256v1'
+
+TLS_EXTENSIONS = '''\
+[req]
+distinguished_name = dn
+[dn]
+[ca]
+basicConstraints = critical, CA:TRUE
+keyUsage = critical, keyCertSign, cRLSign
+subjectKeyIdentifier = hash
+[server]
+basicConstraints = critical, CA:FALSE
+keyUsage = critical, digitalSignature
+extendedKeyUsage = serverAuth
+subjectAltName = %(subject_alt_names)s
+subjectKeyIdentifier = hash
+authorityKeyIdentifier = keyid
+[client]
+basicConstraints = critical, CA:FALSE
+keyUsage = critical, digitalSignature
+extendedKeyUsage = clientAuth
+subjectKeyIdentifier = hash
+authorityKeyIdentifier = keyid
+'''
+
+ZEO_SSL_TEMPLATE = """\
+  <ssl>
+    certificate %(tls)s/server.pem
+    key %(tls)s/server.key
+    authenticate %(tls)s/ca.pem
+  </ssl>
+"""
+
+ZEOCLIENT_SSL_TEMPLATE = """\
+    <ssl>
+      certificate %(tls)s/client.pem
+      key %(tls)s/client.key
+      authenticate %(tls)s/ca.pem
+    </ssl>
+"""
+
+# Where --container instances live in their containers (below a
+# directory named after their service), with the volumes mounted below
+# them, and the Python of the official images.
+CONTAINER_ROOT = '/srv'
+CONTAINER_BLOB_DIR = '$INSTANCE/blobs'
+CONTAINER_PYTHON = '/usr/local/bin/python'
+CONTAINER_IMAGE = 'python:%d.%d-slim' % sys.version_info[:2]
+CONTAINER_SITE_PACKAGES = '/usr/local/lib/python%d.%d/site-packages' % (
+    sys.version_info[:2])
+
+# The uid the server runs as in the image when the instance is created
+# by root: a container's root is too powerful to run it.
+CONTAINER_UID = 10001
+
+# Where --reconcile records the files it wrote, in <home>/etc.
+RECONCILE_MANIFEST = '.mkzeoinstance.manifest'
+
+# Lock file in <home>/etc held while the instance is being written.
+LOCK_FILE = '.mkzeoinstance.lock'
+
+# Packages whose bytecode --fast-scripts compiles ahead of time.
+PRECOMPILE_PACKAGES = ('ZEO', 'ZODB', 'ZConfig', 'zdaemon', 'persistent',
+                       'BTrees', 'transaction', 'zc.lockfile', 'zodbpickle')
+
+# bin/zeoctl runs bin/zeostatus for "status" with --fast-scripts.
+ZEOCTL_STATUS_HOOK = '''\
+if [ "$1" = status ]; then
+    # Ask zdrun directly, without loading ZEO and the configuration.
+    exec "$PYTHON" -I -S "$INSTANCE_HOME/bin/zeostatus" ${1+"$@"}
+fi
+
+'''
+
+# Filesystems on which commits and storage iteration are slow.
+NETWORK_FILESYSTEMS = ('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'fuse.sshfs',
+                       'glusterfs', 'ceph', '9p')
+
+# Minimum storage performance for each profile, as measured by --probe:
+# the fsync latency (median, in ms) every commit waits for, the
+# sequential append throughput (MB/s) of Data.fs and the rate at which
+# blob files can be created (files/s).  Without a named profile, the
+# limits of small apply.
+PROBE_LIMITS = {
+    'small': {'fsync_ms': 50, 'append_mb_s': 10, 'files_per_s': 100},
+    'read-heavy': {'fsync_ms': 20, 'append_mb_s': 20, 'files_per_s': 200},
+    'write-heavy': {'fsync_ms': 5, 'append_mb_s': 50, 'files_per_s': 500},
+}
+
+# Filesystems missing a limit by this factor are refused rather than
+# warned about.
+PROBE_REFUSE_FACTOR = 4
+
+# From this median fsync latency (ms) on, storages are tuned as on a
+# network filesystem.
+PROBE_SLOW_FSYNC_MS = 20
+
+# What --probe writes: fsyncs of one small record each, the bytes
+# appended and the small files created.
+PROBE_FSYNCS = 50
+PROBE_APPEND_SIZE = 16 << 20
+PROBE_FILES = 200
+
+# Storage names end up as ZConfig section names.
+STORAGE_NAME = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+# Keys allowed for an [[instance]] (or [defaults]) in a --manifest file.
+MANIFEST_KEYS = ('home', 'address', 'blobs', 'profile', 'storages',
+                 'storage-dir', 'bench', 'metrics', 'blob-layout',
+                 'blob-mounts', 'shared-blobs', 'client-config',
+                 'client-var', 'storage-type', 'compress', 'pack',
+                 'pack-window', 'index', 'warm', 'service',
+                 'fast-scripts', 'reconcile', 'fsync', 'tls',
+                 'log-level', 'log-rotate', 'log-keep', 'log-json',
+                 'log-queue', 'probe', 'container', 'relocatable')
+
+# zeo.conf tuning parameters used without a profile.  create() also
+# falls back to these for callers (like ZRS) that build their own params.
+ZEO_TUNING_DEFAULTS = {
+    'invalidation_queue_size': 100,
+    'invalidation_age': '',
+    'transaction_timeout': '# transaction-timeout SECONDS',
+    'client_cache_hint': '',
+}
+
+
+def package_home(name):
+    """Return the directory containing the package called name.
+
+    The package is located without importing it, so that creating an
+    instance doesn't load the whole ZODB stack.
+    """
+    import importlib.util
+
+    spec = importlib.util.find_spec(name)
+    if spec is None or not spec.submodule_search_locations:
+        raise ImportError("No package named %s" % name)
+    return os.path.dirname(spec.submodule_search_locations[0])
+
+
+def print_(msg, *args, **kw):
+    if args:
+        msg = msg % args
+    if kw:
+        msg = msg % kw
+    if not isinstance(msg, str):
+        msg = msg.decode('utf8')
+    sys.stdout.write('%s\n' % msg)
+
+
+def usage(msg='', rc=1,
+          exit=sys.exit,  # testing hook
+          ):
+    if not isinstance(msg, str):
+        msg = str(msg)
+    print_(__doc__, program=PROGRAM)
+    if msg:
+        print_(msg)
+    exit(rc)
+
+
+def allocate_ports(host, first, count):
+    """Find count free TCP ports on host, starting at port first.
+
+    A port is free if it can be bound.  With first 0, the system picks
+    the ports.  All ports are held until the search is done, so none is
+    returned twice.
+    """
+    import socket
+
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    host = host.strip('[]')
+    ports = []
+    sockets = []
+    try:
+        port = first
+        while len(ports) < count:
+            if port > 65535:
+                raise ValueError("Not enough free ports from %s" % first)
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sockets.append(sock)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                sock.bind((host, port))
+            except OSError:
+                pass
+            else:
+                ports.append(sock.getsockname()[1])
+            if first:
+                port += 1
+    finally:
+        for sock in sockets:
+            sock.close()
+    return ports
+
+
+def is_socket_path(address):
+    """Tell whether address is the path of a Unix domain socket.
+
+    As for ZConfig, that's any address containing a slash.
+    """
+    return isinstance(address, str) and '/' in address
+
+
+def connect_address(address):
+    """Return the (host, port) clients on this host use to reach address.
+
+    Wildcard listen addresses are reached through localhost.  The path
+    of a Unix domain socket is returned as it is.
+    """
+    if is_socket_path(address):
+        return address
+    host, sep, port = str(address).rpartition(':')
+    if host in ('', '0.0.0.0', '::', '[::]'):
+        host = 'localhost'
+    return host.strip('[]'), int(port)
+
+
+def tls_hostnames(address):
+    """Return the names a server certificate for address is valid for.
+
+    Besides the host of the address, these are the names clients on this
+    host or elsewhere may use to reach it.
+    """
+    import socket
+
+    names = ['localhost', '127.0.0.1', '::1']
+    host = str(address).rpartition(':')[0].strip('[]')
+    for name in (host, socket.getfqdn(), socket.gethostname()):
+        if name and name not in names and name not in ('0.0.0.0', '::'):
+            names.append(name)
+    return names
+
+
+def missing_certificates(directory):
+    """Return the names of the certificates missing from directory."""
+    return [name for name in TLS_CERTIFICATES
+            if not os.path.exists(os.path.join(directory, name + '.pem'))]
+
+
+def make_certificates(directory, hostnames, openssl='openssl'):
+    """Create the missing TLS certificates and keys in directory.
+
+    The CA's certificate and key are ca.pem and ca.key; the server and
+    client certificates signed by it are server.pem and client.pem,
+    with keys server.key and client.key.  Certificates that exist are
+    kept, so certificates from another CA can be put in place first.
+    Keys are only readable by their owner.  Returns the certificates
+    created.
+    """
+    import ipaddress
+    import subprocess
+    import tempfile
+
+    alt_names = []
+    for name in hostnames:
+        try:
+            ipaddress.ip_address(name)
+        except ValueError:
+            alt_names.append('DNS:' + name)
+        else:
+            alt_names.append('IP:' + name)
+
+    created = []
+    with tempfile.NamedTemporaryFile('w', suffix='.cnf') as config:
+        config.write(TLS_EXTENSIONS % {
+            'subject_alt_names': ', '.join(alt_names)})
+        config.flush()
+        for name in missing_certificates(directory):
+            subject, days = TLS_CERTIFICATES[name]
+            path = os.path.join(directory, name)
+            command = [
+                openssl, 'req', '-new', '-newkey', 'ec',
+                '-pkeyopt', 'ec_paramgen_curve:' + TLS_CURVE, '-nodes',
+                '-keyout', path + '.key', '-subj', '/CN=' + subject,
+                '-config', config.name]
+            if name == 'ca':
+                subprocess.run(
+                    command + ['-x509', '-sha256', '-days', str(days),
+                               '-extensions', 'ca', '-out', path + '.pem'],
+                    check=True, capture_output=True)
+            else:
+                request = subprocess.run(
+                    command, check=True, capture_output=True).stdout
+                subprocess.run(
+                    [openssl, 'x509', '-req', '-sha256', '-days', str(days),
+                     '-CA', os.path.join(directory, 'ca.pem'),
+                     '-CAkey', os.path.join(directory, 'ca.key'),
+                     '-set_serial', '0x' + os.urandom(16).hex(),
+                     '-extfile', config.name, '-extensions', name,
+                     '-out', path + '.pem'],
+                    input=request, check=True, capture_output=True)
+            os.chmod(path + '.key', 0o600)
+            created.append(path + '.pem')
+    return created
+
+
+def format_size(nbytes):
+    """Format a byte count as a ZConfig byte-size value."""
+    for unit, factor in (('GB', 1 << 30), ('MB', 1 << 20), ('KB', 1 << 10)):
+        if nbytes >= factor:
+            return '%d%s' % (nbytes // factor, unit)
+    return '%d' % nbytes
+
+
+def parse_size(value):
+    """Parse a ZConfig byte-size value like 256MB into bytes."""
+    value = str(value).strip().upper()
+    for unit, factor in (('GB', 1 << 30), ('MB', 1 << 20), ('KB', 1 << 10)):
+        if value.endswith(unit):
+            return int(value[:-2]) * factor
+    return int(value)
+
+
+def tree_size(path):
+    """Return the total size of the files below path."""
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def client_cache_sizes(storage_size, blob_size, memory, wanted=None):
+    """Recommend ZEO client cache sizes for a storage.
+
+    The object cache aims at a quarter of the storage (or wanted, the
+    profile's hint), but never exceeds the storage itself or a 16th of
+    the RAM, as several application processes usually share a host.
+    The blob cache lives on disk and aims at a quarter of the blobs.
+    Returns (cache_size, blob_cache_size) in bytes.
+    """
+    memory = memory or (1 << 30)
+    if wanted is None:
+        wanted = max(64 << 20, storage_size // 4)
+    upper = memory // 16
+    if storage_size:
+        upper = min(upper, storage_size)
+    cache_size = max(20 << 20, min(wanted, upper))
+    blob_cache_size = max(256 << 20, min(blob_size // 4, 16 << 30))
+    return cache_size, blob_cache_size
+
+
+def pack_schedule(window, key=''):
+    """Pick the time to start packing within window.
+
+    The pack starts in the first half of the window, at a minute derived
+    from key (the instance home), so that instances sharing a host or
+    disks don't all pack at once.  Returns (weekday, hour, minute), with
+    weekday an index into PACK_WEEKDAYS, or None for daily packs.
+    Raises ValueError for an invalid window.
+    """
+    match = PACK_WINDOW.match(window.strip())
+    if match is None:
+        raise ValueError("Invalid pack window: %s" % window)
+    day, start_hour, start_minute, end_hour, end_minute = match.groups()
+    times = [int(start_hour), int(start_minute),
+             int(end_hour), int(end_minute)]
+    if times[0] > 23 or times[2] > 23 or times[1] > 59 or times[3] > 59:
+        raise ValueError("Invalid pack window: %s" % window)
+    weekday = None
+    if day is not None:
+        if day.capitalize() not in PACK_WEEKDAYS:
+            raise ValueError("Invalid pack window: %s" % window)
+        weekday = PACK_WEEKDAYS.index(day.capitalize())
+
+    start = times[0] * 60 + times[1]
+    span = (times[2] * 60 + times[3] - start) % 1440 or 1440
+    start += zlib.crc32(key.encode('utf-8')) % max(1, span // 2)
+    if weekday is not None:
+        # The window may run past midnight.
+        weekday = (weekday + start // 1440) % 7
+    start %= 1440
+    return weekday, start // 60, start % 60
+
+
+def systemd_unit_name(prefix, instance_home):
+    """Return a systemd unit name for instance_home, like zeo-NAME."""
+    return prefix + '-' + re.sub(
+        r'[^A-Za-z0-9_.-]', '_', os.path.basename(instance_home) or 'zeo')
+
+
+def script_literal(value, instance_home):
+    """Return value as a Python literal for a relocatable script.
+
+    Paths in instance_home (or starting with $INSTANCE) are made
+    relative to INSTANCE_HOME, where the script finds the instance when
+    it runs.
+    """
+    if isinstance(value, dict):
+        return '{%s}' % ', '.join(
+            '%r: %s' % (key, script_literal(item, instance_home))
+            for key, item in value.items())
+    if isinstance(value, str):
+        for prefix in ('$INSTANCE', instance_home):
+            if value.startswith(prefix + '/'):
+                return 'INSTANCE_HOME + %r' % value[len(prefix):]
+    return repr(value)
+
+
+def container_service_name(instance_home):
+    """Return the compose service name for instance_home."""
+    return re.sub(r'[^a-z0-9_.-]', '-',
+                  os.path.basename(instance_home).lower()) or 'zeo'
+
+
+def container_uid():
+    """Return the uid the server runs as in --container images.
+
+    That's the uid creating the instance, which owns the TLS keys
+    mounted into the container, or CONTAINER_UID instead of root.
+    """
+    return os.getuid() or CONTAINER_UID
+
+
+def container_requirements(packages):
+    """Return pip requirements for packages, pinned to the versions here.
+
+    Packages that aren't installed here are left unpinned.
+    """
+    from importlib import metadata
+
+    requirements = []
+    for package in packages:
+        try:
+            requirements.append(
+                '%s==%s' % (package, metadata.version(package)))
+        except metadata.PackageNotFoundError:
+            requirements.append(package)
+    return ' '.join(requirements)
+
+
+def cpu_affinity(cpus, block, count=None):
+    """Return the CPUAffinity for the block-th group of cpus cores.
+
+    Blocks wrap around when there are more of them than fit on the
+    count (default: all) cores of this host.
+    """
+    count = count or os.cpu_count() or 1
+    cpus = min(cpus, count)
+    first = block % (count // cpus) * cpus
+    if cpus == 1:
+        return '%d' % first
+    return '%d-%d' % (first, first + cpus - 1)
+
+
+def service_resources(values, affinity=None):
+    """Render the resource controls of a systemd unit.
+
+    Settings without a value are written as comments.
+    """
+    values = dict(SERVICE_DEFAULTS, **{
+        key: value for key, value in values.items()
+        if key in SERVICE_DEFAULTS})
+    memory_high = values['memory_high']
+    if memory_high is not None:
+        # systemd wants 4G, not 4GB.
+        memory_high = str(memory_high).upper().rstrip('B')
+    lines = [
+        ('CPUAffinity', affinity, 'CPUS'),
+        ('Nice', values['nice'], 'N'),
+        ('IOSchedulingClass', 'best-effort', None),
+        ('IOSchedulingPriority', values['io_priority'], 'N'),
+        ('LimitNOFILE', values['nofile'], 'N'),
+        ('MemoryHigh', memory_high, 'BYTES'),
+    ]
+    return ''.join(
+        '%s=%s\n' % (name, value) if value is not None
+        else '# %s=%s\n' % (name, placeholder)
+        for name, value, placeholder in lines)
+
+
+@functools.lru_cache(maxsize=None)
+def safe_python_flags(python=sys.executable):
+    """Return interpreter flags that speed up the server scripts.
+
+    Isolated mode (-I) skips the environment and the user's site
+    directory; it's only used if python can still import ZEO with it.
+    Disabling site (-S) would lose the site-packages ZEO is installed
+    in, so it is left alone.  python is only probed once.
+    """
+    import subprocess
+
+    flags = ['-I']
+    if sys.version_info >= (3, 11):
+        flags.extend(['-X', 'frozen_modules=on'])
+    try:
+        subprocess.check_call(
+            [python] + flags + ['-c', 'import ZEO.runzeo, zdaemon.zdctl'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+    return ' ' + ' '.join(flags)
+
+
+def precompile(packages=PRECOMPILE_PACKAGES):
+    """Compile the bytecode of packages for this interpreter.
+
+    Returns the names of the packages that couldn't be compiled, e.g.
+    because their directory isn't writable.
+    """
+    import compileall
+    import importlib.util
+
+    failed = []
+    for name in packages:
+        try:
+            spec = importlib.util.find_spec(name)
+        except ImportError:
+            spec = None
+        if spec is None or not spec.submodule_search_locations:
+            continue
+        for path in spec.submodule_search_locations:
+            if not compileall.compile_dir(path, quiet=2):
+                failed.append(name)
+                break
+    return failed
+
+
+def physical_memory():
+    """Return the physical memory of this host in bytes, or None."""
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def filesystem_type(path):
+    """Return the type of the filesystem holding path, or None.
+
+    Only Linux exposes this (through /proc/mounts); elsewhere the
+    answer is unknown.
+    """
+    path = os.path.realpath(path)
+    best, fstype = '', None
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1]
+                if (path == mount_point
+                        or path.startswith(mount_point.rstrip('/') + '/')):
+                    if len(mount_point) > len(best):
+                        best, fstype = mount_point, fields[2]
+    except OSError:
+        return None
+    return fstype
+
 
-import zdaemon
-import ZODB
+def existing_ancestor(path):
+    """Return path, or its closest ancestor that exists."""
+    while path and not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
 
 
-PROGRAM = os.path.basename(sys.argv[0])
+def probe_filesystem(path, fsyncs=PROBE_FSYNCS, append_size=PROBE_APPEND_SIZE,
+                     files=PROBE_FILES):
+    """Measure the storage performance of the filesystem holding path.
 
-ZEO_CONF_TEMPLATE = """\
-# ZEO configuration file
+    Commits are simulated by small appends that are each flushed to
+    disk, Data.fs growth by appending append_size bytes in 1MB writes,
+    and blobs by small files written and renamed into place, as ZODB
+    stores them.  The scratch files are created in a temporary
+    directory in path (or its closest existing ancestor) and removed.
+    Returns the median and 99th percentile fsync latency in ms, the
+    append throughput in MB/s and the file creation rate in files/s.
+    """
+    import shutil
+    import tempfile
 
-%%define INSTANCE %(instance_home)s
+    directory = tempfile.mkdtemp(prefix='.mkzeoinstance-probe-',
+                                 dir=existing_ancestor(path))
+    try:
+        latencies = []
+        with open(os.path.join(directory, 'fsync'), 'wb') as f:
+            for i in range(fsyncs):
+                start = time.perf_counter()
+                f.write(b'x' * 512)
+                f.flush()
+                os.fsync(f.fileno())
+                latencies.append(time.perf_counter() - start)
+        latencies.sort()
 
-<zeo>
-  address %(address)s
-  read-only false
-  invalidation-queue-size 100
-  # pid-filename $INSTANCE/var/ZEO.pid
-  # monitor-address PORT
-  # transaction-timeout SECONDS
-</zeo>
+        chunk = b'x' * (1 << 20)
+        start = time.perf_counter()
+        with open(os.path.join(directory, 'append'), 'wb') as f:
+            for i in range(max(1, append_size >> 20)):
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        append_time = time.perf_counter() - start
 
-<filestorage 1>
-  path $INSTANCE/var/Data.fs
-  %(blob_dir)s
-</filestorage>
+        start = time.perf_counter()
+        for i in range(files):
+            temp = os.path.join(directory, '%d.tmp' % i)
+            with open(temp, 'wb') as f:
+                f.write(chunk[:4096])
+            os.rename(temp, os.path.join(directory, '%d.blob' % i))
+        fsync_dir(directory)
+        files_time = time.perf_counter() - start
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
 
-<eventlog>
-  level info
-  <logfile>
-    path $INSTANCE/log/zeo.log
-  </logfile>
-</eventlog>
+    return {
+        'fsync_ms': latencies[len(latencies) // 2] * 1000,
+        'fsync_p99_ms': latencies[
+            min(len(latencies) - 1, len(latencies) * 99 // 100)] * 1000,
+        'append_mb_s': max(1, append_size >> 20) / max(append_time, 1e-9),
+        'files_per_s': files / max(files_time, 1e-9),
+    }
 
-<runner>
-  program $INSTANCE/bin/runzeo
-  socket-name $INSTANCE/var/%(package)s.zdsock
-  daemon true
-  forever false
-  backoff-limit 10
-  exit-codes 0, 2
-  directory $INSTANCE
-  default-to-interactive true
-  # user zope
-  python %(python)s
-  zdrun %(zdaemon_home)s/zdaemon/zdrun.py
 
-  # This logfile should match the one in the %(package)s.conf file.
-  # It is used by zdctl's logtail command, zdrun/zdctl doesn't write it.
-  logfile $INSTANCE/log/%(package)s.log
-</runner>
-"""
+def probe_problems(results, profile=None):
+    """Compare probe results with the limits of profile.
 
+    Returns (problem, fatal) pairs; a problem is fatal if a limit is
+    missed by PROBE_REFUSE_FACTOR or more.
+    """
+    limits = PROBE_LIMITS.get(profile, PROBE_LIMITS['small'])
+    problems = []
+    if results['fsync_ms'] > limits['fsync_ms']:
+        problems.append((
+            'fsync latency %.1fms exceeds %sms' % (
+                results['fsync_ms'], limits['fsync_ms']),
+            results['fsync_ms'] >= limits['fsync_ms'] * PROBE_REFUSE_FACTOR))
+    for key, what, unit in (('append_mb_s', 'append throughput', 'MB/s'),
+                            ('files_per_s', 'file creation rate',
+                             ' files/s')):
+        if results[key] < limits[key]:
+            problems.append((
+                '%s %.0f%s is below %s%s' % (
+                    what, results[key], unit, limits[key], unit),
+                results[key] * PROBE_REFUSE_FACTOR <= limits[key]))
+    return problems
 
-ZEOCTL_TEMPLATE = """\
-#!/bin/sh
-# %(PACKAGE)s instance control script
 
-# The following two lines are for chkconfig.  On Red Hat Linux (and
-# some other systems), you can copy or symlink this script into
-# /etc/rc.d/init.d/ and then use chkconfig(8) to automatically start
-# %(PACKAGE)s at boot time.
+def probe_tuning(values, results):
+    """Adjust profile values to probe results.
 
-# chkconfig: 345 90 10
-# description: start a %(PACKAGE)s server
+    Where fsync is slow, the storage is tuned as on a network filesystem
+    (see detect_profile): commits get more time and reconnecting clients
+    don't catch up by iterating the storage.
+    """
+    values = dict(values)
+    if results['fsync_ms'] >= PROBE_SLOW_FSYNC_MS:
+        values['invalidation_age'] = None
+        values['transaction_timeout'] = max(
+            values.get('transaction_timeout') or 0, 300)
+    return values
 
-PYTHON="%(python)s"
-INSTANCE_HOME="%(instance_home)s"
-ZODB3_HOME="%(zodb_home)s"
 
-CONFIG_FILE="%(instance_home)s/etc/%(package)s.conf"
+def detect_profile(path):
+    """Compute tuning values for an instance to be created at path.
 
-PYTHONPATH="$ZODB3_HOME"
-export PYTHONPATH INSTANCE_HOME
+    The invalidation queue, client cache hint and memory limit scale
+    with RAM, the transaction timeout and CPU pinning with CPU count;
+    network filesystems get a
+    longer timeout and no invalidation-age, as iterating the storage
+    to catch up clients would be slow there.
+    """
+    cpus = os.cpu_count() or 1
+    memory = physical_memory() or (1 << 30)
+    gigabytes = max(1, memory >> 30)
 
-exec "$PYTHON" -m ZEO.zeoctl -C "$CONFIG_FILE" ${1+"$@"}
-"""
+    values = {
+        'invalidation_queue_size': min(20000, max(100, 1000 * gigabytes)),
+        'invalidation_age': 3600 if gigabytes >= 4 else 600,
+        'transaction_timeout': 60 if cpus >= 4 else 120,
+        'client_cache_size': format_size(
+            min(2 << 30, max(20 << 20, memory // 64))),
+        'cpus': 2 if cpus >= 4 else None,
+        'nice': -5 if cpus >= 4 else 0,
+        'io_priority': 2,
+        'memory_high': format_size(max(512 << 20, memory // 4)),
+        'nofile': 65536,
+    }
 
+    if filesystem_type(existing_ancestor(path)) in NETWORK_FILESYSTEMS:
+        values['invalidation_age'] = None
+        values['transaction_timeout'] = 300
+    return values
 
-RUNZEO_TEMPLATE = """\
-#!/bin/sh
-# %(PACKAGE)s instance start script
 
-PYTHON="%(python)s"
-INSTANCE_HOME="%(instance_home)s"
-ZODB3_HOME="%(zodb_home)s"
+def get_profile(name, instance_home):
+    """Return the tuning values for the profile called name."""
+    if name == 'auto':
+        return detect_profile(instance_home)
+    return dict(PROFILES[name])
 
-CONFIG_FILE="%(instance_home)s/etc/%(package)s.conf"
 
-PYTHONPATH="$ZODB3_HOME"
-export PYTHONPATH INSTANCE_HOME
+def profile_params(values):
+    """Render tuning values into zeo.conf template parameters."""
+    params = dict(ZEO_TUNING_DEFAULTS)
+    params['invalidation_queue_size'] = values['invalidation_queue_size']
+    if values.get('invalidation_age'):
+        params['invalidation_age'] = (
+            '  invalidation-age %s\n' % values['invalidation_age'])
+    if values.get('transaction_timeout'):
+        params['transaction_timeout'] = (
+            'transaction-timeout %s' % values['transaction_timeout'])
+    if values.get('client_cache_size'):
+        params['client_cache_hint'] = (
+            '  # Recommended client cache-size: %s\n'
+            % values['client_cache_size'])
+    return params
 
-exec "$PYTHON" -m ZEO.runzeo -C "$CONFIG_FILE" ${1+"$@"}
-"""
 
-ZEO_DEFAULT_BLOB_DIR = '$INSTANCE/var/blobs'
+class ZEOInstanceBuilder:
 
+    storage_types = STORAGE_TYPES
 
-def print_(msg, *args, **kw):
-    if args:
-        msg = msg % args
-    if kw:
-        msg = msg % kw
-    if not isinstance(msg, str):
-        msg = msg.decode('utf8')
-    sys.stdout.write('%s\n' % msg)
+    def register_storage_type(self, name, template, package=None):
+        """Make a storage section template available as storage type name.
 
+        The template is filled in with the storage's name, var directory,
+        Data.fs path and "blob-dir ..." line (name, var, path and
+        blob_dir); package, if given, is %import-ed in zeo.conf.
+        """
+        self.storage_types = dict(self.storage_types)
+        self.storage_types[name] = (template, package)
 
-def usage(msg='', rc=1,
-          exit=sys.exit,  # testing hook
-          ):
-    if not isinstance(msg, str):
-        msg = str(msg)
-    print_(__doc__, program=PROGRAM)
-    if msg:
-        print_(msg)
-    exit(rc)
+    def get_storages(self, names, blob_dir, storage_dirs=None,
+                     blob_mounts=None, instance_home='',
+                     storage_type='filestorage', compress=None,
+                     replicate_to=None, replicate_from=None):
+        """Describe the file storages served by the instance.
 
+        Returns a list of dicts with the storage name, its var directory,
+        the Data.fs path and the blob directory (or None).  With
+        blob_mounts, the storages' blob directories are spread over them
+        round-robin, below a directory named after the instance.
+        replicate_to and replicate_from map storage names to the
+        addresses they replicate to or from with zc.zrs.
+        """
+        storage_dirs = storage_dirs or {}
+        storages = []
+        for index, name in enumerate(names):
+            var = storage_dirs.get(name)
+            if var is None:
+                var = '$INSTANCE/var'
+                if index:
+                    var += '/' + name
+            if blob_mounts:
+                blobs = os.path.join(
+                    blob_mounts[index % len(blob_mounts)],
+                    os.path.basename(instance_home) or 'zeo', name)
+            elif not blob_dir:
+                blobs = None
+            elif blob_dir == ZEO_DEFAULT_BLOB_DIR:
+                blobs = var + '/blobs'
+            elif len(names) == 1:
+                blobs = blob_dir
+            else:
+                blobs = os.path.join(blob_dir, name)
+            storages.append({
+                'name': name,
+                'type': storage_type,
+                'compress': compress,
+                'var': var,
+                'path': var + '/Data.fs',
+                'blob_dir': blobs,
+                'replicate_to': (replicate_to or {}).get(name),
+                'replicate_from': (replicate_from or {}).get(name),
+            })
+        return storages
 
-class ZEOInstanceBuilder:
+    def render_storages(self, storages):
+        sections = []
+        for storage in storages:
+            section = self.storage_types[
+                storage.get('type', 'filestorage')][0] % {
+                'name': storage['name'],
+                'var': storage['var'],
+                'path': storage['path'],
+                'blob_dir': ('blob-dir %s' % storage['blob_dir']
+                             if storage['blob_dir'] else ''),
+            }
+            if storage.get('compress'):
+                section = COMPRESSORS[storage['compress']][0] % {
+                    'name': storage['name'],
+                    'storage': ''.join(
+                        '  ' + line if line.strip() else line
+                        for line in section.splitlines(True)),
+                }
+            if storage.get('replicate_to') or storage.get('replicate_from'):
+                replication = ''
+                if storage.get('replicate_from'):
+                    replication += '  replicate-from %s\n' % (
+                        storage['replicate_from'])
+                    replication += '  keep-alive-delay %s\n' % (
+                        ZRS_KEEP_ALIVE_DELAY)
+                if storage.get('replicate_to'):
+                    replication += '  replicate-to %s\n' % (
+                        storage['replicate_to'])
+                section = ZRS_TEMPLATE % {
+                    'name': storage['name'],
+                    'replication': replication,
+                    'storage': ''.join(
+                        '  ' + line if line.strip() else line
+                        for line in section.splitlines(True)),
+                }
+            sections.append(section)
+        return '\n'.join(sections)
+
+    def render_imports(self, storages):
+        """Render the %import lines the storage sections need."""
+        packages = []
+        for storage in storages:
+            for package in (
+                    self.storage_types[storage.get('type', 'filestorage')][1],
+                    storage.get('compress')
+                    and COMPRESSORS[storage['compress']][1],
+                    (storage.get('replicate_to')
+                     or storage.get('replicate_from')) and 'zc.zrs'):
+                if package and package not in packages:
+                    packages.append(package)
+        if not packages:
+            return ''
+        return ''.join('%%import %s\n' % package
+                       for package in packages) + '\n'
+
+    def get_directories(self, storages, blob_mounts=None):
+        """Return the directories to create for storages.
+
+        Blob directories are only created when they were derived from
+        the default or placed on blob_mounts, as before.
+        """
+        directories = []
+        for storage in storages:
+            directories.append(storage['var'])
+            blobs = storage['blob_dir']
+            if blobs and (blobs == storage['var'] + '/blobs'
+                          or blob_mounts):
+                directories.append(blobs)
+        return directories
 
     def get_params(self, zodb_home, zdaemon_home,
-                   instance_home, address, blob_dir):
-        return {
+                   instance_home, address, blob_dir, profile=None,
+                   storages=None, storage_dirs=None, bench=False,
+                   metrics=None, blob_layout=None, blob_mounts=None,
+                   shared_blobs=False, client_config=False,
+                   client_var=None, storage_type='filestorage',
+                   compress=None, pack=None, pack_window=None,
+                   index=False, warm=None, service=None, cpu_block=None,
+                   fast_scripts=False, reconcile=False, dry_run=False,
+                   fsync=False, tls=None, log_level=None, log_rotate=None,
+                   log_keep=None, log_json=False, log_queue=False,
+                   replicate_to=None, replicate_from=None, read_only=False,
+                   container=None, relocatable=False):
+        literal = repr
+        if relocatable:
+            literal = functools.partial(script_literal,
+                                        instance_home=instance_home)
+        storage_list = self.get_storages(
+            storages or ['1'], blob_dir, storage_dirs, blob_mounts,
+            instance_home, storage_type, compress, replicate_to,
+            replicate_from)
+        params = {
             "package": "zeo",
             "PACKAGE": "ZEO",
             "zodb_home": zodb_home,
@@ -171,27 +2349,716 @@ class ZEOInstanceBuilder:
             "instance_home": instance_home,
             "blob_dir": f"blob-dir {blob_dir}" if blob_dir else "",
             "address": address,
-            "python": sys.executable,
+            "read_only": "true" if read_only else "false",
+            "python": CONTAINER_PYTHON if container else sys.executable,
+            "profile": None,
+            "storage_list": storage_list,
+            "storages": self.render_storages(storage_list),
+            "imports": self.render_imports(storage_list),
+            "directories": self.get_directories(storage_list, blob_mounts),
+            # For generated scripts: storage name -> Data.fs path
+            "storage_files": literal({
+                storage['name']: storage['path'].replace(
+                    '$INSTANCE', instance_home)
+                for storage in storage_list}),
+            "blob_layout": blob_layout,
+            "shared_blobs": shared_blobs,
+            "client_cache": None,
+            "bench": bench,
+            "metrics": metrics,
+            "compress": compress,
+            "pack": pack,
+            "index": index or bool(warm),
+            "runzeo_hook": "",
+            "service": service,
+            "fast_scripts": fast_scripts,
+            "python_cmd": '"$PYTHON"',
+            "zeoctl_hook": "",
+            "reconcile": reconcile,
+            "dry_run": dry_run,
+            "fsync": fsync,
+            "tls": tls,
+            "ssl": "",
+            "tls_files": None,
+            "log_level": log_level or 'info',
+            "log_options": "",
+            "runzeo_main": RUNZEO_QUEUE_MAIN if log_queue else RUNZEO_MAIN,
+            "container": container,
+            "relocatable": relocatable,
+        }
+        params.update(self.get_script_params(params))
+        if relocatable:
+            params['python'] = RELOCATABLE_PYTHON
+        if fast_scripts:
+            params['python_cmd'] = '"$PYTHON"' + safe_python_flags()
+            params['zeoctl_hook'] = ZEOCTL_STATUS_HOOK
+        if params['index']:
+            # Rebuild a missing or stale index with progress reports, and
+            # warm up the page cache, before the server starts.
+            params['index_warm'] = warm
+            params['runzeo_hook'] = (
+                '"$INSTANCE_HOME/bin/zeoindex" --rebuild\n\n')
+        if pack is not None:
+            weekday, hour, minute = pack_schedule(
+                pack_window or ZEO_DEFAULT_PACK_WINDOW, instance_home)
+            params['pack_days'] = pack
+            params['pack_unit'] = systemd_unit_name('zeopack', instance_home)
+            params['pack_calendar'] = '%s*-*-* %02d:%02d:00' % (
+                '' if weekday is None else PACK_WEEKDAYS[weekday] + ' ',
+                hour, minute)
+            params['pack_cron'] = '%d %d * * %s' % (
+                minute, hour,
+                '*' if weekday is None else (weekday + 1) % 7)
+        if is_socket_path(address):
+            socket_dir = os.path.dirname(address)
+            if socket_dir not in params['directories']:
+                params['directories'].append(socket_dir)
+        if tls:
+            if container:
+                # Mounted there from the host.
+                tls = ZEO_DEFAULT_TLS_DIR
+            params['ssl'] = ZEO_SSL_TEMPLATE % {'tls': tls}
+            tls = tls.replace('$INSTANCE', instance_home)
+            params['tls_files'] = literal({
+                'certificate': tls + '/client.pem',
+                'key': tls + '/client.key',
+                'authenticate': tls + '/ca.pem',
+            })
+        if log_rotate or log_json:
+            params['log_options'] = self.render_log_options(
+                log_rotate, log_keep, log_json)
+        if compress:
+            params['compress_wrapper'] = COMPRESSORS[compress][2]
+        if metrics:
+            host, port = connect_address(metrics)
+            params['metrics_address'] = '%s:%s' % (host, port)
+            params['metrics_listen'] = repr((host, port))
+            params['metrics_server'] = literal(connect_address(address))
+        if profile is None:
+            params.update(ZEO_TUNING_DEFAULTS)
+        else:
+            if isinstance(profile, dict):
+                values = profile
+            else:
+                values = get_profile(profile, instance_home)
+            params.update(profile_params(values))
+            params['profile'] = values
+        if service:
+            values = params['profile'] or SERVICE_DEFAULTS
+            affinity = None
+            if values.get('cpus'):
+                if cpu_block is None:
+                    # Spread instances sharing a host over the cores.
+                    cpu_block = zlib.crc32(instance_home.encode('utf-8'))
+                affinity = cpu_affinity(values['cpus'], cpu_block)
+            params['service_unit'] = systemd_unit_name('zeo', instance_home)
+            params['service_resources'] = service_resources(values, affinity)
+        if client_config:
+            params['client_cache'] = self.get_client_cache(
+                storage_list, instance_home, params['profile'], client_var)
+        if container:
+            volumes = ['$INSTANCE/var', '$INSTANCE/log']
+            if any(storage['blob_dir'] for storage in storage_list):
+                volumes.insert(1, CONTAINER_BLOB_DIR)
+            directories = params['directories'] + [
+                path for path in volumes
+                if path not in params['directories']]
+            packages = ['ZEO'] + re.findall(
+                r'^%import (\S+)$', params['imports'], re.MULTILINE)
+            if log_json or log_queue:
+                packages.append('zope.mkzeoinstance')
+            params['container_image'] = CONTAINER_IMAGE
+            params['container_uid'] = container_uid()
+            params['container_requirements'] = container_requirements(
+                packages)
+            params['container_directories'] = ' '.join(
+                path.replace('$INSTANCE', instance_home)
+                for path in directories)
+            params['container_volumes'] = ' '.join(
+                path.replace('$INSTANCE', instance_home) for path in volumes)
+        return params
+
+    def get_script_params(self, params):
+        """Return how zeo.conf and the scripts find the instance and Python.
+
+        With params['relocatable'], they find them when they run rather
+        than where the instance was created.
+        """
+        if not params.get('relocatable'):
+            return {
+                'conf_home': params['instance_home'],
+                'conf_address': params['address'],
+                'runner_interpreter': RUNNER_INTERPRETER_TEMPLATE % params,
+                'script_env': SCRIPT_ENV_TEMPLATE % params,
+                'script_home': SCRIPT_HOME_TEMPLATE % params,
+            }
+        address = params['address']
+        if is_socket_path(address) and address.startswith(
+                params['instance_home'] + '/'):
+            address = '$INSTANCE' + address[len(params['instance_home']):]
+        return {
+            'conf_home': '$(INSTANCE_HOME)',
+            'conf_address': address,
+            'runner_interpreter': '',
+            'script_env': RELOCATABLE_SCRIPT_ENV_TEMPLATE % params,
+            'script_home': RELOCATABLE_SCRIPT_HOME_TEMPLATE,
         }
 
-    def create(self, home, params):
+    def render_log_options(self, rotate=None, keep=None, json=False):
+        """Render the <logfile> settings for rotation and JSON logs.
+
+        rotate is a size, like 100MB, or one of LOG_ROTATIONS; keep is
+        the number of old log files kept.
+        """
+        options = []
+        if rotate in LOG_ROTATIONS:
+            options.append(('when', LOG_ROTATIONS[rotate]))
+        elif rotate:
+            options.append(('max-size', rotate.strip().upper()))
+        if rotate:
+            options.append(('old-files', keep or ZEO_DEFAULT_LOG_KEEP))
+        if json:
+            options.append(
+                ('formatter', 'zope.mkzeoinstance.json_log_formatter'))
+            options.append(('format', '%(message)s'))
+        return ''.join('    %s %s\n' % option for option in options)
+
+    def get_client_cache(self, storages, instance_home, profile=None,
+                         client_var=None):
+        """Return client cache settings for each storage.
+
+        Sizes are derived from the current size of the storage files, if
+        any, and the RAM of this host.  The cache is persistent: it is
+        kept in client_var (default <home>/var/zeoclient) and reused on
+        restart, so the working set isn't fetched again.
+        """
+        memory = physical_memory()
+        wanted = None
+        if profile and profile.get('client_cache_size'):
+            wanted = parse_size(profile['client_cache_size'])
+        if client_var is None:
+            client_var = os.path.join(instance_home, 'var', 'zeoclient')
+        settings = {}
+        for storage in storages:
+            path = storage['path'].replace('$INSTANCE', instance_home)
+            try:
+                storage_size = os.stat(path).st_size
+            except OSError:
+                storage_size = 0
+            blob_dir = storage['blob_dir']
+            blob_size = 0
+            if blob_dir:
+                blob_size = tree_size(
+                    blob_dir.replace('$INSTANCE', instance_home))
+            cache_size, blob_cache_size = client_cache_sizes(
+                storage_size, blob_size, memory, wanted)
+            options = [
+                ('cache-size', format_size(cache_size)),
+                ('client', os.path.basename(instance_home) or 'zeo'),
+                ('var', client_var),
+            ]
+            if blob_dir:
+                options.extend([
+                    ('blob-dir', os.path.join(
+                        client_var, 'blobs-%s' % storage['name'])),
+                    ('blob-cache-size', format_size(blob_cache_size)),
+                ])
+            settings[storage['name']] = options
+        return settings
+
+    def create(self, home, params, umask=None):
+        if params.get('reconcile') or params.get('dry_run'):
+            files = Reconciler(os.path.join(home, 'etc', RECONCILE_MANIFEST),
+                               dry_run=params.get('dry_run'),
+                               fsync=params.get('fsync'), umask=umask)
+        else:
+            files = InstanceFiles(fsync=params.get('fsync'), umask=umask)
+        model = self.render(home, params)
+        if params.get('dry_run'):
+            model.write(files, params)
+            self.create_extras(model, params)
+            return
+        # Keep concurrent runs for the same home from interleaving.
+        lock = lock_home(home)
+        try:
+            model.write(files, params)
+            self.create_extras(model, params)
+        finally:
+            lock.close()
+
+    def render(self, home, params):
+        """Render the instance at home to an InstanceModel.
+
+        Nothing is written, printed or imported, so callers can render
+        many instances quickly and diff, ship or write them as they
+        like.  params are as returned by get_params; they are left
+        unchanged.
+        """
+        model = InstanceModel(home)
+        self.write_files(home, params, model)
+        return model
+
+    def create_extras(self, model, params):
+        """Create what an instance needs besides its files.
+
+        That's the missing TLS certificates and, for --fast-scripts,
+        ZEO's precompiled bytecode.
+        """
+        if params.get('tls'):
+            tls = params['tls'].replace('$INSTANCE', model.home)
+            missing = missing_certificates(tls)
+            if missing and params.get('dry_run'):
+                print_("Would create TLS certificates %s in %s",
+                       ', '.join(missing), tls)
+            elif missing:
+                # Only the owner may read the keys.
+                os.chmod(tls, 0o700)
+                hostnames = tls_hostnames(params['address'])
+                if params.get('container'):
+                    # How the other containers reach it.
+                    hostnames.append(container_service_name(model.home))
+                for path in make_certificates(tls, hostnames):
+                    print_("Created certificate %s", path)
+        if params.get('fast_scripts') and not params.get('dry_run'):
+            for name in precompile():
+                print_("Warning: can't precompile %s", name)
+
+    def complete_params(self, params, home=None):
+        """Return params with what the templates need filled in.
+
+        params built by an older caller, with just the values the
+        templates took before, are given defaults for the rest.  params
+        themselves are left unchanged.  home defaults to the instance
+        home in params.
+        """
+        params = dict(params)
+        if home is None:
+            home = params['instance_home']
+        if 'storages' not in params:
+            # Params built by an older caller: one storage, its blob
+            # dir given as a ready-made "blob-dir ..." line.
+            blob_dir = params.setdefault('blob_dir', '')
+            storage_list = self.get_storages(
+                ['1'], blob_dir.split(None, 1)[1] if blob_dir else None)
+            params['storage_list'] = storage_list
+            params['storages'] = self.render_storages(storage_list)
+            params['directories'] = self.get_directories(storage_list)
+            params['storage_files'] = repr({
+                storage['name']: storage['path'].replace('$INSTANCE', home)
+                for storage in storage_list})
+        params.setdefault('imports', '')
+        for name, value in ZEO_TUNING_DEFAULTS.items():
+            params.setdefault(name, value)
+        params.setdefault('runzeo_hook', '')
+        params.setdefault('zeoctl_hook', '')
+        params.setdefault('python_cmd', '"$PYTHON"')
+        params.setdefault('ssl', '')
+        params.setdefault('tls_files', None)
+        params.setdefault('log_level', 'info')
+        params.setdefault('log_options', '')
+        params.setdefault('runzeo_main', RUNZEO_MAIN)
+        params.setdefault('read_only', 'false')
+        if 'script_env' not in params:
+            params.update(self.get_script_params(params))
+        return params
+
+    def write_files(self, home, params, files):
+        makedir = files.makedir
+        makefile = files.makefile
+        makexfile = files.makexfile
+
         makedir(home)
         makedir(home, "etc")
         makedir(home, "var")
         makedir(home, "log")
         makedir(home, "bin")
 
-        # Create dir only when default is selected
-        if ZEO_DEFAULT_BLOB_DIR in params.setdefault('blob_dir', ''):
-            makedir(home, "var/blobs")
+        params = self.complete_params(params, home)
+        for path in params['directories']:
+            makedir(path.replace('$INSTANCE', home))
+
+        if params.get('blob_layout'):
+            # ZODB reads the layout of a blob directory from this marker.
+            for storage in params['storage_list']:
+                if storage['blob_dir']:
+                    makefile(params['blob_layout'],
+                             storage['blob_dir'].replace('$INSTANCE', home),
+                             '.layout')
+
+        if params.get('tls'):
+            files.makedir(params['tls'].replace('$INSTANCE', home))
 
         makefile(ZEO_CONF_TEMPLATE, home, "etc", "zeo.conf", **params)
         makexfile(ZEOCTL_TEMPLATE, home, "bin", "zeoctl", **params)
         makexfile(RUNZEO_TEMPLATE, home, "bin", "runzeo", **params)
+        if params.get('bench'):
+            makexfile(ZEOBENCH_TEMPLATE, home, "bin", "zeobench", **params)
+        if params.get('metrics'):
+            makexfile(ZEOMETRICS_TEMPLATE, home, "bin", "zeometrics",
+                      **params)
+        if params.get('compress'):
+            makexfile(ZEOCOMPRESS_TEMPLATE, home, "bin", "zeocompress",
+                      **params)
+        if params.get('fast_scripts'):
+            makexfile(ZEOSTATUS_TEMPLATE, home, "bin", "zeostatus",
+                      **params)
+        if params.get('service'):
+            makefile(ZEO_SERVICE_TEMPLATE, home, "etc",
+                     params['service_unit'] + '.service', **params)
+        if params.get('index'):
+            makexfile(ZEOINDEX_TEMPLATE, home, "bin", "zeoindex", **params)
+        if params.get('pack') is not None:
+            makexfile(ZEOPACK_TEMPLATE, home, "bin", "zeopack", **params)
+            makefile(ZEOPACK_SERVICE_TEMPLATE, home, "etc",
+                     params['pack_unit'] + '.service', **params)
+            makefile(ZEOPACK_TIMER_TEMPLATE, home, "etc",
+                     params['pack_unit'] + '.timer', **params)
+            makefile(ZEOPACK_CRON_TEMPLATE, home, "etc", "zeopack.cron",
+                     **params)
+        if params.get('client_cache'):
+            for settings in params['client_cache'].values():
+                makedir(dict(settings)['var'])
+        if (params.get('shared_blobs') or params.get('client_cache')
+                or params.get('tls')):
+            makefile(ZEOCLIENT_CONF_TEMPLATE, home, "etc", "zeoclient.conf",
+                     description='the ZEO server in %s' % home,
+                     clients=self.render_clients([params]))
+        if params.get('container'):
+            makefile(DOCKERFILE_TEMPLATE, home, "Dockerfile", **params)
+            makefile(DOCKERIGNORE_TEMPLATE, home, ".dockerignore",
+                     reconcile_manifest=RECONCILE_MANIFEST,
+                     lock_file=LOCK_FILE)
+            makefile(COMPOSE_TEMPLATE, home, "compose.yaml",
+                     description='the ZEO server in %s' % home,
+                     **self.render_compose(home, [(home, params)]))
+        files.close(params)
+
+    def render_compose(self, directory, instances):
+        """Render the services and volumes of a compose file.
+
+        instances are (home, params) pairs of --container instances,
+        built from their homes relative to directory.
+        """
+        services = []
+        volumes = []
+        for home, params in instances:
+            service = container_service_name(home)
+            build = os.path.relpath(home, directory)
+            mounts = []
+            for path in params['container_volumes'].split():
+                volume = '%s-%s' % (service, os.path.basename(path))
+                mounts.append('%s:%s' % (volume, path))
+                volumes.append('  %s:\n' % volume)
+            if params.get('tls'):
+                tls = os.path.relpath(
+                    params['tls'].replace('$INSTANCE', home), directory)
+                mounts.append('%s:%s:ro' % (
+                    tls if tls.startswith('.') else './' + tls,
+                    ZEO_DEFAULT_TLS_DIR.replace(
+                        '$INSTANCE', params['instance_home'])))
+            services.append(COMPOSE_SERVICE_TEMPLATE % {
+                'service': service,
+                'build': build if build.startswith('.') else './' + build,
+                'publish': '%s:%s' % (params['container'],
+                                      params['address']),
+                'volumes': ''.join('      - %s\n' % mount
+                                   for mount in mounts),
+            })
+        return {'services': '\n'.join(services), 'volumes': ''.join(volumes)}
+
+    def probe(self, paths, profile, instance_home,
+              usage=usage,  # testing hook
+              probed=None,
+              ):
+        """Probe the filesystems the instance's storages will live on.
+
+        Each filesystem is probed once and the results are printed.
+        Filesystems too slow for profile are warned about, or refused
+        if they are much too slow.  Returns the profile's tuning values
+        adjusted to the slowest filesystem, or None without a profile.
+        probed maps the filesystems already probed for other instances
+        of the same run to their results and the profiles they were
+        checked for; they aren't probed or reported again.
+        """
+        if probed is None:
+            probed = {}
+        name = profile
+        if isinstance(profile, dict):
+            name = next((key for key, values in PROFILES.items()
+                         if values == profile), None)
+        devices = set()
+        slowest = None
+        for path in paths:
+            existing = existing_ancestor(path)
+            device = os.stat(existing).st_dev
+            if device in devices:
+                continue
+            devices.add(device)
+            if device in probed:
+                results, checked = probed[device]
+            else:
+                results = probe_filesystem(path)
+                print_("Probed %s (%s): fsync %.1fms (p99 %.1fms),"
+                       " append %.0f MB/s, %.0f files/s", path,
+                       filesystem_type(existing) or 'unknown filesystem',
+                       results['fsync_ms'], results['fsync_p99_ms'],
+                       results['append_mb_s'], results['files_per_s'])
+                checked = set()
+                probed[device] = results, checked
+            if name in checked:
+                problems = []
+            else:
+                problems = probe_problems(results, name)
+                checked.add(name)
+            for problem, fatal in problems:
+                message = "%s is too slow for the %s profile: %s" % (
+                    path, name if name in PROBE_LIMITS else 'small', problem)
+                if fatal:
+                    usage(message, rc=1)
+                print_("Warning: %s", message)
+            if slowest is None or results['fsync_ms'] > slowest['fsync_ms']:
+                slowest = results
+        if profile is None:
+            return None
+        if not isinstance(profile, dict):
+            profile = get_profile(profile, instance_home)
+        return probe_tuning(profile, slowest)
+
+    def parse_storages(self, value,
+                       usage=usage,  # testing hook
+                       ):
+        """Parse --storages: a count or a comma separated list of names.
+
+        Returns the storage names, or None if value is empty.
+        """
+        if not value:
+            return None
+        if value.isdigit():
+            storages = [str(i + 1) for i in range(int(value))]
+        else:
+            storages = [name.strip() for name in value.split(',')]
+        if not storages or not all(
+                STORAGE_NAME.match(name) for name in storages):
+            usage("Invalid storages: %s" % value, rc=1)
+        if len(set(storages)) != len(storages):
+            usage("Duplicate storage names: %s" % value, rc=1)
+        return storages
+
+    def get_args_params(self, args, zodb_home, zdaemon_home,
+                        usage=usage,  # testing hook
+                        cpu_block=None, probed=None,
+                        ):
+        """Validate parsed command line (or manifest) arguments.
+
+        Returns the instance home and its template parameters.  probed
+        is shared by the instances of a run, see probe.
+        """
+        if (args.profile is not None
+                and not isinstance(args.profile, dict)
+                and args.profile not in PROFILES
+                and args.profile != 'auto'):
+            usage("Unknown profile: %s" % args.profile, rc=1)
+
+        storages = self.parse_storages(args.storages, usage=usage)
+
+        if args.storage_type not in self.storage_types:
+            usage("Unknown storage type: %s" % args.storage_type, rc=1)
+
+        if args.compress is not None:
+            if args.compress not in COMPRESSORS:
+                usage("Unknown compressor: %s" % args.compress, rc=1)
+            if args.storage_type == 'zlibstorage':
+                usage("zlibstorage is already compressed", rc=1)
+
+        storage_dirs = {}
+        for spec in args.storage_dir:
+            name, sep, path = spec.partition('=')
+            if not sep or not path or name not in (storages or ['1']):
+                usage("Invalid storage directory: %s" % spec, rc=1)
+            storage_dirs[name] = os.path.abspath(path)
+
+        instance_home = os.path.abspath(args.instance_home)
+
+        addr_string = args.addr_string
+
+        if is_socket_path(addr_string):
+            address = os.path.join(instance_home, addr_string)
+            if len(address.encode('utf-8')) > UNIX_PATH_MAX:
+                usage("Socket path too long: %s" % address, rc=1)
+        elif ':' in addr_string:
+            host, port = addr_string.split(':', 1)
+            address = host + ':' + port
+        elif addr_string.isdigit():
+            address = int(addr_string)
+        else:
+            usage(rc=1)
+
+        if args.metrics:
+            if not args.metrics.rpartition(':')[2].isdigit():
+                usage("Invalid metrics address: %s" % args.metrics, rc=1)
+
+        if args.blob_layout is not None and args.blob_layout not in (
+                BLOB_LAYOUTS):
+            usage("Unknown blob layout: %s" % args.blob_layout, rc=1)
+
+        if args.pack is not None and args.pack < 0:
+            usage("Invalid pack retention: %s" % args.pack, rc=1)
+        if args.pack_window is not None:
+            try:
+                pack_schedule(args.pack_window)
+            except ValueError as e:
+                usage(str(e), rc=1)
+
+        warm = args.warm
+        if warm is not None:
+            try:
+                # Zero or nothing turns warming up off.
+                if not warm.strip() or not parse_size(warm):
+                    warm = None
+            except ValueError:
+                usage("Invalid warm-up size: %s" % args.warm, rc=1)
+
+        if args.service is not None and args.service not in SERVICES:
+            usage("Unknown service manager: %s" % args.service, rc=1)
+
+        if args.log_level is not None and args.log_level not in LOG_LEVELS:
+            usage("Unknown log level: %s" % args.log_level, rc=1)
+        if (args.log_rotate is not None
+                and args.log_rotate not in LOG_ROTATIONS):
+            try:
+                size = parse_size(args.log_rotate)
+            except ValueError:
+                size = 0
+            if size <= 0:
+                usage("Invalid log rotation: %s" % args.log_rotate, rc=1)
+        if args.log_keep is not None and args.log_keep < 1:
+            usage("Invalid number of old log files: %s" % args.log_keep,
+                  rc=1)
+
+        tls = args.tls
+        if tls is not None:
+            if is_socket_path(address):
+                usage("TLS needs a TCP address", rc=1)
+            if tls != ZEO_DEFAULT_TLS_DIR:
+                tls = os.path.abspath(tls)
+            import shutil
+            if (missing_certificates(tls.replace('$INSTANCE', instance_home))
+                    and shutil.which('openssl') is None):
+                usage("Creating TLS certificates needs openssl", rc=1)
+
+        container = getattr(args, 'container', False)
+        if container:
+            for option, value in (
+                    ('--storage-dir', args.storage_dir),
+                    ('--blob-mounts', args.blob_mounts),
+                    ('--blob-layout', args.blob_layout),
+                    ('--shared-blobs', args.shared_blobs),
+                    ('--client-config', args.client_config),
+                    ('--client-var', args.client_var),
+                    ('--service', args.service),
+                    ('--pack', args.pack is not None),
+                    # Nothing in the image would run these.
+                    ('--metrics', args.metrics),
+                    ('--bench', args.bench)):
+                if value:
+                    usage("--container can't be combined with %s" % option,
+                          rc=1)
+            if args.blobs not in (None, ZEO_DEFAULT_BLOB_DIR):
+                usage("--container keeps blobs in a volume", rc=1)
+            port = str(address).rpartition(':')[2]
+            if (is_socket_path(address) or not port.isdigit()
+                    or not int(port)):
+                usage("--container needs a TCP port", rc=1)
+            if args.tls is not None and not os.getuid():
+                # The server doesn't run as root in the container, so it
+                # couldn't read keys only root may read.
+                usage("--container can't use TLS keys created by root",
+                      rc=1)
+
+        relocatable = getattr(args, 'relocatable', False)
+        if relocatable:
+            for option, value in (
+                    ('--storage-dir', args.storage_dir),
+                    ('--blob-mounts', args.blob_mounts),
+                    ('--service', args.service),
+                    ('--pack', args.pack is not None),
+                    ('--fast-scripts', args.fast_scripts),
+                    # These write etc/zeoclient.conf, with absolute paths.
+                    ('--shared-blobs', args.shared_blobs),
+                    ('--client-config', args.client_config),
+                    ('--client-var', args.client_var),
+                    ('--tls', args.tls is not None)):
+                if value:
+                    usage("--relocatable can't be combined with %s"
+                          % option, rc=1)
+            if args.blobs and os.path.isabs(args.blobs) and not (
+                    args.blobs.startswith(instance_home + os.sep)):
+                usage("--relocatable keeps blobs in the instance home",
+                      rc=1)
+
+        blob_mounts = None
+        if args.blob_mounts:
+            blob_mounts = [os.path.abspath(path)
+                           for path in args.blob_mounts.split(',') if path]
+
+        blob_dir = args.blobs if args.blobs else None
+        if blob_dir is None and (blob_mounts or args.blob_layout
+                                 or args.shared_blobs):
+            blob_dir = ZEO_DEFAULT_BLOB_DIR
+
+        profile = args.profile
+        if args.probe:
+            paths = [os.path.join(instance_home, 'var')]
+            paths.extend(storage_dirs.values())
+            if blob_dir and not blob_dir.startswith('$INSTANCE'):
+                paths.append(os.path.abspath(blob_dir))
+            paths.extend(blob_mounts or ())
+            profile = self.probe(paths, profile, instance_home, usage=usage,
+                                 probed=probed)
+
+        home = instance_home
+        if container:
+            # Render the instance for its place in the container.
+            if profile == 'auto':
+                profile = get_profile('auto', instance_home)
+            if tls == ZEO_DEFAULT_TLS_DIR:
+                tls = os.path.join(instance_home, 'etc', 'ssl')
+            if blob_dir:
+                blob_dir = CONTAINER_BLOB_DIR
+            container = args.addr_string
+            address = int(port)
+            home = CONTAINER_ROOT + '/' + container_service_name(
+                instance_home)
+            zodb_home = ''
+            zdaemon_home = CONTAINER_SITE_PACKAGES
+
+        params = self.get_params(
+            zodb_home, zdaemon_home, home, address, blob_dir,
+            profile=profile, storages=storages,
+            storage_dirs=storage_dirs, bench=args.bench,
+            metrics=args.metrics, blob_layout=args.blob_layout,
+            blob_mounts=blob_mounts, shared_blobs=args.shared_blobs,
+            client_config=args.client_config or bool(args.client_var),
+            client_var=(os.path.abspath(args.client_var)
+                        if args.client_var else None),
+            storage_type=args.storage_type, compress=args.compress,
+            pack=args.pack, pack_window=args.pack_window,
+            index=args.index, warm=warm, service=args.service,
+            cpu_block=cpu_block, fast_scripts=args.fast_scripts,
+            reconcile=args.reconcile, dry_run=args.dry_run,
+            fsync=args.fsync, tls=tls, log_level=args.log_level,
+            log_rotate=args.log_rotate, log_keep=args.log_keep,
+            log_json=args.log_json, log_queue=args.log_queue,
+            replicate_to=getattr(args, 'replicate_to', None),
+            replicate_from=getattr(args, 'replicate_from', None),
+            read_only=getattr(args, 'read_only', False),
+            container=container or None, relocatable=relocatable)
+        return instance_home, params
 
     def run(self, argv,
             usage=usage,  # testing hook
             ):
+        import argparse
 
         parser = argparse.ArgumentParser(add_help=False)
         parser.add_argument('instance_home', nargs='?', default=None)
@@ -199,6 +3066,44 @@ class ZEOInstanceBuilder:
         parser.add_argument('-h', '--help', action='store_true')
         parser.add_argument('-b', '--blobs', required=False, default=None,
                             const=ZEO_DEFAULT_BLOB_DIR, nargs='?')
+        parser.add_argument('-p', '--profile', default=None)
+        parser.add_argument('-s', '--storages', default=None)
+        parser.add_argument('--storage-dir', action='append', default=[])
+        parser.add_argument('-t', '--storage-type', default='filestorage')
+        parser.add_argument('-z', '--compress', default=None, const='zlib',
+                            nargs='?')
+        parser.add_argument('-m', '--manifest', default=None)
+        parser.add_argument('-j', '--jobs', type=int, default=None)
+        parser.add_argument('-n', '--instances', type=int, default=None)
+        parser.add_argument('--blob-layout', default=None)
+        parser.add_argument('--blob-mounts', default=None)
+        parser.add_argument('--shared-blobs', action='store_true')
+        parser.add_argument('--client-config', action='store_true')
+        parser.add_argument('--client-var', default=None)
+        parser.add_argument('--bench', action='store_true')
+        parser.add_argument('--metrics', default=None,
+                            const=ZEO_DEFAULT_METRICS_ADDRESS, nargs='?')
+        parser.add_argument('--pack', type=int, default=None,
+                            const=ZEO_DEFAULT_PACK_DAYS, nargs='?')
+        parser.add_argument('--pack-window', default=None)
+        parser.add_argument('--index', action='store_true')
+        parser.add_argument('--warm', default=None)
+        parser.add_argument('--service', default=None)
+        parser.add_argument('--fast-scripts', action='store_true')
+        parser.add_argument('--reconcile', action='store_true')
+        parser.add_argument('--dry-run', action='store_true')
+        parser.add_argument('--fsync', action='store_true')
+        parser.add_argument('--tls', default=None,
+                            const=ZEO_DEFAULT_TLS_DIR, nargs='?')
+        parser.add_argument('--log-level', default=None)
+        parser.add_argument('--log-rotate', default=None)
+        parser.add_argument('--log-keep', type=int, default=None)
+        parser.add_argument('--log-json', action='store_true')
+        parser.add_argument('--log-queue', action='store_true')
+        parser.add_argument('--probe', action='store_true')
+        parser.add_argument('--secondaries', type=int, default=None)
+        parser.add_argument('--container', action='store_true')
+        parser.add_argument('--relocatable', action='store_true')
 
         parsed_args, unknown_args = parser.parse_known_args(argv)
 
@@ -207,29 +3112,469 @@ class ZEOInstanceBuilder:
 
         if parsed_args.help:
             usage(rc=2)
+        elif parsed_args.manifest is not None:
+            if parsed_args.instance_home is not None:
+                usage("A manifest can't be combined with an instance home",
+                      rc=1)
         elif parsed_args.instance_home is None:
             usage(rc=1)
 
-        instance_home = os.path.abspath(parsed_args.instance_home)
+        zodb_home = package_home('ZODB')
+        zdaemon_home = package_home('zdaemon')
 
-        zodb_home = os.path.split(ZODB.__path__[0])[0]
-        zdaemon_home = os.path.split(zdaemon.__path__[0])[0]
+        if parsed_args.secondaries is not None:
+            if parsed_args.manifest is not None:
+                usage("--secondaries can't be combined with --manifest",
+                      rc=1)
+            if parsed_args.instances is not None:
+                usage("--secondaries can't be combined with --instances",
+                      rc=1)
+            if parsed_args.secondaries < 1:
+                usage("--secondaries must be at least 1", rc=1)
+            return self.run_replicated(
+                parsed_args, parsed_args.secondaries, zodb_home,
+                zdaemon_home, usage=usage)
 
-        addr_string = parsed_args.addr_string
+        if parsed_args.instances is not None:
+            if parsed_args.manifest is not None or parsed_args.instances < 1:
+                usage(rc=1)
+            return self.run_instances(
+                parsed_args, parsed_args.instances, zodb_home, zdaemon_home,
+                usage=usage)
 
-        if ':' in addr_string:
-            host, port = addr_string.split(':', 1)
-            address = host + ':' + port
-        elif addr_string.isdigit():
-            address = int(addr_string)
+        if parsed_args.manifest is not None:
+            return self.run_manifest(
+                parsed_args.manifest, zodb_home, zdaemon_home,
+                jobs=parsed_args.jobs, usage=usage,
+                reconcile=parsed_args.reconcile, dry_run=parsed_args.dry_run)
+
+        instance_home, params = self.get_args_params(
+            parsed_args, zodb_home, zdaemon_home, usage=usage)
+        self.create(instance_home, params)
+
+    def run_instances(self, args, count, zodb_home, zdaemon_home,
+                      usage=usage,  # testing hook
+                      ):
+        """Create count sibling instances below args.instance_home.
+
+        Each sibling gets its own server process, storage and port, and
+        a client configuration listing all of them is written next to
+        them.
+        """
+        import argparse
+
+        if is_socket_path(args.addr_string):
+            usage("Sibling instances need a TCP port", rc=1)
+        host, sep, port = args.addr_string.rpartition(':')
+        if not port.isdigit():
+            usage(rc=1)
+        try:
+            ports = allocate_ports(host, int(port), count)
+        except (OSError, ValueError) as e:
+            usage("Can't allocate ports: %s" % e, rc=1)
+
+        home = os.path.abspath(args.instance_home)
+        profile = args.profile
+        if profile == 'auto':
+            # Detect once, not once per sibling.
+            profile = get_profile('auto', home)
+        siblings = []
+        for i, port in enumerate(ports):
+            sibling = argparse.Namespace(**vars(args))
+            sibling.instance_home = os.path.join(home, 'zeo%d' % (i + 1))
+            sibling.addr_string = '%s%s%d' % (host, sep, port)
+            sibling.profile = profile
+            siblings.append(sibling)
+        self.spread_metrics(siblings, usage=usage)
+        # Probe each filesystem once, not once per sibling.
+        probed = {}
+        instances = [self.get_args_params(sibling, zodb_home, zdaemon_home,
+                                          usage=usage, cpu_block=i,
+                                          probed=probed)
+                     for i, sibling in enumerate(siblings)]
+
+        for instance_home, params in instances:
+            self.create(instance_home, params)
+
+        if args.reconcile or args.dry_run:
+            files = Reconciler(None, dry_run=args.dry_run, fsync=args.fsync)
         else:
+            files = InstanceFiles(fsync=args.fsync)
+        files.makefile(ZEOCLIENT_CONF_TEMPLATE, home, 'zeoclient.conf',
+                       description='the ZEO servers in %s' % home,
+                       clients=self.render_clients(
+                           [params for instance_home, params in instances]))
+        if args.container:
+            files.makefile(COMPOSE_TEMPLATE, home, 'compose.yaml',
+                           description='the ZEO servers in %s' % home,
+                           **self.render_compose(home, instances))
+        files.close({})
+
+    def run_replicated(self, args, count, zodb_home, zdaemon_home,
+                       usage=usage,  # testing hook
+                       ):
+        """Create a primary and count secondaries below args.instance_home.
+
+        The primary's storages are zc.zrs primary storages, which the
+        secondaries replicate and serve read-only, each from its own
+        server process.  The primary's ZEO port comes first, followed by
+        a replication port per storage and the secondaries' ZEO ports.
+        A client configuration sending read-write connections to the
+        primary and read-only ones to the secondaries is written next to
+        them.
+        """
+        import argparse
+
+        if is_socket_path(args.addr_string):
+            usage("Replication needs a TCP port", rc=1)
+        if args.storage_type != 'filestorage' or args.compress:
+            usage("Replication needs file storages", rc=1)
+        if args.storage_dir or (
+                args.blobs and args.blobs != ZEO_DEFAULT_BLOB_DIR):
+            usage("Replicated instances keep their storages in their homes",
+                  rc=1)
+        storages = self.parse_storages(args.storages, usage=usage) or ['1']
+        host, sep, port = args.addr_string.rpartition(':')
+        if not port.isdigit():
             usage(rc=1)
+        try:
+            ports = allocate_ports(host, int(port), 1 + len(storages) + count)
+        except (OSError, ValueError) as e:
+            usage("Can't allocate ports: %s" % e, rc=1)
 
-        blob_dir = parsed_args.blobs if parsed_args.blobs else None
+        home = os.path.abspath(args.instance_home)
+        profile = args.profile
+        if profile == 'auto':
+            profile = get_profile('auto', home)
+        replication = dict(zip(storages, ports[1:1 + len(storages)]))
+        source = connect_address(host + sep + '0')[0]
+        if ':' in source:
+            source = '[%s]' % source
+        listen = host + sep
+        if args.container:
+            # Replicate over the compose network.
+            source = container_service_name('primary')
+            listen = ''
+        replicas = []
+        for i, port in enumerate([ports[0]] + ports[1 + len(storages):]):
+            instance = argparse.Namespace(**vars(args))
+            instance.addr_string = '%s%s%d' % (host, sep, port)
+            instance.profile = profile
+            if args.tls == ZEO_DEFAULT_TLS_DIR:
+                # One CA for all, so clients can connect to any of them.
+                instance.tls = os.path.join(home, 'ssl')
+            if i:
+                instance.instance_home = os.path.join(
+                    home, 'secondary%d' % i)
+                instance.replicate_from = {
+                    name: '%s:%d' % (source, replication_port)
+                    for name, replication_port in replication.items()}
+                instance.read_only = True
+            else:
+                instance.instance_home = os.path.join(home, 'primary')
+                instance.replicate_to = {
+                    name: '%s%d' % (listen, replication_port)
+                    for name, replication_port in replication.items()}
+            replicas.append(instance)
+        self.spread_metrics(replicas, usage=usage)
+        probed = {}
+        instances = [self.get_args_params(instance, zodb_home, zdaemon_home,
+                                          usage=usage, cpu_block=i,
+                                          probed=probed)
+                     for i, instance in enumerate(replicas)]
 
-        params = self.get_params(
-            zodb_home, zdaemon_home, instance_home, address, blob_dir)
-        self.create(instance_home, params)
+        for instance_home, params in instances:
+            self.create(instance_home, params)
+
+        if args.reconcile or args.dry_run:
+            files = Reconciler(None, dry_run=args.dry_run, fsync=args.fsync)
+        else:
+            files = InstanceFiles(fsync=args.fsync)
+        files.makefile(ZEOCLIENT_CONF_TEMPLATE, home, 'zeoclient.conf',
+                       description='the replicated ZEO servers in %s' % home,
+                       clients=self.render_clients(
+                           [instances[0][1]],
+                           [params for instance_home, params
+                            in instances[1:]]))
+        if args.container:
+            files.makefile(COMPOSE_TEMPLATE, home, 'compose.yaml',
+                           description='the replicated ZEO servers in %s'
+                           % home, **self.render_compose(home, instances))
+        files.close({})
+
+    def spread_metrics(self, instances,
+                       usage=usage,  # testing hook
+                       ):
+        """Give instances sharing a --metrics address ports of their own.
+
+        They get the free ports from the shared one on, so that their
+        bin/zeometrics can all run on this host.
+        """
+        shared = {}
+        for instance in instances:
+            if instance.metrics:
+                shared.setdefault(instance.metrics, []).append(instance)
+        for metrics, group in shared.items():
+            host, sep, port = metrics.rpartition(':')
+            if len(group) < 2 or not port.isdigit():
+                continue
+            try:
+                ports = allocate_ports(host, int(port), len(group))
+            except (OSError, ValueError) as e:
+                usage("Can't allocate metrics ports: %s" % e, rc=1)
+            for instance, port in zip(group, ports):
+                instance.metrics = '%s%s%d' % (host, sep, port)
+
+    def render_clients(self, instances, secondaries=()):
+        """Render <zodb> client sections for the storages of instances.
+
+        With secondaries, a read-only section per storage lists all of
+        them; the client uses whichever server answers first.
+        """
+        sections = []
+        imports = ''
+        groups = [(params, [params], os.path.basename(params['instance_home']))
+                  for params in instances]
+        if secondaries:
+            groups.append((secondaries[0], secondaries, 'secondaries'))
+        for params, servers, name in groups:
+            server = '\n    server '.join(
+                self.render_server(server['address']) for server in servers)
+            for storage in params['storage_list']:
+                settings = []
+                if params.get('client_cache'):
+                    settings = params['client_cache'][storage['name']]
+                if params.get('shared_blobs') and storage['blob_dir']:
+                    # Read blobs straight from the server's directory
+                    # instead of streaming them over the connection.
+                    settings = [(key, value) for key, value in settings
+                                if not key.startswith('blob-')]
+                    settings.append(('blob-dir', storage['blob_dir'].replace(
+                        '$INSTANCE', params['instance_home'])))
+                    settings.append(('shared-blob-dir', 'true'))
+                section = 'zeoclient'
+                comment = 'client name'
+                if params.get('tls'):
+                    # Only ZEO's clientstorage section takes <ssl>; it
+                    # names the persistent cache file directly.
+                    section = 'clientstorage'
+                    comment = 'cache-path'
+                    imports = '%import ZEO\n\n'
+                    settings = dict(settings)
+                    client = settings.pop('client', None)
+                    var = settings.pop('var', None)
+                    settings = list(settings.items())
+                    if client:
+                        settings.insert(1, ('cache-path', os.path.join(
+                            var, '%s-%s.zec' % (client, storage['name']))))
+                options = ''.join('    %s %s\n' % setting
+                                  for setting in settings)
+                if params.get('tls'):
+                    options += ZEOCLIENT_SSL_TEMPLATE % {
+                        'tls': params['tls'].replace(
+                            '$INSTANCE', params['instance_home'])}
+                if params.get('client_cache'):
+                    options = ('    # Give every application process its'
+                               ' own %s.\n' % comment + options)
+                if params.get('read_only') == 'true':
+                    options += '    read-only true\n'
+                sections.append(ZEOCLIENT_TEMPLATE % {
+                    'name': (name if len(params['storage_list']) == 1
+                             else '%s-%s' % (name, storage['name'])),
+                    'type': section,
+                    'server': server,
+                    'storage': storage['name'],
+                    'options': options,
+                })
+        return imports + '\n'.join(sections)
+
+    def render_server(self, address):
+        """Render the server line clients use to reach address."""
+        address = connect_address(address)
+        if is_socket_path(address):
+            return address
+        host, port = address
+        return '%s:%s' % (host if ':' not in host else '[%s]' % host, port)
+
+    def read_manifest(self, path,
+                      usage=usage,  # testing hook
+                      ):
+        """Read a fleet manifest, returning one argument set per instance.
+
+        Relative homes and directories are taken relative to the
+        manifest.  Values in the optional ``[defaults]`` table apply to
+        every ``[[instance]]``.
+        """
+        import argparse
+
+        try:
+            import tomllib
+        except ImportError:  # pragma: nocover  Python < 3.11
+            try:
+                import tomli as tomllib
+            except ImportError:
+                usage("Reading manifests requires Python 3.11 or tomli",
+                      rc=1)
+        try:
+            with open(path, 'rb') as f:
+                manifest = tomllib.load(f)
+        except (OSError, ValueError) as e:
+            usage("Can't read manifest %s: %s" % (path, e), rc=1)
+
+        here = os.path.dirname(os.path.abspath(path))
+        defaults = manifest.get('defaults', {})
+        entries = []
+        for instance in manifest.get('instance', ()):
+            entry = dict(defaults, **instance)
+            unknown = set(entry) - set(MANIFEST_KEYS)
+            if unknown:
+                usage("Unknown manifest keys: %s"
+                      % ', '.join(sorted(unknown)), rc=1)
+            if 'home' not in entry:
+                usage("Manifest instance without home", rc=1)
+            blobs = entry.get('blobs')
+            if blobs is True:
+                blobs = ZEO_DEFAULT_BLOB_DIR
+            elif blobs:
+                blobs = os.path.join(here, blobs)
+            pack = entry.get('pack')
+            if pack is True:
+                pack = ZEO_DEFAULT_PACK_DAYS
+            elif pack is False:
+                pack = None
+            storages = entry.get('storages')
+            if isinstance(storages, list):
+                storages = ','.join(storages)
+            entries.append(argparse.Namespace(
+                instance_home=os.path.join(here, entry['home']),
+                addr_string=str(entry.get('address', '9999')),
+                blobs=blobs or None,
+                profile=entry.get('profile'),
+                storages=str(storages) if storages else None,
+                storage_dir=[
+                    '%s=%s' % (name, os.path.join(here, storage_dir))
+                    for name, storage_dir
+                    in entry.get('storage-dir', {}).items()],
+                bench=bool(entry.get('bench')),
+                metrics=(ZEO_DEFAULT_METRICS_ADDRESS
+                         if entry.get('metrics') is True
+                         else entry.get('metrics') or None),
+                blob_layout=entry.get('blob-layout'),
+                blob_mounts=','.join(
+                    os.path.join(here, path)
+                    for path in entry.get('blob-mounts', ())) or None,
+                shared_blobs=bool(entry.get('shared-blobs')),
+                client_config=bool(entry.get('client-config')),
+                client_var=(os.path.join(here, entry['client-var'])
+                            if entry.get('client-var') else None),
+                storage_type=entry.get('storage-type', 'filestorage'),
+                compress=('zlib' if entry.get('compress') is True
+                          else entry.get('compress') or None),
+                pack=pack,
+                pack_window=entry.get('pack-window'),
+                index=bool(entry.get('index')),
+                warm=(str(entry['warm']) if entry.get('warm') else None),
+                service=entry.get('service'),
+                fast_scripts=bool(entry.get('fast-scripts')),
+                reconcile=bool(entry.get('reconcile')),
+                dry_run=False,
+                fsync=bool(entry.get('fsync')),
+                tls=(ZEO_DEFAULT_TLS_DIR if entry.get('tls') is True
+                     else os.path.join(here, entry['tls'])
+                     if entry.get('tls') else None),
+                log_level=entry.get('log-level'),
+                log_rotate=(str(entry['log-rotate'])
+                            if entry.get('log-rotate') else None),
+                log_keep=entry.get('log-keep'),
+                log_json=bool(entry.get('log-json')),
+                log_queue=bool(entry.get('log-queue')),
+                probe=bool(entry.get('probe')),
+                container=bool(entry.get('container')),
+                relocatable=bool(entry.get('relocatable')),
+            ))
+
+        if not entries:
+            usage("No instances in manifest %s" % path, rc=1)
+        homes = [os.path.abspath(entry.instance_home) for entry in entries]
+        if len(set(homes)) != len(homes):
+            usage("Duplicate instance homes in manifest %s" % path, rc=1)
+        addresses = [entry.addr_string for entry in entries]
+        if len(set(addresses)) != len(addresses):
+            usage("Duplicate addresses in manifest %s" % path, rc=1)
+        self.spread_metrics(entries, usage=usage)
+        return entries
+
+    def run_manifest(self, path, zodb_home, zdaemon_home, jobs=None,
+                     usage=usage,  # testing hook
+                     reconcile=False, dry_run=False,
+                     ):
+        """Create every instance listed in a manifest, in parallel.
+
+        Profiles are resolved, and filesystems probed, once and shared
+        by the instances using them.  Returns the number of instances
+        that failed.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        entries = self.read_manifest(path, usage=usage)
+        for entry in entries:
+            entry.reconcile = entry.reconcile or reconcile
+            entry.dry_run = dry_run
+
+        profiles = {}
+        for entry in entries:
+            if entry.profile is not None:
+                if entry.profile not in profiles:
+                    if entry.profile in PROFILES or entry.profile == 'auto':
+                        profiles[entry.profile] = get_profile(
+                            entry.profile,
+                            os.path.abspath(entry.instance_home))
+                    else:
+                        usage("Unknown profile: %s" % entry.profile, rc=1)
+                entry.profile = profiles[entry.profile]
+
+        probed = {}
+        instances = [
+            self.get_args_params(entry, zodb_home, zdaemon_home, usage=usage,
+                                 probed=probed)
+            for entry in entries]
+
+        # Reading the umask changes it for a moment, which the workers
+        # would see, so it's read once, here.
+        umask = get_umask()
+
+        def create(instance):
+            home, params = instance
+            start = time.time()
+            self.create(home, params, umask=umask)
+            return time.time() - start
+
+        failed = 0
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [(home, executor.submit(create, (home, params)))
+                       for home, params in instances]
+            for home, future in futures:
+                try:
+                    elapsed = future.result()
+                except Exception as e:
+                    failed += 1
+                    print_("Failed to create instance %s: %s", home, e)
+                else:
+                    print_("Created instance %s in %.3fs", home, elapsed)
+        print_("Created %d of %d instances in %.3fs",
+               len(instances) - failed, len(instances), time.time() - start)
+        return failed
+
+
+def complete_params(params):
+    """Return params with what the templates need filled in.
+
+    The templates have gained placeholders; tools that format them with
+    the values the templates took before, like ZRS, can pass those
+    through this first.
+    """
+    return ZEOInstanceBuilder().complete_params(params)
 
 
 def makedir(*args):
@@ -246,38 +3591,451 @@ def mkdirs(path):
     head, tail = os.path.split(path)
     if head and tail and not os.path.isdir(head):
         mkdirs(head)
-    os.mkdir(path)
+    try:
+        os.mkdir(path)
+    except FileExistsError:
+        # Created concurrently, e.g. a shared parent in a fleet build.
+        if not os.path.isdir(path):
+            raise
+        return
     print_("Created directory %s", path)
 
 
 def makefile(template, *args, **kwds):
+    return _makefile(0o666, template, args, kwds)
+
+
+def makexfile(template, *args, **kwds):
+    return _makefile(0o777, template, args, kwds)
+
+
+def _makefile(mode, template, args, kwds):
     path = makedir(*args[:-1])
     path = os.path.join(path, args[-1])
-    data = template % kwds
+    putfile(path, template % kwds, mode)
+    return path
+
+
+def putfile(path, data, mode=0o666, umask=None):
+    """Write data to a new file at path, with mode less the umask.
+
+    An existing file is kept; a warning is printed if it differs from
+    data.  Returns whether the file was written.  umask defaults to the
+    process's.
+    """
+    if umask is None:
+        umask = get_umask()
     if os.path.exists(path):
         with open(path) as f:
             olddata = f.read().strip()
         if olddata:
             if olddata != data.strip():
                 print_("Warning: not overwriting existing file %s", path)
-            return path
-    with open(path, "w") as f:
-        f.write(data)
+            if mode & 0o111:
+                makexmode(path, umask=umask)
+            return False
+    writefile(path, data, mode, umask)
     print_("Wrote file %s", path)
-    return path
+    if mode & 0o111:
+        # The mode was set before the file was moved into place; it is
+        # reported as it always was.
+        print_("Changed mode for %s to %o", path, mode & ~umask)
+    return True
 
 
-def makexfile(template, *args, **kwds):
-    path = makefile(template, *args, **kwds)
+def get_umask():
     umask = os.umask(0o022)
     os.umask(umask)
+    return umask
+
+
+def writefile(path, data, mode=0o666, umask=None):
+    """Replace the file at path with one containing data, atomically.
+
+    The data goes to a temporary file next to path, which is flushed to
+    disk and given mode (less umask, by default the process's) before it
+    is renamed to path.
+    Readers, and a crash, see either the old file or the complete new
+    one, never a truncated or not yet executable file.  If path is a
+    symlink, the file it points to is replaced and the link kept.
+    """
+    import tempfile
+
+    # Replace what a symlink points to, not the link itself.
+    directory, name = os.path.split(os.path.realpath(path))
+    fd, temp_path = tempfile.mkstemp(
+        prefix='.%s.' % name, suffix='.tmp', dir=directory or '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if umask is None:
+            umask = get_umask()
+        os.chmod(temp_path, mode & ~umask)
+        os.replace(temp_path, os.path.join(directory, name))
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def fsync_dir(path):
+    """Flush a directory's entries, e.g. renamed files, to disk."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass  # Not supported for directories everywhere.
+    finally:
+        os.close(fd)
+
+
+class HomeLock:
+    """An exclusive lock on an instance home, see lock_home."""
+
+    def __init__(self, path, f):
+        self.path = path
+        self.file = f
+
+    def close(self):
+        """Release the lock and remove the lock file."""
+        try:
+            # Still holding the lock, so nobody can be using the file.
+            os.remove(self.path)
+        except OSError:
+            pass
+        self.file.close()
+
+
+def lock_home(home):
+    """Lock the instance at home against concurrent creators.
+
+    Blocks until another process (or thread) creating the same instance
+    is done.  Returns a HomeLock; closing it releases the lock and
+    removes the lock file, so it isn't left in the instance.  Where
+    fcntl isn't available, nothing is locked.
+    """
+    path = os.path.join(makedir(home, 'etc'), LOCK_FILE)
+    try:
+        import fcntl
+    except ImportError:  # pragma: nocover
+        return HomeLock(path, open(path, 'a'))
+    while True:
+        f = open(path, 'a')
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        # The previous holder may have removed the file while we waited,
+        # and a lock on a removed file excludes nobody.
+        try:
+            if os.stat(path).st_ino == os.fstat(f.fileno()).st_ino:
+                return HomeLock(path, f)
+        except FileNotFoundError:
+            pass
+        f.close()
+
+
+def makexmode(path, dry_run=False, umask=None):
+    if umask is None:
+        umask = get_umask()
     mode = 0o0777 & ~umask
     if stat.S_IMODE(os.stat(path)[stat.ST_MODE]) != mode:
+        if dry_run:
+            print_("Would change mode for %s to %o", path, mode)
+            return
         os.chmod(path, mode)
         print_("Changed mode for %s to %o", path, mode)
-    return path
+
+
+class InstanceFiles:
+    """Create the directories and files of an instance.
+
+    Existing files are never overwritten; a warning is printed if they
+    differ from what would have been written.  With fsync, the
+    directories the files were written to are flushed to disk on close.
+    Files get their mode less umask, by default the process's.
+    """
+
+    def __init__(self, fsync=False, umask=None):
+        self.fsync = fsync
+        self.umask = umask
+        self.directories = set()
+
+    def makedir(self, *args):
+        return makedir(*args)
+
+    def makefile(self, template, *args, **kwds):
+        path = os.path.join(self.makedir(*args[:-1]), args[-1])
+        self.putfile(path, template % kwds)
+        return path
+
+    def makexfile(self, template, *args, **kwds):
+        path = os.path.join(self.makedir(*args[:-1]), args[-1])
+        self.putfile(path, template % kwds, 0o777)
+        return path
+
+    def putfile(self, path, data, mode=0o666):
+        putfile(path, data, mode, self.umask)
+        self.directories.add(os.path.dirname(path))
+
+    def close(self, params):
+        if self.fsync:
+            for path in sorted(self.directories, reverse=True):
+                fsync_dir(path)
+
+
+class Reconciler(InstanceFiles):
+    """Bring the directories and files of an instance up to date.
+
+    Files whose content differs from what the templates produce are
+    rewritten.  The content hash, size and modification time of every
+    file written are recorded in a manifest, so that files that are
+    still up to date are skipped on the next run without reading them.
+    With dry_run, nothing is changed; the differences are printed as
+    unified diffs instead.
+    """
+
+    def __init__(self, manifest, dry_run=False, fsync=False, umask=None):
+        import json
+
+        super().__init__(fsync, umask)
+        self.manifest = manifest
+        self.dry_run = dry_run
+        self.old = {}
+        self.files = {}
+        self.dirs = set()
+        if manifest and os.path.exists(manifest):
+            try:
+                with open(manifest) as f:
+                    self.old = json.load(f).get('files', {})
+            except (OSError, ValueError):
+                print_("Warning: ignoring unreadable manifest %s", manifest)
+
+    def makedir(self, *args):
+        if not self.dry_run:
+            return makedir(*args)
+        path = os.path.join(*args)
+        if not os.path.isdir(path) and path not in self.dirs:
+            self.dirs.add(path)
+            print_("Would create directory %s", path)
+        return path
+
+    def putfile(self, path, data, mode=0o666):
+        self.reconcile(path, data, mode)
+        if mode & 0o111 and os.path.exists(path):
+            makexmode(path, self.dry_run, self.umask)
+
+    def reconcile(self, path, data, mode):
+        import hashlib
+
+        digest = hashlib.sha256(data.encode('utf-8')).hexdigest()
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        if (st is not None and self.old.get(path)
+                == [digest, st.st_size, st.st_mtime_ns]):
+            self.files[path] = self.old[path]
+            return
+
+        olddata = None
+        if st is not None:
+            with open(path) as f:
+                olddata = f.read()
+        if olddata != data:
+            if self.dry_run:
+                import difflib
+                sys.stdout.writelines(difflib.unified_diff(
+                    (olddata or '').splitlines(True),
+                    data.splitlines(True),
+                    path if olddata is not None else '/dev/null', path))
+                self.files[path] = [digest, None, None]
+                return
+            writefile(path, data, mode, self.umask)
+            self.directories.add(os.path.dirname(path))
+            if olddata is None:
+                print_("Wrote file %s", path)
+            else:
+                print_("Updated file %s", path)
+            st = os.stat(path)
+        self.files[path] = [digest, st.st_size, st.st_mtime_ns]
+
+    def close(self, params):
+        """Record the files written, and report files no longer written."""
+        import json
+
+        for path in sorted(set(self.old) - set(self.files)):
+            print_("Warning: %s is no longer generated", path)
+        if self.dry_run:
+            return
+        if not self.manifest:
+            super().close(params)
+            return
+        data = json.dumps({
+            'params': {key: value for key, value in params.items()
+                       if key not in ('reconcile', 'dry_run')},
+            'files': self.files,
+        }, indent=1, sort_keys=True, default=repr) + '\n'
+        if os.path.exists(self.manifest):
+            with open(self.manifest) as f:
+                if f.read() == data:
+                    data = None
+        if data is not None:
+            writefile(self.manifest, data, umask=self.umask)
+            self.directories.add(os.path.dirname(self.manifest))
+        super().close(params)
+
+
+class InstanceModel:
+    """The directories and files of an instance, rendered in memory.
+
+    directories lists the directories to create, in order; files maps
+    the path of every file to its content and mode (before the umask).
+    Rendering one neither touches the filesystem nor prints anything;
+    write() creates it, with an InstanceFiles or Reconciler.
+    """
+
+    def __init__(self, home, directories=None, files=None):
+        self.home = home
+        self.directories = directories if directories is not None else []
+        self.files = files if files is not None else {}
+
+    def __repr__(self):
+        return '%s(%r, directories=%r, files=%r)' % (
+            self.__class__.__name__, self.home, self.directories, self.files)
+
+    def __eq__(self, other):
+        if not isinstance(other, InstanceModel):
+            return NotImplemented
+        return ((self.home, self.directories, self.files)
+                == (other.home, other.directories, other.files))
+
+    def makedir(self, *args):
+        path = os.path.join(*args)
+        if path not in self.directories:
+            self.directories.append(path)
+        return path
+
+    def makefile(self, template, *args, **kwds):
+        path = os.path.join(self.makedir(*args[:-1]), args[-1])
+        self.putfile(path, template % kwds)
+        return path
+
+    def makexfile(self, template, *args, **kwds):
+        path = os.path.join(self.makedir(*args[:-1]), args[-1])
+        self.putfile(path, template % kwds, 0o777)
+        return path
+
+    def putfile(self, path, data, mode=0o666):
+        self.files[path] = (data, mode)
+
+    def close(self, params):
+        pass
+
+    def write(self, files=None, params=None):
+        """Create the directories and files, by default as create() does."""
+        if files is None:
+            files = InstanceFiles()
+        for path in self.directories:
+            files.makedir(path)
+        for path, (data, mode) in self.files.items():
+            files.putfile(path, data, mode)
+        files.close(params or {})
+
+
+def json_log_formatter(fmt=None, datefmt=None, style='%'):
+    """Return a log formatter writing each record as a line of JSON.
+
+    The objects hold the time (with milliseconds), level, logger name
+    and message of the record, and its traceback, if any.  --log-json
+    names this as the formatter of the server's <logfile>; fmt is
+    ignored.
+    """
+    import json
+    import logging
+
+    class JSONFormatter(logging.Formatter):
+
+        def format(self, record):
+            entry = {
+                'time': '%s.%03d' % (self.formatTime(record, self.datefmt),
+                                     record.msecs),
+                'level': record.levelname,
+                'logger': record.name,
+                'message': record.getMessage(),
+            }
+            if record.exc_info and not record.exc_text:
+                record.exc_text = self.formatException(record.exc_info)
+            if record.exc_text:
+                entry['exception'] = record.exc_text
+            return json.dumps(entry)
+
+    return JSONFormatter(None, datefmt)
+
+
+def queue_log_handlers(logger):
+    """Move the handlers of logger behind a queue.
+
+    Records are put on a queue by a QueueHandler and written by the
+    original handlers in a QueueListener thread, so the threads logging
+    them never wait for the disk.  Returns the started listener, or
+    None if logger has no handlers.
+    """
+    import logging.handlers
+    import queue
+
+    handlers = logger.handlers[:]
+    if not handlers:
+        return None
+    records = queue.SimpleQueue()
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    listener = logging.handlers.QueueListener(
+        records, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def runzeo(args=None):
+    """Run a ZEO server as ZEO.runzeo does, logging through a queue.
+
+    bin/runzeo uses this with --log-queue.  Log files are still reopened
+    on SIGUSR2.
+    """
+    import logging
+
+    from ZEO.runzeo import ZEOOptions
+    from ZEO.runzeo import ZEOServer
+
+    class QueueLoggingZEOServer(ZEOServer):
+
+        def handle_sigusr2(self):
+            if listener is None:
+                return ZEOServer.handle_sigusr2(self)
+            # ZEO reopens the root logger's handlers, which is just the
+            # QueueHandler now; reopen the files behind it instead.
+            for handler in listener.handlers:
+                if callable(getattr(handler, 'reopen', None)):
+                    handler.reopen()
+            logging.getLogger('ZEO.runzeo').info(
+                "Log files reopened successfully")
+
+    options = ZEOOptions()
+    options.realize(args)
+    listener = queue_log_handlers(logging.getLogger())
+    try:
+        QueueLoggingZEOServer(options).main()
+    finally:
+        if listener is not None:
+            listener.stop()
 
 
 def main():  # pragma: nocover
-    ZEOInstanceBuilder().run(sys.argv[1:])
+    if ZEOInstanceBuilder().run(sys.argv[1:]):
+        sys.exit(1)
     print_("All done.")
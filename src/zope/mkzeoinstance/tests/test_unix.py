@@ -12,6 +12,7 @@
 #
 ##############################################################################
 
+import shutil
 import unittest
 
 
@@ -144,8 +145,67 @@ class ZEOInstanceBuilderTests(_WithTempdir, unittest.TestCase):
                            'zdaemon_home': '',
                            'instance_home': '',
                            'address': '',
+                           'read_only': 'false',
                            'zodb_home': '',
-                           'blob_dir': ''
+                           'blob_dir': '',
+                           'profile': None,
+                           'invalidation_queue_size': 100,
+                           'invalidation_age': '',
+                           'transaction_timeout':
+                               '# transaction-timeout SECONDS',
+                           'client_cache_hint': '',
+                           'storage_list': [{'name': '1',
+                                             'type': 'filestorage',
+                                             'compress': None,
+                                             'var': '$INSTANCE/var',
+                                             'path': '$INSTANCE/var/Data.fs',
+                                             'blob_dir': None,
+                                             'replicate_to': None,
+                                             'replicate_from': None}],
+                           'storages': ('<filestorage 1>\n'
+                                        '  path $INSTANCE/var/Data.fs\n'
+                                        '  \n'
+                                        '</filestorage>\n'),
+                           'imports': '',
+                           'directories': ['$INSTANCE/var'],
+                           'storage_files': "{'1': '/var/Data.fs'}",
+                           'blob_layout': None,
+                           'shared_blobs': False,
+                           'client_cache': None,
+                           'bench': False,
+                           'metrics': None,
+                           'compress': None,
+                           'pack': None,
+                           'index': False,
+                           'runzeo_hook': '',
+                           'service': None,
+                           'fast_scripts': False,
+                           'python_cmd': '"$PYTHON"',
+                           'zeoctl_hook': '',
+                           'reconcile': False,
+                           'dry_run': False,
+                           'fsync': False,
+                           'tls': None,
+                           'ssl': '',
+                           'tls_files': None,
+                           'log_level': 'info',
+                           'log_options': '',
+                           'runzeo_main': '-m ZEO.runzeo',
+                           'container': None,
+                           'relocatable': False,
+                           'conf_home': '',
+                           'conf_address': '',
+                           'runner_interpreter':
+                               '  python %s\n'
+                               '  zdrun /zdaemon/zdrun.py\n'
+                               % sys.executable,
+                           'script_env': ('PYTHON="%s"\n'
+                                          'INSTANCE_HOME=""\n'
+                                          'ZODB3_HOME=""\n'
+                                          '\n'
+                                          'CONFIG_FILE="/etc/zeo.conf"\n'
+                                          % sys.executable),
+                           'script_home': 'INSTANCE_HOME = ""\n',
                            }
 
         builder = self._makeOne()
@@ -158,6 +218,42 @@ class ZEOInstanceBuilderTests(_WithTempdir, unittest.TestCase):
 
         self.assertEqual(params, expected_params)
 
+    def test_get_params_w_profile(self):
+        from zope.mkzeoinstance import PROFILES
+
+        builder = self._makeOne()
+        params = builder.get_params(zodb_home='',
+                                    zdaemon_home='',
+                                    instance_home='',
+                                    address='',
+                                    blob_dir='',
+                                    profile='write-heavy',
+                                    )
+
+        self.assertEqual(params['profile'], PROFILES['write-heavy'])
+        self.assertEqual(params['invalidation_queue_size'], 2000)
+        self.assertEqual(params['invalidation_age'],
+                         '  invalidation-age 600\n')
+        self.assertEqual(params['transaction_timeout'],
+                         'transaction-timeout 60')
+        self.assertEqual(params['client_cache_hint'],
+                         '  # Recommended client cache-size: 256MB\n')
+
+    def test_get_params_w_auto_profile(self):
+        builder = self._makeOne()
+        params = builder.get_params(zodb_home='',
+                                    zdaemon_home='',
+                                    instance_home=self._makeTempDir(),
+                                    address='',
+                                    blob_dir='',
+                                    profile='auto',
+                                    )
+
+        self.assertGreaterEqual(params['invalidation_queue_size'], 100)
+        self.assertTrue(params['transaction_timeout'].startswith(
+            'transaction-timeout '))
+        self.assertIn('client cache-size', params['client_cache_hint'])
+
     def test_create_folders_and_files(self):
         import os
 
@@ -239,6 +335,90 @@ class ZEOInstanceBuilderTests(_WithTempdir, unittest.TestCase):
         self.assertTrue(
             os.path.exists(os.path.join(instance_home, 'bin', 'runzeo')))
 
+    def test_render(self):
+        import os
+
+        from zope.mkzeoinstance import InstanceModel
+        params = self._makeParams()
+        instance_home = params['instance_home']
+
+        builder = self._makeOne()
+        with TempStdout() as out:
+            model = builder.render(instance_home, params)
+
+        self.assertEqual(out.getvalue(), '')
+        self.assertFalse(os.path.exists(instance_home))
+        self.assertIsInstance(model, InstanceModel)
+        self.assertEqual(model.home, instance_home)
+        self.assertEqual(model.directories, [
+            instance_home,
+            os.path.join(instance_home, 'etc'),
+            os.path.join(instance_home, 'var'),
+            os.path.join(instance_home, 'log'),
+            os.path.join(instance_home, 'bin'),
+        ])
+        self.assertEqual(sorted(model.files), [
+            os.path.join(instance_home, 'bin', 'runzeo'),
+            os.path.join(instance_home, 'bin', 'zeoctl'),
+            os.path.join(instance_home, 'etc', 'zeo.conf'),
+        ])
+        data, mode = model.files[os.path.join(instance_home, 'bin', 'zeoctl')]
+        self.assertIn('-m ZEO.zeoctl', data)
+        self.assertEqual(mode, 0o777)
+        self.assertEqual(builder.render(instance_home, params), model)
+
+    def test_render_leaves_params_unchanged(self):
+        import copy
+
+        params = self._makeParams()
+        original = copy.deepcopy(params)
+
+        builder = self._makeOne()
+        model = builder.render(params['instance_home'], params)
+
+        self.assertEqual(params, original)
+        self.assertEqual(builder.render(params['instance_home'], params),
+                         model)
+
+    def test_complete_params(self):
+        import copy
+
+        from zope.mkzeoinstance import RUNZEO_TEMPLATE
+        from zope.mkzeoinstance import ZEO_CONF_TEMPLATE
+        from zope.mkzeoinstance import ZEOCTL_TEMPLATE
+        from zope.mkzeoinstance import complete_params
+        params = self._makeParams(blob_dir='/srv/blobs')
+        original = copy.deepcopy(params)
+
+        completed = complete_params(params)
+
+        self.assertEqual(params, original)
+        self.assertIn('  address 99999\n', ZEO_CONF_TEMPLATE % completed)
+        self.assertIn('  blob-dir /srv/blobs\n',
+                      ZEO_CONF_TEMPLATE % completed)
+        self.assertIn('-m ZEO.zeoctl', ZEOCTL_TEMPLATE % completed)
+        self.assertIn('-m ZEO.runzeo', RUNZEO_TEMPLATE % completed)
+
+    def test_render_write(self):
+        import os
+
+        params = self._makeParams()
+        instance_home = params['instance_home']
+        builder = self._makeOne()
+        model = builder.render(instance_home, params)
+
+        with TempStdout() as out:
+            with TempUmask(0o022):
+                model.write()
+
+        self.assertIn("Wrote file %s/etc/zeo.conf" % instance_home,
+                      out.getvalue())
+        for path, (data, mode) in model.files.items():
+            with open(path) as f:
+                self.assertEqual(f.read(), data)
+        self.assertTrue(os.access(
+            os.path.join(instance_home, 'bin', 'runzeo'), os.X_OK))
+
     def test_zeo_conf_content(self):
         import os
 
@@ -488,112 +668,123 @@ class ZEOInstanceBuilderTests(_WithTempdir, unittest.TestCase):
         with open(zeo_conf_path) as f:
             self.assertEqual(f.read(), expected_out)
 
-    def test_zeoctl_content(self):
+    def test_zeo_conf_content_w_profile(self):
         import os
+
+        builder = self._makeOne()
         params = self._makeParams()
-        instance_home = params['instance_home']
-        zeoctl_path = os.path.join(instance_home, 'bin', 'zeoctl')
+        params.update(builder.get_params(
+            params['zodb_home'], params['zdaemon_home'],
+            params['instance_home'], params['address'], None,
+            profile='read-heavy'))
 
+        instance_home = params['instance_home']
+        zeo_conf_path = os.path.join(instance_home, 'etc', 'zeo.conf')
         expected_out = "\n".join([
-            '#!/bin/sh',
-            '# ZEO instance control script',
-            '',
-            ('# The following two lines are for chkconfig.  '
-             'On Red Hat Linux (and'),
-            '# some other systems), you can copy or symlink this script into',
-            ('# /etc/rc.d/init.d/ and then use chkconfig(8) to '
-             'automatically start'),
-            '# ZEO at boot time.',
-            '',
-            '# chkconfig: 345 90 10',
-            '# description: start a ZEO server',
-            '',
-            'PYTHON="%(executable)s"',
-            'INSTANCE_HOME="%(instance_home)s"',
-            'ZODB3_HOME="%(zodb_home)s"',
-            '',
-            'CONFIG_FILE="%(instance_home)s/etc/zeo.conf"',
-            '',
-            'PYTHONPATH="$ZODB3_HOME"',
-            'export PYTHONPATH INSTANCE_HOME',
-            '',
-            'exec "$PYTHON" -m ZEO.zeoctl -C "$CONFIG_FILE" ${1+"$@"}',
-            '',
-        ]) % params
+            "<zeo>",
+            "  address 99999",
+            "  read-only false",
+            "  invalidation-queue-size 10000",
+            "  invalidation-age 3600",
+            "  # pid-filename $INSTANCE/var/ZEO.pid",
+            "  # monitor-address PORT",
+            "  transaction-timeout 300",
+            "  # Recommended client cache-size: 1GB",
+            "</zeo>",
+        ])
 
-        builder = self._makeOne()
         with TempStdout():
             builder.create(instance_home, params)
 
-        with open(zeoctl_path) as f:
-            self.assertEqual(f.read(), expected_out)
+        with open(zeo_conf_path) as f:
+            self.assertIn(expected_out, f.read())
 
-    def test_run_w_invalid_opt(self):
-        builder = self._makeOne()
-        usage = UsageStub()
-        self.assertRaises(UsageExit, builder.run, ['--nonesuch'], usage=usage)
-        self.assertEqual(usage._called_with,
-                         ('NO MESSAGE', 1))
+    def test_zeo_conf_content_w_storages(self):
+        import os
 
-    def test_run_w_help(self):
-        builder = self._makeOne()
-        usage = UsageStub()
-        self.assertRaises(UsageExit, builder.run, ['--help'], usage=usage)
-        self.assertEqual(usage._called_with, ('NO MESSAGE', 2))
+        from zope.mkzeoinstance import ZEO_DEFAULT_BLOB_DIR
 
-    def test_run_wo_arguments(self):
         builder = self._makeOne()
-        usage = UsageStub()
-        self.assertRaises(UsageExit, builder.run, [], usage=usage)
-        self.assertEqual(usage._called_with, ('NO MESSAGE', 1))
+        params = self._makeParams()
+        instance_home = params['instance_home']
+        other_var = os.path.join(self._makeTempDir(), 'disk2')
+        params = builder.get_params(
+            params['zodb_home'], params['zdaemon_home'], instance_home,
+            params['address'], ZEO_DEFAULT_BLOB_DIR,
+            storages=['main', 'catalog', 'sessions'],
+            storage_dirs={'sessions': other_var})
 
-    def test_run_w_too_many_arguments(self):
+        expected_out = "\n".join([
+            "<filestorage main>",
+            "  path $INSTANCE/var/Data.fs",
+            "  blob-dir $INSTANCE/var/blobs",
+            "</filestorage>",
+            "",
+            "<filestorage catalog>",
+            "  path $INSTANCE/var/catalog/Data.fs",
+            "  blob-dir $INSTANCE/var/catalog/blobs",
+            "</filestorage>",
+            "",
+            "<filestorage sessions>",
+            "  path %(other_var)s/Data.fs",
+            "  blob-dir %(other_var)s/blobs",
+            "</filestorage>",
+            "",
+            "<eventlog>",
+        ]) % {'other_var': other_var}
+
+        with TempStdout():
+            builder.create(instance_home, params)
+
+        with open(os.path.join(instance_home, 'etc', 'zeo.conf')) as f:
+            self.assertIn(expected_out, f.read())
+        self.assertTrue(os.path.isdir(
+            os.path.join(instance_home, 'var', 'blobs')))
+        self.assertTrue(os.path.isdir(
+            os.path.join(instance_home, 'var', 'catalog', 'blobs')))
+        self.assertTrue(os.path.isdir(os.path.join(other_var, 'blobs')))
+
+    def test_get_storages_w_specified_blobs(self):
         builder = self._makeOne()
-        usage = UsageStub()
-        self.assertRaises(UsageExit, builder.run, ['a', 'b', 'c'], usage=usage)
-        self.assertEqual(usage._called_with, ('NO MESSAGE', 1))
+        storages = builder.get_storages(['1', '2'], '/usr/local/blobs')
+        self.assertEqual([s['blob_dir'] for s in storages],
+                         ['/usr/local/blobs/1', '/usr/local/blobs/2'])
+        self.assertEqual(builder.get_directories(storages),
+                         ['$INSTANCE/var', '$INSTANCE/var/2'])
 
-    def test_run_wo_single_arg_non_absolute(self):
+    def test_run_w_blob_layout_and_mounts(self):
         import os
-        self.maxDiff = None
-        builder = self._makeOne()
-        tempdir = self._makeTempDir()
-        where = os.path.join(tempdir, 'foo', '..', 'bar')
-        abswhere = os.path.abspath(where)
 
-        params = self._makeParams()
-        params['instance_home'] = abswhere
-        expected_out = "\n".join([
-            "Created directory %(instance_home)s",
-            "Created directory %(instance_home)s/etc",
-            "Created directory %(instance_home)s/var",
-            "Created directory %(instance_home)s/log",
-            "Created directory %(instance_home)s/bin",
-            "Wrote file %(instance_home)s/etc/zeo.conf",
-            "Wrote file %(instance_home)s/bin/zeoctl",
-            "Changed mode for %(instance_home)s/bin/zeoctl to 755",
-            "Wrote file %(instance_home)s/bin/runzeo",
-            "Changed mode for %(instance_home)s/bin/runzeo to 755",
-            ""
-        ]) % params
+        builder = self._makeOne()
+        temp_dir = self._makeTempDir()
+        instance_home = os.path.join(temp_dir, 'instance')
+        mounts = [os.path.join(temp_dir, 'm1'), os.path.join(temp_dir, 'm2')]
 
-        with TempStdout() as temp_out_file:
+        with TempStdout():
             with TempUmask(0o022):
-                builder.run([where])
-                self.assertEqual(temp_out_file.getvalue(), expected_out)
+                builder.run([instance_home, '--storages', '3',
+                             '--blob-layout', 'lawn',
+                             '--blob-mounts', ','.join(mounts)])
 
-        self.assertTrue(os.path.exists(os.path.join(abswhere, 'etc')))
-        self.assertTrue(os.path.exists(os.path.join(abswhere, 'var')))
-        self.assertTrue(os.path.exists(os.path.join(abswhere, 'log')))
-        self.assertTrue(os.path.exists(os.path.join(abswhere, 'bin')))
-        self.assertTrue(
-            os.path.exists(os.path.join(abswhere, 'etc', 'zeo.conf')))
-        self.assertTrue(
-            os.path.exists(os.path.join(abswhere, 'bin', 'zeoctl')))
-        self.assertTrue(
-            os.path.exists(os.path.join(abswhere, 'bin', 'runzeo')))
+        with open(os.path.join(instance_home, 'etc', 'zeo.conf')) as f:
+            conf = [x.strip() for x in f.read().splitlines()]
+        expected = [os.path.join(mounts[0], 'instance', '1'),
+                    os.path.join(mounts[1], 'instance', '2'),
+                    os.path.join(mounts[0], 'instance', '3')]
+        for blob_dir in expected:
+            self.assertIn('blob-dir %s' % blob_dir, conf)
+            with open(os.path.join(blob_dir, '.layout')) as f:
+                self.assertEqual(f.read(), 'lawn')
+
+    def test_run_w_unknown_blob_layout(self):
+        builder = self._makeOne()
+        usage = UsageStub()
+        self.assertRaises(UsageExit, builder.run,
+                          ['home', '--blob-layout', 'tree'], usage=usage)
+        self.assertEqual(usage._called_with,
+                         ('Unknown blob layout: tree', 1))
 
-    def test_run_wo_two_args_no_host(self):
+    def test_run_w_shared_blobs(self):
         import os
 
         builder = self._makeOne()
@@ -602,96 +793,1586 @@ class ZEOInstanceBuilderTests(_WithTempdir, unittest.TestCase):
 
         with TempStdout():
             with TempUmask(0o022):
-                builder.run([instance_home, '8888'])
+                builder.run([instance_home, '8100', '--shared-blobs'])
 
         with open(os.path.join(instance_home, 'etc', 'zeo.conf')) as f:
-            conf = f.read()
-        self.assertIn(
-            'address 8888',
-            [x.strip() for x in conf.splitlines()]
-        )
-
-    def test_run_wo_two_args_w_host(self):
+            conf = [x.strip() for x in f.read().splitlines()]
+        self.assertIn('blob-dir $INSTANCE/var/blobs', conf)
+        with open(os.path.join(instance_home, 'etc', 'zeoclient.conf')) as f:
+            client_conf = f.read()
+        self.assertIn("\n".join([
+            "<zodb instance>",
+            "  <zeoclient>",
+            "    server localhost:8100",
+            "    storage 1",
+            "    blob-dir %s/var/blobs" % instance_home,
+            "    shared-blob-dir true",
+            "  </zeoclient>",
+            "</zodb>",
+        ]), client_conf)
+
+    def test_run_w_client_config(self):
         import os
 
         builder = self._makeOne()
         params = self._makeParams()
         instance_home = params['instance_home']
+        os.makedirs(os.path.join(instance_home, 'var'))
+        with open(os.path.join(instance_home, 'var', 'Data.fs'), 'wb') as f:
+            f.truncate(200 << 20)
 
         with TempStdout():
             with TempUmask(0o022):
-                builder.run([instance_home, 'localhost:8888'])
-
-        with open(os.path.join(instance_home, 'etc', 'zeo.conf')) as f:
-            conf = f.read()
-        self.assertIn(
-            'address localhost:8888',
-            [x.strip() for x in conf.splitlines()]
-        )
-
+                builder.run([instance_home, '8100', '-b', '--client-config'])
+
+        with open(os.path.join(instance_home, 'etc', 'zeoclient.conf')) as f:
+            client_conf = f.read()
+        client_var = os.path.join(instance_home, 'var', 'zeoclient')
+        self.assertIn("\n".join([
+            "    storage 1",
+            "    # Give every application process its own client name.",
+            "    cache-size 64MB",
+            "    client instance",
+            "    var %s" % client_var,
+            "    blob-dir %s/blobs-1" % client_var,
+            "    blob-cache-size 256MB",
+            "  </zeoclient>",
+        ]), client_conf)
+        self.assertTrue(os.path.isdir(client_var))
+
+    def test_run_w_client_config_and_shared_blobs(self):
+        import os
 
-class UtilityFunctionsTest(_WithTempdir, unittest.TestCase):
+        builder = self._makeOne()
+        params = self._makeParams()
+        instance_home = params['instance_home']
+        client_var = os.path.join(self._makeTempDir(), 'cache')
 
-    def test_mkdirs(self):
+        with TempStdout():
+            with TempUmask(0o022):
+                builder.run([instance_home, '--shared-blobs',
+                             '--client-var', client_var,
+                             '--profile', 'write-heavy'])
+
+        with open(os.path.join(instance_home, 'etc', 'zeoclient.conf')) as f:
+            lines = [x.strip() for x in f.read().splitlines()]
+        self.assertIn('cache-size 256MB', lines)
+        self.assertIn('var %s' % client_var, lines)
+        self.assertIn('shared-blob-dir true', lines)
+        self.assertNotIn('blob-cache-size', ' '.join(lines))
+
+    def test_create_w_bench(self):
         import os
 
-        from zope.mkzeoinstance import mkdirs
-        temp_dir = self._makeTempDir()
-        path = os.path.join(temp_dir, 'test')
+        params = self._makeParams()
+        params['bench'] = True
+        instance_home = params['instance_home']
+        zeobench_path = os.path.join(instance_home, 'bin', 'zeobench')
 
-        with TempStdout() as temp_out_file:
-            mkdirs(path)
-            self.assertEqual('Created directory %s\n' % path,
-                             temp_out_file.getvalue())
-        self.assertTrue(os.path.exists(path))
+        builder = self._makeOne()
+        with TempStdout() as out:
+            with TempUmask(0o022):
+                builder.create(instance_home, params)
 
-    def test_mkdirs_nested(self):
+        self.assertIn('Changed mode for %s to 755' % zeobench_path,
+                      out.getvalue())
+        with open(zeobench_path) as f:
+            script = f.read()
+        self.assertTrue(script.startswith('#!%s\n' % params['python']))
+        self.assertIn('\nINSTANCE_HOME = "%s"\n'
+                      'CONFIG_FILE = INSTANCE_HOME + "/etc/zeo.conf"\n'
+                      % instance_home, script)
+        compile(script, zeobench_path, 'exec')
+
+    def test_zeobench_removes_its_data(self):
         import os
 
-        from zope.mkzeoinstance import mkdirs
-        temp_dir = self._makeTempDir()
-        parent_path = os.path.join(temp_dir, 'parent')
-        child_path = os.path.join(parent_path, 'child')
-
-        with TempStdout() as temp_out_file:
-            mkdirs(child_path)
-            self.assertEqual('Created directory %s\n'
-                             'Created directory %s\n'
-                             % (parent_path, child_path),
-                             temp_out_file.getvalue())
-        self.assertTrue(os.path.isdir(child_path))
+        import transaction
+        import ZEO
 
-    def test_makedir(self):
+        builder = self._makeOne()
+        params = self._makeParams()
+        instance_home = params['instance_home']
+        params = builder.get_params(
+            params['zodb_home'], params['zdaemon_home'], instance_home,
+            params['address'], None, bench=True)
+        with TempStdout():
+            builder.create(instance_home, params)
+        zeobench_path = os.path.join(instance_home, 'bin', 'zeobench')
+        with open(zeobench_path) as f:
+            script = f.read()
+        namespace = {'__name__': 'zeobench'}
+        exec(compile(script, zeobench_path, 'exec'), namespace)
+
+        address, stop = ZEO.server()
+        try:
+            namespace['server_config'] = lambda config: (address, ['1'])
+            with TempStdout() as out:
+                namespace['main'](['-c', '1', '-t', '2', '-o', '100'])
+            self.assertIn('"operations": 2,', out.getvalue())
+            db = ZEO.DB(address)
+            try:
+                with db.transaction() as conn:
+                    self.assertNotIn('zeobench', conn.root())
+            finally:
+                transaction.abort()
+                db.close()
+        finally:
+            stop()
+
+    def test_create_w_metrics(self):
         import os
+        import subprocess
+        import sys
 
-        from zope.mkzeoinstance import makedir
-        temp_dir = self._makeTempDir()
-        path = os.path.join(temp_dir, 'test')
+        builder = self._makeOne()
+        params = self._makeParams()
+        instance_home = params['instance_home']
+        params = builder.get_params(
+            params['zodb_home'], params['zdaemon_home'], instance_home,
+            '127.0.0.1:1', None, metrics='9180')
+        zeometrics_path = os.path.join(instance_home, 'bin', 'zeometrics')
 
-        with TempStdout() as temp_out_file:
-            makedir(temp_dir, 'test')
-            self.assertEqual('Created directory %s\n' % path,
-                             temp_out_file.getvalue())
-        self.assertTrue(os.path.exists(path))
+        self.assertEqual(params['metrics_address'], 'localhost:9180')
+        self.assertEqual(params['metrics_server'], "('127.0.0.1', 1)")
+        self.assertEqual(
+            params['storage_files'],
+            repr({'1': os.path.join(instance_home, 'var', 'Data.fs')}))
 
-    def test_makefile(self):
+        with TempStdout():
+            with TempUmask(0o022):
+                builder.create(instance_home, params)
+
+        with open(os.path.join(instance_home, 'var', 'Data.fs'), 'wb') as f:
+            f.write(b'FS21')
+        output = subprocess.check_output(
+            [sys.executable, zeometrics_path, '--once']).decode('utf-8')
+        self.assertIn('zeo_up 0\n', output)
+        self.assertIn('zeo_storage_size_bytes{storage="1"} 4\n', output)
+
+    def test_run_w_pack(self):
         import os
 
-        from zope.mkzeoinstance import makefile
-        template = "KEY=%(key)s"
-        params = {'key': 'value'}
-        temp_dir = self._makeTempDir()
-        path = os.path.join(temp_dir, 'test.txt')
+        from zope.mkzeoinstance import pack_schedule
 
-        with TempStdout() as temp_out_file:
-            makefile(template, temp_dir, 'test.txt', **params)
-            self.assertEqual('Wrote file %s\n' % path,
-                             temp_out_file.getvalue())
+        builder = self._makeOne()
+        params = self._makeParams()
+        instance_home = params['instance_home']
 
+        with TempStdout():
+            with TempUmask(0o022):
+                builder.run([instance_home, '--pack', '3',
+                             '--pack-window', 'Sat 02:00-04:00'])
+
+        weekday, hour, minute = pack_schedule('Sat 02:00-04:00',
+                                              instance_home)
+        etc = os.path.join(instance_home, 'etc')
+        with open(os.path.join(etc, 'zeopack-instance.timer')) as f:
+            self.assertIn('\nOnCalendar=Sat *-*-* %02d:%02d:00\n'
+                          % (hour, minute), f.read())
+        with open(os.path.join(etc, 'zeopack-instance.service')) as f:
+            self.assertIn('\nExecStart=%s/bin/zeopack\n' % instance_home,
+                          f.read())
+        with open(os.path.join(etc, 'zeopack.cron')) as f:
+            self.assertIn('\n%d %d * * 6 %s/bin/zeopack'
+                          % (minute, hour, instance_home), f.read())
+
+        path = os.path.join(instance_home, 'bin', 'zeopack')
+        self.assertTrue(os.access(path, os.X_OK))
         with open(path) as f:
-            self.assertEqual('KEY=value', f.read())
+            script = f.read()
+        self.assertIn('\nDAYS = 3\n', script)
+        compile(script, path, 'exec')
 
-    def test_makefile_existing_same_content(self):
+    def test_run_w_invalid_pack_window(self):
+        builder = self._makeOne()
+        usage = UsageStub()
+        self.assertRaises(UsageExit, builder.run,
+                          ['home', '--pack', '--pack-window', '2am-4am'],
+                          usage=usage)
+        self.assertEqual(usage._called_with,
+                         ('Invalid pack window: 2am-4am', 1))
+
+    def test_run_w_warm(self):
+        import os
+        import subprocess
+        import sys
+
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.FileStorage import FileStorage
+
+        builder = self._makeOne()
+        params = self._makeParams()
+        instance_home = params['instance_home']
+
+        with TempStdout():
+            with TempUmask(0o022):
+                builder.run([instance_home, '--warm', '1MB'])
+
+        with open(os.path.join(instance_home, 'bin', 'runzeo')) as f:
+            self.assertIn('\n"$INSTANCE_HOME/bin/zeoindex" --rebuild\n\n'
+                          'exec "$PYTHON" -m ZEO.runzeo', f.read())
+        zeoindex_path = os.path.join(instance_home, 'bin', 'zeoindex')
+        with open(zeoindex_path) as f:
+            self.assertIn("\nWARM = '1MB'\n", f.read())
+
+        path = os.path.join(instance_home, 'var', 'Data.fs')
+        db = DB(FileStorage(path))
+        with db.transaction() as conn:
+            conn.root()['x'] = 1
+        db.close()
+        transaction.abort()
+        os.remove(path + '.index')
+
+        output = subprocess.check_output(
+            [sys.executable, zeoindex_path, '--rebuild']).decode('utf-8')
+        self.assertIn('%s: index rebuilt in ' % path, output)
+        self.assertIn('%s: warmed up in ' % path, output)
+        output = subprocess.check_output(
+            [sys.executable, zeoindex_path, '--warm', '0']).decode('utf-8')
+        self.assertEqual(output.split(' in ')[0], '%s: index ok' % path)
+        self.assertNotIn('warmed up', output)
+
+    def test_run_w_warm_off(self):
+        import os
+
+        for size in ('0', '0MB', ''):
+            builder = self._makeOne()
+            params = self._makeParams()
+            instance_home = params['instance_home']
+
+            with TempStdout():
+                with TempUmask(0o022):
+                    builder.run([instance_home, '--warm', size])
+
+            with open(os.path.join(instance_home, 'bin', 'runzeo')) as f:
+                self.assertNotIn('zeoindex', f.read())
+            self.assertFalse(os.path.exists(
+                os.path.join(instance_home, 'bin', 'zeoindex')))
+
+    def test_run_w_invalid_warm(self):
+        builder = self._makeOne()
+        usage = UsageStub()
+        self.assertRaises(UsageExit, builder.run,
+                          ['home', '--warm', 'lots'], usage=usage)
+        self.assertEqual(usage._called_with,
+                         ('Invalid warm-up size: lots', 1))
+
+    def test_run_w_service(self):
+        import os
+
+        builder = self._makeOne()
+        params = self._makeParams()
+        instance_home = params['instance_home']
+
+        with TempStdout():
+            with TempUmask(0o022):
+                builder.run([instance_home, '--service', 'systemd',
+                             '-p', 'small'])
+
+        path = os.path.join(instance_home, 'etc', 'zeo-instance.service')
+        with open(path) as f:
+            unit = f.read()
+        self.assertIn('\nExecStart=%s/bin/runzeo\n' % instance_home, unit)
+        self.assertRegex(unit, '\nCPUAffinity=[0-9]+\n')
+        self.assertIn("\n".join([
+            "Nice=0",
+            "IOSchedulingClass=best-effort",
+            "IOSchedulingPriority=4",
+            "LimitNOFILE=4096",
+            "MemoryHigh=512M",
+            "",
+        ]), unit)
+
+    def test_run_w_service_wo_profile(self):
+        import os
+
+        builder = self._makeOne()
+        params = self._makeParams()
+        instance_home = params['instance_home']
+
+        with TempStdout():
+            with TempUmask(0o022):
+                builder.run([instance_home, '--service', 'systemd'])
+
+        path = os.path.join(instance_home, 'etc', 'zeo-instance.service')
+        with open(path) as f:
+            unit = f.read()
+        self.assertIn('\n# CPUAffinity=CPUS\n', unit)
+        self.assertIn('\n# MemoryHigh=BYTES\n', unit)
+
+    def test_run_w_unknown_service(self):
+        builder = self._makeOne()
+        usage = UsageStub()
+        self.assertRaises(UsageExit, builder.run,
+                          ['home', '--service', 'upstart'], usage=usage)
+        self.assertEqual(usage._called_with,
+                         ('Unknown service manager: upstart', 1))
+
+    def test_run_w_fast_scripts(self):
+        import os
+        import subprocess
+
+        import zope.mkzeoinstance
+        builder = self._makeOne()
+        params = self._makeParams()
+        instance_home = params['instance_home']
+        precompiled = []
+
+        def precompile():
+            precompiled.append(True)
+            return ['ZEO']
+
+        with TempStdout() as out:
+            with TempUmask(0o022):
+                with TempAttribute(zope.mkzeoinstance, 'precompile',
+                                   precompile):
+                    builder.run([instance_home, '--fast-scripts'])
+
+        self.assertEqual(precompiled, [True])
+        self.assertIn("Warning: can't precompile ZEO\n", out.getvalue())
+
+        bin_dir = os.path.join(instance_home, 'bin')
+        with open(os.path.join(bin_dir, 'zeoctl')) as f:
+            zeoctl = f.read()
+        self.assertIn('\nif [ "$1" = status ]; then\n', zeoctl)
+        self.assertIn('exec "$PYTHON" -I ', zeoctl)
+        with open(os.path.join(bin_dir, 'runzeo')) as f:
+            self.assertIn('exec "$PYTHON" -I ', f.read())
+
+        process = subprocess.Popen(
+            [os.path.join(bin_dir, 'zeoctl'), 'status'],
+            stdout=subprocess.PIPE)
+        output = process.communicate()[0].decode('utf-8')
+        self.assertEqual(output, 'daemon manager not running\n')
+        self.assertEqual(process.returncode, 3)
+
+    def test_run_w_reconcile(self):
+        import json
+        import os
+
+        builder = self._makeOne()
+        params = self._makeParams()
+        instance_home = params['instance_home']
+        zeo_conf = os.path.join(instance_home, 'etc', 'zeo.conf')
+        zeoctl = os.path.join(instance_home, 'bin', 'zeoctl')
+
+        with TempStdout():
+            with TempUmask(0o022):
+                builder.run([instance_home, '--reconcile'])
+        with open(os.path.join(instance_home, 'etc',
+                               '.mkzeoinstance.manifest')) as f:
+            manifest = json.load(f)
+        self.assertEqual(sorted(manifest['files']),
+                         sorted([zeo_conf, zeoctl, os.path.join(
+                             instance_home, 'bin', 'runzeo')]))
+        self.assertEqual(manifest['params']['address'], 9999)
+
+        with TempStdout() as out:
+            with TempUmask(0o022):
+                builder.run([instance_home, '--reconcile'])
+        self.assertEqual(out.getvalue(), '')
+
+        with open(zeoctl, 'a') as f:
+            f.write('# local change\n')
+        with TempStdout() as out:
+            with TempUmask(0o022):
+                builder.run([instance_home, '8100', '--reconcile'])
+        self.assertEqual(out.getvalue(), ''.join([
+            'Updated file %s\n' % zeo_conf,
+            'Updated file %s\n' % zeoctl,
+        ]))
+        with open(zeo_conf) as f:
+            self.assertIn('\n  address 8100\n', f.read())
+        with open(zeoctl) as f:
+            self.assertNotIn('local change', f.read())
+
+    def test_run_w_dry_run(self):
+        import os
+
+        builder = self._makeOne()
+        params = self._makeParams()
+        instance_home = params['instance_home']
+        zeo_conf = os.path.join(instance_home, 'etc', 'zeo.conf')
+
+        with TempStdout():
+            with TempUmask(0o022):
+                builder.run([instance_home])
+        with open(zeo_conf) as f:
+            before = f.read()
+
+        with TempStdout() as out:
+            with TempUmask(0o022):
+                builder.run([instance_home, '8100', '--dry-run', '--bench'])
+        output = out.getvalue()
+        self.assertIn('--- %s\n+++ %s\n' % (zeo_conf, zeo_conf), output)
+        self.assertIn('\n-  address 9999\n+  address 8100\n', output)
+        self.assertIn('--- /dev/null\n+++ %s/bin/zeobench\n'
+                      % instance_home, output)
+        self.assertNotIn('Warning', output)
+        with open(zeo_conf) as f:
+            self.assertEqual(f.read(), before)
+        self.assertFalse(os.path.exists(
+            os.path.join(instance_home, 'bin', 'zeobench')))
+        self.assertFalse(os.path.exists(
+            os.path.join(instance_home, 'etc', '.mkzeoinstance.manifest')))
+
+    def test_zeo_conf_content_w_zlibstorage(self):
+        import os
+
+        builder = self._makeOne()
+        params = self._makeParams()
+        instance_home = params['instance_home']
+        params = builder.get_params(
+            params['zodb_home'], params['zdaemon_home'], instance_home,
+            params['address'], '/blobs', storage_type='zlibstorage')
+
+        with TempStdout():
+            builder.create(instance_home, params)
+
+        with open(os.path.join(instance_home, 'etc', 'zeo.conf')) as f:
+            conf = f.read()
+        self.assertTrue(conf.startswith("\n".join([
+            "# ZEO configuration file",
+            "",
+            "%import zc.zlibstorage",
+            "",
+            "%define INSTANCE " + instance_home,
+            "",
+        ])))
+        self.assertIn("\n".join([
+            "<zlibstorage 1>",
+            "  <filestorage>",
+            "    path $INSTANCE/var/Data.fs",
+            "    blob-dir /blobs",
+            "  </filestorage>",
+            "</zlibstorage>",
+        ]), conf)
+
+    def test_demostorage_opens_on_fresh_instance(self):
+        import os
+
+        from ZEO.runzeo import ZEOOptions
+
+        builder = self._makeOne()
+        params = self._makeParams()
+        instance_home = params['instance_home']
+        params = builder.get_params(
+            params['zodb_home'], params['zdaemon_home'], instance_home,
+            params['address'], None, storage_type='demostorage')
+
+        with TempStdout():
+            builder.create(instance_home, params)
+
+        options = ZEOOptions()
+        options.realize(
+            ['-C', os.path.join(instance_home, 'etc', 'zeo.conf')])
+        storage = options.storages[0].open()
+        try:
+            self.assertEqual(len(storage), 0)
+            self.assertFalse(storage.isReadOnly())
+        finally:
+            storage.close()
+        self.assertTrue(os.path.exists(
+            os.path.join(instance_home, 'var', 'Data.fs')))
+
+    def test_register_storage_type(self):
+        builder = self._makeOne()
+        builder.register_storage_type(
+            'relstorage',
+            '<relstorage %(name)s>\n  <postgresql>\n  </postgresql>\n'
+            '</relstorage>\n',
+            'relstorage')
+        storages = builder.get_storages(
+            ['1', '2'], None, storage_type='relstorage')
+
+        self.assertEqual(builder.render_imports(storages),
+                         '%import relstorage\n\n')
+        self.assertIn('<relstorage 2>', builder.render_storages(storages))
+        self.assertNotIn('relstorage', self._getTargetClass().storage_types)
+
+    def test_zeoctl_content(self):
+        import os
+        params = self._makeParams()
+        instance_home = params['instance_home']
+        zeoctl_path = os.path.join(instance_home, 'bin', 'zeoctl')
+
+        expected_out = "\n".join([
+            '#!/bin/sh',
+            '# ZEO instance control script',
+            '',
+            ('# The following two lines are for chkconfig.  '
+             'On Red Hat Linux (and'),
+            '# some other systems), you can copy or symlink this script into',
+            ('# /etc/rc.d/init.d/ and then use chkconfig(8) to '
+             'automatically start'),
+            '# ZEO at boot time.',
+            '',
+            '# chkconfig: 345 90 10',
+            '# description: start a ZEO server',
+            '',
+            'PYTHON="%(executable)s"',
+            'INSTANCE_HOME="%(instance_home)s"',
+            'ZODB3_HOME="%(zodb_home)s"',
+            '',
+            'CONFIG_FILE="%(instance_home)s/etc/zeo.conf"',
+            '',
+            'PYTHONPATH="$ZODB3_HOME"',
+            'export PYTHONPATH INSTANCE_HOME',
+            '',
+            'exec "$PYTHON" -m ZEO.zeoctl -C "$CONFIG_FILE" ${1+"$@"}',
+            '',
+        ]) % params
+
+        builder = self._makeOne()
+        with TempStdout():
+            builder.create(instance_home, params)
+
+        with open(zeoctl_path) as f:
+            self.assertEqual(f.read(), expected_out)
+
+    def test_run_w_invalid_opt(self):
+        builder = self._makeOne()
+        usage = UsageStub()
+        self.assertRaises(UsageExit, builder.run, ['--nonesuch'], usage=usage)
+        self.assertEqual(usage._called_with,
+                         ('NO MESSAGE', 1))
+
+    def test_run_w_help(self):
+        builder = self._makeOne()
+        usage = UsageStub()
+        self.assertRaises(UsageExit, builder.run, ['--help'], usage=usage)
+        self.assertEqual(usage._called_with, ('NO MESSAGE', 2))
+
+    def test_run_w_unknown_profile(self):
+        builder = self._makeOne()
+        usage = UsageStub()
+        self.assertRaises(UsageExit, builder.run,
+                          ['home', '--profile', 'nonesuch'], usage=usage)
+        self.assertEqual(usage._called_with,
+                         ('Unknown profile: nonesuch', 1))
+
+    def test_run_w_profile(self):
+        import os
+
+        builder = self._makeOne()
+        params = self._makeParams()
+        instance_home = params['instance_home']
+
+        with TempStdout():
+            with TempUmask(0o022):
+                builder.run([instance_home, '--profile', 'write-heavy'])
+
+        with open(os.path.join(instance_home, 'etc', 'zeo.conf')) as f:
+            conf = [x.strip() for x in f.read().splitlines()]
+        self.assertIn('invalidation-queue-size 2000', conf)
+        self.assertIn('transaction-timeout 60', conf)
+
+    def test_run_w_storages_count(self):
+        import os
+
+        builder = self._makeOne()
+        params = self._makeParams()
+        instance_home = params['instance_home']
+
+        with TempStdout():
+            with TempUmask(0o022):
+                builder.run([instance_home, '--storages', '2'])
+
+        with open(os.path.join(instance_home, 'etc', 'zeo.conf')) as f:
+            conf = [x.strip() for x in f.read().splitlines()]
+        self.assertIn('<filestorage 1>', conf)
+        self.assertIn('<filestorage 2>', conf)
+        self.assertIn('path $INSTANCE/var/2/Data.fs', conf)
+        self.assertTrue(os.path.isdir(os.path.join(instance_home, 'var', '2')))
+
+    def test_run_w_invalid_storages(self):
+        builder = self._makeOne()
+        usage = UsageStub()
+        self.assertRaises(UsageExit, builder.run,
+                          ['home', '--storages', 'a,b c'], usage=usage)
+        self.assertEqual(usage._called_with, ('Invalid storages: a,b c', 1))
+
+    def test_run_w_duplicate_storages(self):
+        builder = self._makeOne()
+        usage = UsageStub()
+        self.assertRaises(UsageExit, builder.run,
+                          ['home', '--storages', 'a,a'], usage=usage)
+        self.assertEqual(usage._called_with,
+                         ('Duplicate storage names: a,a', 1))
+
+    def test_run_w_storage_dir_for_unknown_storage(self):
+        builder = self._makeOne()
+        usage = UsageStub()
+        self.assertRaises(UsageExit, builder.run,
+                          ['home', '--storage-dir', 'x=/tmp'], usage=usage)
+        self.assertEqual(usage._called_with,
+                         ('Invalid storage directory: x=/tmp', 1))
+
+    def _writeManifest(self, text):
+        import os
+        path = os.path.join(self._makeTempDir(), 'fleet.toml')
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_run_w_manifest_umask(self):
+        import os
+        import stat
+        import threading
+
+        import zope.mkzeoinstance
+        builder = self._makeOne()
+        manifest = self._writeManifest(''.join(
+            '[[instance]]\nhome = "zeo%d"\naddress = %d\n' % (i, 8100 + i)
+            for i in range(4)))
+        get_umask = zope.mkzeoinstance.get_umask
+        threads = []
+
+        def record_umask():
+            threads.append(threading.current_thread())
+            return get_umask()
+
+        with TempStdout():
+            with TempUmask(0o077):
+                with TempAttribute(zope.mkzeoinstance, 'get_umask',
+                                   record_umask):
+                    failed = builder.run(['--manifest', manifest, '-j', '4'])
+
+        self.assertEqual(failed, 0)
+        self.assertEqual(threads, [threading.current_thread()])
+        for i in range(4):
+            path = os.path.join(os.path.dirname(manifest), 'zeo%d' % i,
+                                'bin', 'runzeo')
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o700)
+
+    def test_run_w_manifest(self):
+        import os
+
+        builder = self._makeOne()
+        manifest = self._writeManifest('\n'.join([
+            '[defaults]',
+            'profile = "write-heavy"',
+            'blobs = true',
+            '',
+            '[[instance]]',
+            'home = "zeo1"',
+            'address = "8100"',
+            '',
+            '[[instance]]',
+            'home = "zeo2"',
+            'address = 8101',
+            'storages = ["main", "catalog"]',
+            'storage-dir = {catalog = "disk2"}',
+            '',
+        ]))
+        temp_dir = self._makeTempDir()
+
+        with TempStdout() as out:
+            with TempUmask(0o022):
+                failed = builder.run(['--manifest', manifest, '-j', '2'])
+
+        self.assertEqual(failed, 0)
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[-1].startswith('Created 2 of 2 instances in '))
+        self.assertIn('Created instance %s in ' % os.path.join(
+            temp_dir, 'zeo1'), out.getvalue())
+        with open(os.path.join(temp_dir, 'zeo1', 'etc', 'zeo.conf')) as f:
+            conf = [x.strip() for x in f.read().splitlines()]
+        self.assertIn('address 8100', conf)
+        self.assertIn('transaction-timeout 60', conf)
+        self.assertIn('blob-dir $INSTANCE/var/blobs', conf)
+        with open(os.path.join(temp_dir, 'zeo2', 'etc', 'zeo.conf')) as f:
+            conf = [x.strip() for x in f.read().splitlines()]
+        self.assertIn('address 8101', conf)
+        self.assertIn('path %s/Data.fs' % os.path.join(temp_dir, 'disk2'),
+                      conf)
+        self.assertTrue(os.path.isdir(os.path.join(temp_dir, 'disk2')))
+
+    def test_run_w_manifest_shared_metrics(self):
+        import os
+
+        builder = self._makeOne()
+        manifest = self._writeManifest('\n'.join([
+            '[defaults]',
+            'metrics = "127.0.0.1:0"',
+            '',
+            '[[instance]]',
+            'home = "zeo1"',
+            'address = 8100',
+            '',
+            '[[instance]]',
+            'home = "zeo2"',
+            'address = 8101',
+            '',
+        ]))
+        temp_dir = self._makeTempDir()
+
+        with TempStdout():
+            with TempUmask(0o022):
+                builder.run(['--manifest', manifest])
+
+        listens = set()
+        for name in ('zeo1', 'zeo2'):
+            with open(os.path.join(temp_dir, name, 'bin', 'zeometrics')) as f:
+                listens.update(x for x in f.read().splitlines()
+                               if x.startswith('LISTEN = '))
+        self.assertEqual(len(listens), 2)
+
+    def test_run_w_manifest_failure(self):
+        import os
+
+        builder = self._makeOne()
+        manifest = self._writeManifest('\n'.join([
+            '[[instance]]',
+            'home = "zeo1"',
+            'address = "8100"',
+            '[[instance]]',
+            'home = "blocked/zeo2"',
+            'address = "8101"',
+            '',
+        ]))
+        with open(os.path.join(self._makeTempDir(), 'blocked'), 'w'):
+            pass
+
+        with TempStdout() as out:
+            failed = builder.run(['--manifest', manifest])
+
+        self.assertEqual(failed, 1)
+        self.assertIn('Failed to create instance', out.getvalue())
+        self.assertIn('Created 1 of 2 instances in ', out.getvalue())
+
+    def test_run_w_manifest_and_home(self):
+        builder = self._makeOne()
+        usage = UsageStub()
+        self.assertRaises(UsageExit, builder.run,
+                          ['home', '--manifest', 'fleet.toml'], usage=usage)
+        self.assertEqual(
+            usage._called_with,
+            ("A manifest can't be combined with an instance home", 1))
+
+    def test_run_w_manifest_duplicate_homes(self):
+        builder = self._makeOne()
+        manifest = self._writeManifest('\n'.join([
+            '[[instance]]',
+            'home = "zeo1"',
+            'address = "8100"',
+            '[[instance]]',
+            'home = "zeo1"',
+            'address = "8101"',
+            '',
+        ]))
+        usage = UsageStub()
+        self.assertRaises(UsageExit, builder.run,
+                          ['--manifest', manifest], usage=usage)
+        self.assertEqual(
+            usage._called_with,
+            ('Duplicate instance homes in manifest %s' % manifest, 1))
+
+    def test_run_w_manifest_unknown_key(self):
+        builder = self._makeOne()
+        manifest = self._writeManifest('[[instance]]\nhome = "a"\nx = 1\n')
+        usage = UsageStub()
+        self.assertRaises(UsageExit, builder.run,
+                          ['--manifest', manifest], usage=usage)
+        self.assertEqual(usage._called_with,
+                         ('Unknown manifest keys: x', 1))
+
+    def test_run_w_instances(self):
+        import os
+        import socket
+
+        builder = self._makeOne()
+        temp_dir = self._makeTempDir()
+        home = os.path.join(temp_dir, 'fleet')
+
+        busy = socket.socket()
+        busy.bind(('127.0.0.1', 0))
+        busy.listen(1)
+        first = busy.getsockname()[1]
+        try:
+            with TempStdout():
+                with TempUmask(0o022):
+                    builder.run([home, '127.0.0.1:%d' % first,
+                                 '--instances', '2', '--storages', 'a,b'])
+        finally:
+            busy.close()
+
+        ports = []
+        for name in ('zeo1', 'zeo2'):
+            with open(os.path.join(home, name, 'etc', 'zeo.conf')) as f:
+                conf = [x.strip() for x in f.read().splitlines()]
+            address = [x for x in conf if x.startswith('address ')][0]
+            ports.append(int(address.rsplit(':', 1)[1]))
+        self.assertNotIn(first, ports)
+        self.assertEqual(len(set(ports)), 2)
+
+        with open(os.path.join(home, 'zeoclient.conf')) as f:
+            client_conf = f.read()
+        self.assertIn('<zodb zeo1-a>', client_conf)
+        self.assertIn('<zodb zeo2-b>', client_conf)
+        self.assertIn('    server 127.0.0.1:%d\n    storage b\n'
+                      % ports[1], client_conf)
+
+    def test_run_w_instances_metrics(self):
+        import os
+
+        builder = self._makeOne()
+        home = os.path.join(self._makeTempDir(), 'fleet')
+
+        with TempStdout():
+            with TempUmask(0o022):
+                builder.run([home, '0', '-n', '2', '--metrics'])
+
+        listens = []
+        for name in ('zeo1', 'zeo2'):
+            with open(os.path.join(home, name, 'bin', 'zeometrics')) as f:
+                listens.extend(x for x in f.read().splitlines()
+                               if x.startswith('LISTEN = '))
+        self.assertEqual(len(listens), 2)
+        self.assertNotEqual(listens[0], listens[1])
+        self.assertTrue(listens[0].startswith("LISTEN = ('127.0.0.1', "))
+
+    def test_run_w_instances_auto_ports(self):
+        import os
+
+        builder = self._makeOne()
+        home = os.path.join(self._makeTempDir(), 'fleet')
+
+        with TempStdout():
+            with TempUmask(0o022):
+                builder.run([home, '0', '--instances', '3'])
+
+        with open(os.path.join(home, 'zeoclient.conf')) as f:
+            servers = [x.strip() for x in f.read().splitlines()
+                       if x.strip().startswith('server ')]
+        self.assertEqual(len(servers), 3)
+        self.assertEqual(len(set(servers)), 3)
+        self.assertTrue(servers[0].startswith('server localhost:'))
+
+    def test_run_w_instances_invalid_address(self):
+        builder = self._makeOne()
+        usage = UsageStub()
+        self.assertRaises(UsageExit, builder.run,
+                          ['home', 'nohost', '--instances', '2'], usage=usage)
+        self.assertEqual(usage._called_with, ('NO MESSAGE', 1))
+
+    def test_run_w_secondaries(self):
+        import os
+
+        builder = self._makeOne()
+        home = os.path.join(self._makeTempDir(), 'replicated')
+
+        with TempStdout():
+            with TempUmask(0o022):
+                builder.run([home, '0', '--secondaries', '2',
+                             '--storages', 'a,b'])
+
+        confs = {}
+        for name in ('primary', 'secondary1', 'secondary2'):
+            with open(os.path.join(home, name, 'etc', 'zeo.conf')) as f:
+                confs[name] = f.read()
+            self.assertIn('%import zc.zrs\n', confs[name])
+        self.assertIn('  read-only false\n', confs['primary'])
+        self.assertIn('  read-only true\n', confs['secondary1'])
+
+        replicate_to = [x.split()[1] for x in confs['primary'].splitlines()
+                        if x.startswith('  replicate-to ')]
+        self.assertEqual(len(replicate_to), 2)
+        for name in ('secondary1', 'secondary2'):
+            self.assertIn('<zrs b>\n'
+                          '  replicate-from localhost:%s\n'
+                          '  keep-alive-delay 60\n'
+                          '  <filestorage b>\n'
+                          '    path $INSTANCE/var/b/Data.fs\n'
+                          % replicate_to[1], confs[name])
+
+        ports = [int(x.split()[1]) for conf in confs.values()
+                 for x in conf.splitlines() if x.startswith('  address ')]
+        ports.extend(int(x) for x in replicate_to)
+        self.assertEqual(len(set(ports)), 5)
+
+        with open(os.path.join(home, 'zeoclient.conf')) as f:
+            client_conf = f.read()
+        self.assertIn('<zodb primary-a>', client_conf)
+        self.assertIn('<zodb secondaries-b>\n'
+                      '  <zeoclient>\n'
+                      '    server localhost:%d\n'
+                      '    server localhost:%d\n'
+                      '    storage b\n'
+                      '    read-only true\n'
+                      '  </zeoclient>\n' % tuple(ports[1:3]), client_conf)
+
+    def test_run_w_secondaries_invalid(self):
+        builder = self._makeOne()
+        for args, message in [
+                (['--storage-type', 'mappingstorage'],
+                 "Replication needs file storages"),
+                (['--compress'], "Replication needs file storages"),
+                (['--storage-dir', 'a=/srv/a'],
+                 "Replicated instances keep their storages in their homes"),
+                (['-b', '/srv/blobs'],
+                 "Replicated instances keep their storages in their homes"),
+                (['--instances', '2'],
+                 "--secondaries can't be combined with --instances"),
+                (['--secondaries', '0'], "--secondaries must be at least 1"),
+        ]:
+            usage = UsageStub()
+            self.assertRaises(UsageExit, builder.run,
+                              ['home', '0', '--secondaries', '1'] + args,
+                              usage=usage)
+            self.assertEqual(usage._called_with, (message, 1))
+        usage = UsageStub()
+        self.assertRaises(UsageExit, builder.run,
+                          ['--manifest', self._writeManifest(''),
+                           '--secondaries', '1'],
+                          usage=usage)
+        self.assertEqual(usage._called_with,
+                         ("--secondaries can't be combined with --manifest",
+                          1))
+        usage = UsageStub()
+        self.assertRaises(UsageExit, builder.run,
+                          ['home', 'var/zeo.sock', '--secondaries', '1'],
+                          usage=usage)
+        self.assertEqual(usage._called_with,
+                         ("Replication needs a TCP port", 1))
+
+    def test_run_w_container(self):
+        import os
+        import sys
+
+        builder = self._makeOne()
+        home = os.path.join(self._makeTempDir(), 'Blue Sky')
+
+        with TempStdout():
+            with TempUmask(0o022):
+                builder.run([home, '127.0.0.1:8100', '--container', '-b',
+                             '--storages', 'main,cat'])
+
+        with open(os.path.join(home, 'etc', 'zeo.conf')) as f:
+            conf = f.read()
+        self.assertIn('%define INSTANCE /srv/blue-sky\n', conf)
+        self.assertIn('\n  address 8100\n', conf)
+        self.assertIn('\n  blob-dir $INSTANCE/blobs/cat\n', conf)
+        with open(os.path.join(home, 'bin', 'runzeo')) as f:
+            self.assertIn('\nPYTHON="/usr/local/bin/python"\n', f.read())
+
+        with open(os.path.join(home, 'Dockerfile')) as f:
+            dockerfile = f.read()
+        self.assertIn('\nFROM python:%d.%d-slim\n' % sys.version_info[:2],
+                      dockerfile)
+        self.assertIn(' && mkdir -p /srv/blue-sky/var /srv/blue-sky/var/cat'
+                      ' /srv/blue-sky/blobs /srv/blue-sky/log \\\n',
+                      dockerfile)
+        self.assertIn('\nVOLUME /srv/blue-sky/var /srv/blue-sky/blobs'
+                      ' /srv/blue-sky/log\n', dockerfile)
+        self.assertIn('\nCMD ["/srv/blue-sky/bin/runzeo"]\n', dockerfile)
+        with open(os.path.join(home, '.dockerignore')) as f:
+            dockerignore = f.read()
+        self.assertIn('\nvar\n', dockerignore)
+        self.assertIn('\netc/.mkzeoinstance.lock\n', dockerignore)
+
+        with open(os.path.join(home, 'compose.yaml')) as f:
+            compose = f.read()
+        self.assertIn('\n  blue-sky:\n'
+                      '    build: .\n'
+                      '    restart: unless-stopped\n'
+                      '    ports:\n'
+                      '      - "127.0.0.1:8100:8100"\n'
+                      '    volumes:\n'
+                      '      - blue-sky-var:/srv/blue-sky/var\n'
+                      '      - blue-sky-blobs:/srv/blue-sky/blobs\n'
+                      '      - blue-sky-log:/srv/blue-sky/log\n'
+                      '    tmpfs:\n'
+                      '      - /tmp\n', compose)
+        self.assertTrue(compose.endswith('\nvolumes:\n'
+                                         '  blue-sky-var:\n'
+                                         '  blue-sky-blobs:\n'
+                                         '  blue-sky-log:\n'))
+
+    def test_run_w_container_as_root(self):
+        import os
+
+        builder = self._makeOne()
+        home = os.path.join(self._makeTempDir(), 'zeo')
+
+        with TempAttribute(os, 'getuid', lambda: 0):
+            with TempStdout():
+                with TempUmask(0o022):
+                    builder.run([home, '8100', '--container'])
+            usage = UsageStub()
+            self.assertRaises(UsageExit, builder.run,
+                              [home, '8100', '--container', '--tls'],
+                              usage=usage)
+        self.assertEqual(usage._called_with,
+                         ("--container can't use TLS keys created by root",
+                          1))
+
+        with open(os.path.join(home, 'Dockerfile')) as f:
+            self.assertIn(' && useradd --system --non-unique --uid 10001 ',
+                          f.read())
+
+    def test_run_w_container_instances(self):
+        import os
+
+        builder = self._makeOne()
+        home = os.path.join(self._makeTempDir(), 'fleet')
+
+        with TempStdout():
+            with TempUmask(0o022):
+                builder.run([home, '0', '--container', '--secondaries', '1'])
+
+        with open(os.path.join(home, 'compose.yaml')) as f:
+            compose = f.read()
+        self.assertIn('\n  primary:\n    build: ./primary\n', compose)
+        self.assertIn('\n  secondary1:\n    build: ./secondary1\n', compose)
+        self.assertIn('\n  secondary1-var:\n', compose)
+        self.assertFalse(os.path.exists(os.path.join(home, 'Dockerfile')))
+        self.assertTrue(os.path.exists(
+            os.path.join(home, 'secondary1', 'Dockerfile')))
+        with open(os.path.join(home, 'secondary1', 'etc', 'zeo.conf')) as f:
+            self.assertIn('\n  replicate-from primary:', f.read())
+        with open(os.path.join(home, 'zeoclient.conf')) as f:
+            self.assertIn('<zodb secondaries>', f.read())
+
+    def test_run_w_container_invalid(self):
+        builder = self._makeOne()
+        for args, message in [
+                (['8100', '--storage-dir', '1=/srv/a'],
+                 "--container can't be combined with --storage-dir"),
+                (['8100', '--service', 'systemd'],
+                 "--container can't be combined with --service"),
+                (['8100', '--pack'],
+                 "--container can't be combined with --pack"),
+                (['8100', '--metrics'],
+                 "--container can't be combined with --metrics"),
+                (['8100', '--bench'],
+                 "--container can't be combined with --bench"),
+                (['8100', '-b', '/srv/blobs'],
+                 "--container keeps blobs in a volume"),
+                (['var/zeo.sock'], "--container needs a TCP port"),
+                (['0'], "--container needs a TCP port"),
+                (['host:abc'], "--container needs a TCP port"),
+        ]:
+            usage = UsageStub()
+            self.assertRaises(UsageExit, builder.run,
+                              ['home'] + args + ['--container'],
+                              usage=usage)
+            self.assertEqual(usage._called_with, (message, 1))
+
+    def test_run_w_relocatable(self):
+        import os
+        import subprocess
+        import sys
+
+        builder = self._makeOne()
+        temp_dir = self._makeTempDir()
+        home = os.path.join(temp_dir, 'template')
+
+        with TempStdout():
+            with TempUmask(0o022):
+                builder.run([home, 'var/zeo.sock', '--relocatable', '-b',
+                             '--storages', 'main,cat', '--index',
+                             '--metrics'])
+
+        clone = os.path.join(temp_dir, 'clone')
+        os.rename(home, clone)
+        for path in (('etc', 'zeo.conf'), ('bin', 'zeoctl'),
+                     ('bin', 'runzeo'), ('bin', 'zeoindex'),
+                     ('bin', 'zeometrics')):
+            with open(os.path.join(clone, *path)) as f:
+                self.assertNotIn(home, f.read())
+        with open(os.path.join(clone, 'etc', 'zeo.conf')) as f:
+            conf = f.read()
+        self.assertIn('%define INSTANCE $(INSTANCE_HOME)\n', conf)
+        self.assertIn('\n  address $INSTANCE/var/zeo.sock\n', conf)
+        self.assertNotIn('\n  python ', conf)
+        with open(os.path.join(clone, 'bin', 'zeometrics')) as f:
+            script = f.read()
+        self.assertTrue(script.startswith('#!/usr/bin/env python3\n'))
+        self.assertIn("\nSERVER = INSTANCE_HOME + '/var/zeo.sock'\n", script)
+
+        env = dict(os.environ, PYTHON=sys.executable)
+        output = subprocess.run(
+            [os.path.join(clone, 'bin', 'zeoctl'), 'status'], env=env,
+            stdout=subprocess.PIPE).stdout.decode('utf-8')
+        self.assertEqual(output, 'daemon manager not running\n')
+        output = subprocess.check_output(
+            [sys.executable, os.path.join(clone, 'bin', 'zeoindex')])
+        self.assertIn('%s/var/cat/Data.fs: no data file, skipped\n' % clone,
+                      output.decode('utf-8'))
+
+    def test_run_w_relocatable_invalid(self):
+        builder = self._makeOne()
+        for args, message in [
+                (['--storage-dir', '1=/srv/a'],
+                 "--relocatable can't be combined with --storage-dir"),
+                (['--fast-scripts'],
+                 "--relocatable can't be combined with --fast-scripts"),
+                (['--pack'], "--relocatable can't be combined with --pack"),
+                (['--shared-blobs'],
+                 "--relocatable can't be combined with --shared-blobs"),
+                (['--client-config'],
+                 "--relocatable can't be combined with --client-config"),
+                (['--client-var', '/srv/client'],
+                 "--relocatable can't be combined with --client-var"),
+                (['--tls'], "--relocatable can't be combined with --tls"),
+                (['-b', '/srv/blobs'],
+                 "--relocatable keeps blobs in the instance home"),
+        ]:
+            usage = UsageStub()
+            self.assertRaises(UsageExit, builder.run,
+                              ['home'] + args + ['--relocatable'],
+                              usage=usage)
+            self.assertEqual(usage._called_with, (message, 1))
+
+    def test_run_w_socket_path(self):
+        import os
+
+        builder = self._makeOne()
+        params = self._makeParams()
+        instance_home = params['instance_home']
+        socket_path = os.path.join(instance_home, 'run', 'zeo.sock')
+
+        with TempStdout():
+            with TempUmask(0o022):
+                builder.run([instance_home, 'run/zeo.sock',
+                             '--shared-blobs', '--metrics'])
+
+        with open(os.path.join(instance_home, 'etc', 'zeo.conf')) as f:
+            self.assertIn('\n  address %s\n' % socket_path, f.read())
+        with open(os.path.join(instance_home, 'etc', 'zeoclient.conf')) as f:
+            self.assertIn('\n    server %s\n' % socket_path, f.read())
+        with open(os.path.join(instance_home, 'bin', 'zeometrics')) as f:
+            self.assertIn('\nSERVER = %r\n' % socket_path, f.read())
+        self.assertTrue(os.path.isdir(os.path.dirname(socket_path)))
+
+    @unittest.skipUnless(shutil.which('openssl'), 'needs openssl')
+    def test_run_w_tls(self):
+        import os
+        import stat
+
+        builder = self._makeOne()
+        params = self._makeParams()
+        instance_home = params['instance_home']
+        tls = os.path.join(instance_home, 'etc', 'ssl')
+
+        with TempStdout():
+            with TempUmask(0o022):
+                builder.run([instance_home, '127.0.0.1:8100', '--tls',
+                             '--client-config'])
+
+        with open(os.path.join(instance_home, 'etc', 'zeo.conf')) as f:
+            self.assertIn("\n".join([
+                "  <ssl>",
+                "    certificate $INSTANCE/etc/ssl/server.pem",
+                "    key $INSTANCE/etc/ssl/server.key",
+                "    authenticate $INSTANCE/etc/ssl/ca.pem",
+                "  </ssl>",
+                "</zeo>",
+            ]), f.read())
+        with open(os.path.join(instance_home, 'etc', 'zeoclient.conf')) as f:
+            client_conf = f.read()
+        client_var = os.path.join(instance_home, 'var', 'zeoclient')
+        self.assertIn("%import ZEO\n", client_conf)
+        self.assertIn("\n".join([
+            "  <clientstorage>",
+            "    server 127.0.0.1:8100",
+            "    storage 1",
+            "    # Give every application process its own cache-path.",
+        ]), client_conf)
+        self.assertIn("\n".join([
+            "    cache-path %s/instance-1.zec" % client_var,
+            "    <ssl>",
+            "      certificate %s/client.pem" % tls,
+            "      key %s/client.key" % tls,
+            "      authenticate %s/ca.pem" % tls,
+            "    </ssl>",
+            "  </clientstorage>",
+        ]), client_conf)
+
+        self.assertEqual(sorted(os.listdir(tls)), [
+            'ca.key', 'ca.pem', 'client.key', 'client.pem',
+            'server.key', 'server.pem'])
+        for name in ('ca.key', 'client.key', 'server.key'):
+            self.assertEqual(
+                stat.S_IMODE(os.stat(os.path.join(tls, name)).st_mode),
+                0o600)
+
+        # The certificates verify against the CA, for this host.
+        import ssl
+        context = ssl.create_default_context(
+            cafile=os.path.join(tls, 'ca.pem'))
+        context.load_cert_chain(os.path.join(tls, 'client.pem'),
+                                os.path.join(tls, 'client.key'))
+        server = ssl.create_default_context(
+            ssl.Purpose.CLIENT_AUTH, cafile=os.path.join(tls, 'ca.pem'))
+        server.verify_mode = ssl.CERT_REQUIRED
+        for side in context, server:
+            # As ZEO checks them.
+            side.verify_flags |= ssl.VERIFY_X509_STRICT
+        server.load_cert_chain(os.path.join(tls, 'server.pem'),
+                               os.path.join(tls, 'server.key'))
+        client_in, server_out = ssl.MemoryBIO(), ssl.MemoryBIO()
+        server_in, client_out = ssl.MemoryBIO(), ssl.MemoryBIO()
+        client = context.wrap_bio(client_in, client_out,
+                                  server_hostname='127.0.0.1')
+        server = server.wrap_bio(server_in, server_out, server_side=True)
+        for _ in range(5):
+            for side in client, server:
+                try:
+                    side.do_handshake()
+                except ssl.SSLWantReadError:
+                    pass
+            server_in.write(client_out.read())
+            client_in.write(server_out.read())
+        self.assertEqual(client.version(), 'TLSv1.3')
+        self.assertTrue(server.getpeercert())
+
+        # Existing certificates are kept.
+        with open(os.path.join(tls, 'ca.pem')) as f:
+            ca = f.read()
+        with TempStdout():
+            builder.run([instance_home, '127.0.0.1:8100', '--tls'])
+        with open(os.path.join(tls, 'ca.pem')) as f:
+            self.assertEqual(f.read(), ca)
+
+    def test_run_w_tls_certificates(self):
+        import os
+
+        builder = self._makeOne()
+        params = self._makeParams()
+        instance_home = params['instance_home']
+        tls = os.path.join(self._makeTempDir(), 'pki')
+        os.mkdir(tls)
+        for name in ('ca', 'server', 'client'):
+            with open(os.path.join(tls, name + '.pem'), 'w'):
+                pass
+
+        with TempStdout() as out:
+            builder.run([instance_home, '8100', '--tls', tls, '--metrics'])
+
+        self.assertNotIn('certificate', out.getvalue())
+        with open(os.path.join(instance_home, 'etc', 'zeo.conf')) as f:
+            self.assertIn("    certificate %s/server.pem\n" % tls, f.read())
+        with open(os.path.join(instance_home, 'etc', 'zeoclient.conf')) as f:
+            self.assertIn("      authenticate %s/ca.pem\n" % tls, f.read())
+        with open(os.path.join(instance_home, 'bin', 'zeometrics')) as f:
+            self.assertIn("\nTLS = {'certificate': '%s/client.pem'," % tls,
+                          f.read())
+
+    def test_run_w_tls_socket_path(self):
+        builder = self._makeOne()
+        usage = UsageStub()
+        self.assertRaises(UsageExit, builder.run,
+                          ['home', 'var/zeo.sock', '--tls'], usage=usage)
+        self.assertEqual(usage._called_with, ('TLS needs a TCP address', 1))
+
+    def test_run_w_log_options(self):
+        import os
+
+        builder = self._makeOne()
+        params = self._makeParams()
+        instance_home = params['instance_home']
+
+        with TempStdout():
+            builder.run([instance_home, '--log-level', 'debug',
+                         '--log-rotate', '100mb', '--log-keep', '3',
+                         '--log-json', '--log-queue'])
+
+        with open(os.path.join(instance_home, 'etc', 'zeo.conf')) as f:
+            self.assertIn("\n".join([
+                "<eventlog>",
+                "  level debug",
+                "  <logfile>",
+                "    path $INSTANCE/log/zeo.log",
+                "    max-size 100MB",
+                "    old-files 3",
+                "    formatter zope.mkzeoinstance.json_log_formatter",
+                "    format %(message)s",
+                "  </logfile>",
+                "</eventlog>",
+            ]), f.read())
+        with open(os.path.join(instance_home, 'bin', 'runzeo')) as f:
+            self.assertIn(
+                "\nexec \"$PYTHON\" -c 'from zope.mkzeoinstance import runzeo;"
+                " runzeo()' -C \"$CONFIG_FILE\"", f.read())
+
+    def test_run_w_log_rotate_daily(self):
+        import os
+
+        builder = self._makeOne()
+        params = self._makeParams()
+        instance_home = params['instance_home']
+
+        with TempStdout():
+            builder.run([instance_home, '--log-rotate', 'daily'])
+
+        with open(os.path.join(instance_home, 'etc', 'zeo.conf')) as f:
+            self.assertIn("    path $INSTANCE/log/zeo.log\n"
+                          "    when midnight\n"
+                          "    old-files 7\n"
+                          "  </logfile>\n", f.read())
+
+    def test_run_w_invalid_log_options(self):
+        builder = self._makeOne()
+        for args, message in [
+                (['--log-level', 'loud'], 'Unknown log level: loud'),
+                (['--log-rotate', 'often'], 'Invalid log rotation: often'),
+                (['--log-rotate', '0'], 'Invalid log rotation: 0'),
+                (['--log-keep', '0'], 'Invalid number of old log files: 0'),
+        ]:
+            usage = UsageStub()
+            self.assertRaises(UsageExit, builder.run, ['home'] + args,
+                              usage=usage)
+            self.assertEqual(usage._called_with, (message, 1))
+
+    def test_run_w_socket_path_too_long(self):
+        builder = self._makeOne()
+        usage = UsageStub()
+        path = '/tmp/' + 'x' * 120
+        self.assertRaises(UsageExit, builder.run, ['home', path],
+                          usage=usage)
+        self.assertEqual(usage._called_with,
+                         ('Socket path too long: %s' % path, 1))
+
+    def test_run_w_instances_socket_path(self):
+        builder = self._makeOne()
+        usage = UsageStub()
+        self.assertRaises(UsageExit, builder.run,
+                          ['home', 'var/zeo.sock', '--instances', '2'],
+                          usage=usage)
+        self.assertEqual(usage._called_with,
+                         ('Sibling instances need a TCP port', 1))
+
+    def test_run_w_invalid_metrics_address(self):
+        builder = self._makeOne()
+        usage = UsageStub()
+        self.assertRaises(UsageExit, builder.run,
+                          ['home', '--metrics', 'localhost'], usage=usage)
+        self.assertEqual(usage._called_with,
+                         ('Invalid metrics address: localhost', 1))
+
+    def test_run_w_mappingstorage(self):
+        import os
+
+        builder = self._makeOne()
+        params = self._makeParams()
+        instance_home = params['instance_home']
+
+        with TempStdout():
+            with TempUmask(0o022):
+                builder.run([instance_home, '-t', 'mappingstorage'])
+
+        with open(os.path.join(instance_home, 'etc', 'zeo.conf')) as f:
+            conf = f.read()
+        self.assertIn('<mappingstorage 1>\n</mappingstorage>\n', conf)
+        self.assertNotIn('<filestorage', conf)
+
+    def test_run_w_compress(self):
+        import os
+
+        builder = self._makeOne()
+        params = self._makeParams()
+        instance_home = params['instance_home']
+
+        with TempStdout():
+            with TempUmask(0o022):
+                builder.run([instance_home, '--compress'])
+
+        with open(os.path.join(instance_home, 'etc', 'zeo.conf')) as f:
+            conf = f.read()
+        self.assertIn('%import zc.zlibstorage\n', conf)
+        self.assertIn("\n".join([
+            "<zlibstorage 1>",
+            "  <filestorage 1>",
+            "    path $INSTANCE/var/Data.fs",
+            "  ",
+            "  </filestorage>",
+            "</zlibstorage>",
+        ]), conf)
+
+        path = os.path.join(instance_home, 'bin', 'zeocompress')
+        self.assertTrue(os.access(path, os.X_OK))
+        with open(path) as f:
+            compile(f.read(), path, 'exec')
+
+    def test_run_w_unknown_compressor(self):
+        builder = self._makeOne()
+        usage = UsageStub()
+        self.assertRaises(UsageExit, builder.run,
+                          ['home', '--compress', 'lz4'], usage=usage)
+        self.assertEqual(usage._called_with, ('Unknown compressor: lz4', 1))
+
+    def test_run_w_compress_zlibstorage(self):
+        builder = self._makeOne()
+        usage = UsageStub()
+        self.assertRaises(UsageExit, builder.run,
+                          ['home', '-t', 'zlibstorage', '--compress'],
+                          usage=usage)
+        self.assertEqual(usage._called_with,
+                         ('zlibstorage is already compressed', 1))
+
+    def test_run_w_unknown_storage_type(self):
+        builder = self._makeOne()
+        usage = UsageStub()
+        self.assertRaises(UsageExit, builder.run,
+                          ['home', '-t', 'nonesuch'], usage=usage)
+        self.assertEqual(usage._called_with,
+                         ('Unknown storage type: nonesuch', 1))
+
+    def test_run_wo_arguments(self):
+        builder = self._makeOne()
+        usage = UsageStub()
+        self.assertRaises(UsageExit, builder.run, [], usage=usage)
+        self.assertEqual(usage._called_with, ('NO MESSAGE', 1))
+
+    def test_run_w_too_many_arguments(self):
+        builder = self._makeOne()
+        usage = UsageStub()
+        self.assertRaises(UsageExit, builder.run, ['a', 'b', 'c'], usage=usage)
+        self.assertEqual(usage._called_with, ('NO MESSAGE', 1))
+
+    def test_run_wo_single_arg_non_absolute(self):
+        import os
+        self.maxDiff = None
+        builder = self._makeOne()
+        tempdir = self._makeTempDir()
+        where = os.path.join(tempdir, 'foo', '..', 'bar')
+        abswhere = os.path.abspath(where)
+
+        params = self._makeParams()
+        params['instance_home'] = abswhere
+        expected_out = "\n".join([
+            "Created directory %(instance_home)s",
+            "Created directory %(instance_home)s/etc",
+            "Created directory %(instance_home)s/var",
+            "Created directory %(instance_home)s/log",
+            "Created directory %(instance_home)s/bin",
+            "Wrote file %(instance_home)s/etc/zeo.conf",
+            "Wrote file %(instance_home)s/bin/zeoctl",
+            "Changed mode for %(instance_home)s/bin/zeoctl to 755",
+            "Wrote file %(instance_home)s/bin/runzeo",
+            "Changed mode for %(instance_home)s/bin/runzeo to 755",
+            ""
+        ]) % params
+
+        with TempStdout() as temp_out_file:
+            with TempUmask(0o022):
+                builder.run([where])
+                self.assertEqual(temp_out_file.getvalue(), expected_out)
+
+        self.assertTrue(os.path.exists(os.path.join(abswhere, 'etc')))
+        self.assertTrue(os.path.exists(os.path.join(abswhere, 'var')))
+        self.assertTrue(os.path.exists(os.path.join(abswhere, 'log')))
+        self.assertTrue(os.path.exists(os.path.join(abswhere, 'bin')))
+        self.assertTrue(
+            os.path.exists(os.path.join(abswhere, 'etc', 'zeo.conf')))
+        self.assertTrue(
+            os.path.exists(os.path.join(abswhere, 'bin', 'zeoctl')))
+        self.assertTrue(
+            os.path.exists(os.path.join(abswhere, 'bin', 'runzeo')))
+
+    def test_run_wo_two_args_no_host(self):
+        import os
+
+        builder = self._makeOne()
+        params = self._makeParams()
+        instance_home = params['instance_home']
+
+        with TempStdout():
+            with TempUmask(0o022):
+                builder.run([instance_home, '8888'])
+
+        with open(os.path.join(instance_home, 'etc', 'zeo.conf')) as f:
+            conf = f.read()
+        self.assertIn(
+            'address 8888',
+            [x.strip() for x in conf.splitlines()]
+        )
+
+    def test_run_wo_two_args_w_host(self):
+        import os
+
+        builder = self._makeOne()
+        params = self._makeParams()
+        instance_home = params['instance_home']
+
+        with TempStdout():
+            with TempUmask(0o022):
+                builder.run([instance_home, 'localhost:8888'])
+
+        with open(os.path.join(instance_home, 'etc', 'zeo.conf')) as f:
+            conf = f.read()
+        self.assertIn(
+            'address localhost:8888',
+            [x.strip() for x in conf.splitlines()]
+        )
+
+
+class UtilityFunctionsTest(_WithTempdir, unittest.TestCase):
+
+    def test_mkdirs(self):
+        import os
+
+        from zope.mkzeoinstance import mkdirs
+        temp_dir = self._makeTempDir()
+        path = os.path.join(temp_dir, 'test')
+
+        with TempStdout() as temp_out_file:
+            mkdirs(path)
+            self.assertEqual('Created directory %s\n' % path,
+                             temp_out_file.getvalue())
+        self.assertTrue(os.path.exists(path))
+
+    def test_mkdirs_nested(self):
+        import os
+
+        from zope.mkzeoinstance import mkdirs
+        temp_dir = self._makeTempDir()
+        parent_path = os.path.join(temp_dir, 'parent')
+        child_path = os.path.join(parent_path, 'child')
+
+        with TempStdout() as temp_out_file:
+            mkdirs(child_path)
+            self.assertEqual('Created directory %s\n'
+                             'Created directory %s\n'
+                             % (parent_path, child_path),
+                             temp_out_file.getvalue())
+        self.assertTrue(os.path.isdir(child_path))
+
+    def test_makedir(self):
+        import os
+
+        from zope.mkzeoinstance import makedir
+        temp_dir = self._makeTempDir()
+        path = os.path.join(temp_dir, 'test')
+
+        with TempStdout() as temp_out_file:
+            makedir(temp_dir, 'test')
+            self.assertEqual('Created directory %s\n' % path,
+                             temp_out_file.getvalue())
+        self.assertTrue(os.path.exists(path))
+
+    def test_makefile(self):
+        import os
+
+        from zope.mkzeoinstance import makefile
+        template = "KEY=%(key)s"
+        params = {'key': 'value'}
+        temp_dir = self._makeTempDir()
+        path = os.path.join(temp_dir, 'test.txt')
+
+        with TempStdout() as temp_out_file:
+            makefile(template, temp_dir, 'test.txt', **params)
+            self.assertEqual('Wrote file %s\n' % path,
+                             temp_out_file.getvalue())
+
+        with open(path) as f:
+            self.assertEqual('KEY=value', f.read())
+
+    def test_makefile_existing_same_content(self):
         import os
 
         from zope.mkzeoinstance import makefile
@@ -751,6 +2432,523 @@ class UtilityFunctionsTest(_WithTempdir, unittest.TestCase):
                              temp_out_file.getvalue())
 
 
+class ImportTimeTests(unittest.TestCase):
+
+    def _run(self, code):
+        import subprocess
+        import sys
+        return subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', code],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+            universal_newlines=True)
+
+    def _import_times(self, stderr):
+        times = {}
+        for line in stderr.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                self_time, cumulative, name = line[12:].split('|')
+                if cumulative.strip().isdigit():
+                    times[name.strip()] = int(cumulative)
+        return times
+
+    def test_zodb_not_imported(self):
+        result = self._run(
+            "import sys\n"
+            "from zope.mkzeoinstance import ZEOInstanceBuilder\n"
+            "builder = ZEOInstanceBuilder()\n"
+            "params = builder.get_params('', '', '/tmp/zeo', 9999,\n"
+            "                            '$INSTANCE/var/blobs',\n"
+            "                            storages=['1', '2'],\n"
+            "                            client_config=True)\n"
+            "print(sorted(name for name in sys.modules\n"
+            "             if name.split('.')[0] in ('ZODB', 'ZEO',\n"
+            "                                       'zdaemon', 'ZConfig')))\n")
+        self.assertEqual(result.stdout, '[]\n')
+
+    def test_import_time(self):
+        # Importing the module must stay much cheaper than importing
+        # ZODB, which it used to pull in.
+        times = self._import_times(self._run(
+            'import zope.mkzeoinstance; import ZODB').stderr)
+        self.assertLess(times['zope.mkzeoinstance'], times['ZODB'])
+
+
+class PrecompileTests(_WithTempdir, unittest.TestCase):
+
+    def test_precompile(self):
+        import os
+        import sys
+
+        from zope.mkzeoinstance import precompile
+        temp_dir = self._makeTempDir()
+        package = os.path.join(temp_dir, 'precompiled')
+        os.mkdir(package)
+        with open(os.path.join(package, '__init__.py'), 'w') as f:
+            f.write('VALUE = 1\n')
+        sys.path.insert(0, temp_dir)
+        try:
+            self.assertEqual(precompile(['precompiled', 'not_there']), [])
+        finally:
+            sys.path.remove(temp_dir)
+        self.assertTrue(os.listdir(os.path.join(package, '__pycache__')))
+
+
+class LoggingTests(unittest.TestCase):
+
+    def _makeRecord(self, msg, args=(), exc_info=None):
+        import logging
+        return logging.LogRecord('ZEO.test', logging.WARNING, __file__, 1,
+                                 msg, args, exc_info)
+
+    def test_json_log_formatter(self):
+        import json
+        import sys
+
+        from zope.mkzeoinstance import json_log_formatter
+        formatter = json_log_formatter('%(message)s', '%Y-%m-%dT%H:%M:%S',
+                                       style='%')
+        entry = json.loads(formatter.format(
+            self._makeRecord('stored %s "objects"', (3,))))
+        self.assertEqual(entry['level'], 'WARNING')
+        self.assertEqual(entry['logger'], 'ZEO.test')
+        self.assertEqual(entry['message'], 'stored 3 "objects"')
+        self.assertRegex(entry['time'], r'^\d{4}-\d\d-\d\dT[\d:]{8}\.\d{3}$')
+        self.assertNotIn('exception', entry)
+
+        try:
+            raise ValueError('broken')
+        except ValueError:
+            record = self._makeRecord('failed', exc_info=sys.exc_info())
+        line = formatter.format(record)
+        self.assertNotIn('\n', line)
+        self.assertIn('ValueError: broken', json.loads(line)['exception'])
+
+    def test_queue_log_handlers(self):
+        import logging
+        import threading
+
+        from zope.mkzeoinstance import queue_log_handlers
+
+        class Handler(logging.Handler):
+            def __init__(self):
+                logging.Handler.__init__(self)
+                self.threads = []
+
+            def emit(self, record):
+                self.threads.append(threading.current_thread())
+
+        logger = logging.getLogger('zope.mkzeoinstance.tests.queue')
+        logger.propagate = False
+        handler = Handler()
+        logger.addHandler(handler)
+        listener = queue_log_handlers(logger)
+        try:
+            self.assertNotIn(handler, logger.handlers)
+            logger.warning('queued')
+        finally:
+            listener.stop()
+            logger.handlers[:] = []
+        self.assertEqual(len(handler.threads), 1)
+        self.assertIsNot(handler.threads[0], threading.current_thread())
+        self.assertIsNone(queue_log_handlers(logger))
+
+    def test_runzeo_reopens_queued_log_files(self):
+        import logging
+        import os
+        import shutil
+        import tempfile
+
+        from ZEO.runzeo import ZEOServer
+
+        import zope.mkzeoinstance
+        from zope.mkzeoinstance import runzeo
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        log_path = os.path.join(temp_dir, 'zeo.log')
+        conf_path = os.path.join(temp_dir, 'zeo.conf')
+        with open(conf_path, 'w') as f:
+            f.write('<zeo>\n  address 0\n</zeo>\n'
+                    '<mappingstorage 1>\n</mappingstorage>\n'
+                    '<eventlog>\n  <logfile>\n    path %s\n'
+                    '  </logfile>\n</eventlog>\n' % log_path)
+
+        def main(server):
+            # What logrotate does before sending SIGUSR2.
+            os.rename(log_path, log_path + '.1')
+            server.handle_sigusr2()
+
+        queue_log_handlers = zope.mkzeoinstance.queue_log_handlers
+        listeners = []
+
+        def record_listener(logger):
+            listeners.append(queue_log_handlers(logger))
+            return listeners[-1]
+
+        root = logging.getLogger()
+        self.addCleanup(setattr, root, 'level', root.level)
+        self.addCleanup(setattr, root, 'handlers', root.handlers[:])
+        with TempAttribute(ZEOServer, 'main', main):
+            with TempAttribute(zope.mkzeoinstance, 'queue_log_handlers',
+                               record_listener):
+                runzeo(['-C', conf_path])
+        for handler in listeners[0].handlers:
+            handler.close()
+
+        with open(log_path) as f:
+            self.assertIn('Log files reopened successfully', f.read())
+
+
+class CPUAffinityTests(unittest.TestCase):
+
+    def _callFUT(self, cpus, block, count):
+        from zope.mkzeoinstance import cpu_affinity
+        return cpu_affinity(cpus, block, count)
+
+    def test_blocks(self):
+        self.assertEqual([self._callFUT(2, block, 8) for block in range(5)],
+                         ['0-1', '2-3', '4-5', '6-7', '0-1'])
+
+    def test_single_core(self):
+        self.assertEqual(self._callFUT(1, 3, 2), '1')
+        self.assertEqual(self._callFUT(2, 3, 1), '0')
+
+
+class WriteFileTests(_WithTempdir, unittest.TestCase):
+
+    def test_writefile(self):
+        import os
+
+        from zope.mkzeoinstance import writefile
+        temp_dir = self._makeTempDir()
+        path = os.path.join(temp_dir, 'runzeo')
+        with open(path, 'w') as f:
+            f.write('old')
+
+        with TempUmask(0o022):
+            writefile(path, 'new', 0o777)
+
+        with open(path) as f:
+            self.assertEqual(f.read(), 'new')
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o755)
+        self.assertEqual(os.listdir(temp_dir), ['runzeo'])
+
+    def test_writefile_keeps_symlink(self):
+        import os
+
+        from zope.mkzeoinstance import writefile
+        temp_dir = self._makeTempDir()
+        target = os.path.join(temp_dir, 'shared.conf')
+        path = os.path.join(temp_dir, 'zeo.conf')
+        with open(target, 'w') as f:
+            f.write('old')
+        os.symlink('shared.conf', path)
+
+        writefile(path, 'new')
+
+        self.assertTrue(os.path.islink(path))
+        with open(target) as f:
+            self.assertEqual(f.read(), 'new')
+        self.assertEqual(sorted(os.listdir(temp_dir)),
+                         ['shared.conf', 'zeo.conf'])
+
+    def test_writefile_failure_keeps_old_file(self):
+        import os
+
+        from zope.mkzeoinstance import writefile
+        temp_dir = self._makeTempDir()
+        path = os.path.join(temp_dir, 'zeo.conf')
+        with open(path, 'w') as f:
+            f.write('old')
+
+        # Lone surrogates can't be encoded, so writing fails half way.
+        self.assertRaises(UnicodeEncodeError, writefile, path,
+                          'new' * 10000 + '\udc80')
+
+        with open(path) as f:
+            self.assertEqual(f.read(), 'old')
+        self.assertEqual(os.listdir(temp_dir), ['zeo.conf'])
+
+    def test_lock_home(self):
+        import os
+        import threading
+
+        from zope.mkzeoinstance import lock_home
+        home = self._makeTempDir()
+        locked = threading.Event()
+
+        def lock():
+            lock_home(home).close()
+            locked.set()
+
+        with TempStdout():
+            lock_file = lock_home(home)
+            thread = threading.Thread(target=lock)
+            thread.start()
+            self.assertFalse(locked.wait(0.2))
+            lock_file.close()
+            thread.join(10)
+        self.assertTrue(locked.is_set())
+        self.assertEqual(os.listdir(os.path.join(home, 'etc')), [])
+
+    def test_lock_home_waiters_exclude_each_other(self):
+        import os
+        import threading
+        import time
+
+        from zope.mkzeoinstance import lock_home
+        home = self._makeTempDir()
+        holders = []
+        overlaps = []
+
+        def lock():
+            lock_file = lock_home(home)
+            holders.append(lock_file)
+            if len(holders) > 1:
+                overlaps.append(len(holders))
+            time.sleep(0.05)
+            holders.remove(lock_file)
+            lock_file.close()
+
+        with TempStdout():
+            lock_file = lock_home(home)
+            threads = [threading.Thread(target=lock) for i in range(3)]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.1)
+            lock_file.close()
+            for thread in threads:
+                thread.join(10)
+        self.assertEqual(overlaps, [])
+        self.assertEqual(os.listdir(os.path.join(home, 'etc')), [])
+
+
+class PackScheduleTests(unittest.TestCase):
+
+    def _callFUT(self, window, key=''):
+        from zope.mkzeoinstance import pack_schedule
+        return pack_schedule(window, key)
+
+    def test_daily(self):
+        self.assertEqual(self._callFUT('01:00-01:01'), (None, 1, 0))
+
+    def test_within_first_half_of_window(self):
+        for key in ('/srv/zeo1', '/srv/zeo2', '/srv/zeo3'):
+            weekday, hour, minute = self._callFUT('Sun 01:00-05:00', key)
+            self.assertEqual(weekday, 6)
+            self.assertIn(hour, (1, 2))
+
+    def test_staggered(self):
+        times = {self._callFUT('01:00-05:00', '/srv/zeo%d' % i)
+                 for i in range(10)}
+        self.assertGreater(len(times), 1)
+
+    def test_past_midnight(self):
+        self.assertEqual(self._callFUT('sun 23:59-00:00'), (6, 23, 59))
+        weekday, hour, minute = self._callFUT('Sun 23:00-03:00', 'x' * 5)
+        self.assertEqual(weekday, 0 if hour < 23 else 6)
+
+    def test_invalid(self):
+        for window in ('', '1-5', 'Xyz 01:00-02:00', '25:00-26:00'):
+            self.assertRaises(ValueError, self._callFUT, window)
+
+
+class AllocatePortsTests(unittest.TestCase):
+
+    def _callFUT(self, host, first, count):
+        from zope.mkzeoinstance import allocate_ports
+        return allocate_ports(host, first, count)
+
+    def test_skips_busy_ports(self):
+        import socket
+        busy = socket.socket()
+        busy.bind(('127.0.0.1', 0))
+        busy.listen(1)
+        first = busy.getsockname()[1]
+        try:
+            ports = self._callFUT('127.0.0.1', first, 2)
+        finally:
+            busy.close()
+        self.assertNotIn(first, ports)
+        self.assertEqual(ports, sorted(set(ports)))
+
+    def test_system_chosen(self):
+        ports = self._callFUT('', 0, 3)
+        self.assertEqual(len(set(ports)), 3)
+
+    def test_out_of_ports(self):
+        self.assertRaises(ValueError, self._callFUT, '127.0.0.1', 65535, 2)
+
+
+class DetectProfileTests(_WithTempdir, unittest.TestCase):
+
+    def _callFUT(self, path):
+        from zope.mkzeoinstance import detect_profile
+        return detect_profile(path)
+
+    def test_nonexisting_path(self):
+        import os
+        path = os.path.join(self._makeTempDir(), 'not', 'there')
+        values = self._callFUT(path)
+        self.assertEqual(
+            sorted(values),
+            ['client_cache_size', 'cpus', 'invalidation_age',
+             'invalidation_queue_size', 'io_priority', 'memory_high',
+             'nice', 'nofile', 'transaction_timeout'])
+        self.assertLessEqual(values['invalidation_queue_size'], 20000)
+
+    def test_client_cache_sizes(self):
+        from zope.mkzeoinstance import client_cache_sizes
+        GB, MB = 1 << 30, 1 << 20
+        # New storage: the wanted size, limited by RAM.
+        self.assertEqual(client_cache_sizes(0, 0, 16 * GB, 2 * GB),
+                         (GB, 256 * MB))
+        # Small storage: no bigger than the storage.
+        self.assertEqual(client_cache_sizes(30 * MB, 0, 16 * GB),
+                         (30 * MB, 256 * MB))
+        # Big storage: a quarter of it.
+        self.assertEqual(client_cache_sizes(2 * GB, 8 * GB, 64 * GB),
+                         (512 * MB, 2 * GB))
+
+    def test_parse_size(self):
+        from zope.mkzeoinstance import parse_size
+        self.assertEqual(parse_size('256MB'), 256 << 20)
+        self.assertEqual(parse_size('1gb'), 1 << 30)
+        self.assertEqual(parse_size('12'), 12)
+
+    def test_format_size(self):
+        from zope.mkzeoinstance import format_size
+        self.assertEqual(format_size(512), '512')
+        self.assertEqual(format_size(3 << 20), '3MB')
+        self.assertEqual(format_size(5 << 30), '5GB')
+
+
+class ProbeTests(_WithTempdir, unittest.TestCase):
+
+    SLOW = {'fsync_ms': 30.0, 'fsync_p99_ms': 80.0, 'append_mb_s': 40.0,
+            'files_per_s': 90.0}
+
+    def test_probe_filesystem(self):
+        import os
+
+        from zope.mkzeoinstance import probe_filesystem
+        temp_dir = self._makeTempDir()
+        results = probe_filesystem(os.path.join(temp_dir, 'var', 'blobs'),
+                                   fsyncs=5, append_size=1 << 20, files=10)
+        self.assertEqual(sorted(results), ['append_mb_s', 'files_per_s',
+                                           'fsync_ms', 'fsync_p99_ms'])
+        self.assertTrue(all(value > 0 for value in results.values()))
+        self.assertLessEqual(results['fsync_ms'], results['fsync_p99_ms'])
+        self.assertEqual(os.listdir(temp_dir), [])
+
+    def test_probe_problems(self):
+        from zope.mkzeoinstance import probe_problems
+        self.assertEqual(probe_problems(self.SLOW, 'small'), [
+            ('file creation rate 90 files/s is below 100 files/s', False),
+        ])
+        self.assertEqual(probe_problems(self.SLOW, 'write-heavy'), [
+            ('fsync latency 30.0ms exceeds 5ms', True),
+            ('append throughput 40MB/s is below 50MB/s', False),
+            ('file creation rate 90 files/s is below 500 files/s', True),
+        ])
+        # Without a named profile, the limits of small apply.
+        self.assertEqual(probe_problems(self.SLOW),
+                         probe_problems(self.SLOW, 'small'))
+
+    def test_probe_tuning(self):
+        from zope.mkzeoinstance import PROFILES
+        from zope.mkzeoinstance import probe_tuning
+        values = probe_tuning(PROFILES['write-heavy'], self.SLOW)
+        self.assertIsNone(values['invalidation_age'])
+        self.assertEqual(values['transaction_timeout'], 300)
+        self.assertEqual(PROFILES['write-heavy']['transaction_timeout'], 60)
+        fast = dict(self.SLOW, fsync_ms=0.5)
+        self.assertEqual(probe_tuning(PROFILES['write-heavy'], fast),
+                         PROFILES['write-heavy'])
+
+    def _probeStub(self, **results):
+        probed = []
+
+        def probe_filesystem(path):
+            probed.append(path)
+            values = {'fsync_ms': 1.0, 'fsync_p99_ms': 2.0,
+                      'append_mb_s': 100.0, 'files_per_s': 1000.0}
+            values.update(results)
+            return values
+
+        return probe_filesystem, probed
+
+    def test_run_w_probe(self):
+        import os
+
+        import zope.mkzeoinstance
+        from zope.mkzeoinstance import ZEOInstanceBuilder
+        instance_home = os.path.join(self._makeTempDir(), 'instance')
+        blob_dir = os.path.join(self._makeTempDir(), 'blobs')
+        probe_filesystem, probed = self._probeStub()
+        usage = UsageStub()
+        with TempStdout() as out:
+            with TempAttribute(zope.mkzeoinstance, 'probe_filesystem',
+                               probe_filesystem):
+                ZEOInstanceBuilder().run(
+                    [instance_home, '--probe', '-b', blob_dir, '-p', 'small'],
+                    usage=usage)
+        self.assertIsNone(usage._called_with)
+        # The temporary directories may share a filesystem.
+        self.assertEqual(probed[0], os.path.join(instance_home, 'var'))
+        lines = [line for line in out.getvalue().splitlines()
+                 if line.startswith('Probed ')]
+        self.assertEqual(len(lines), len(probed))
+        self.assertTrue(lines[0].startswith(
+            'Probed %s (' % os.path.join(instance_home, 'var')))
+        self.assertTrue(lines[0].endswith(
+            ': fsync 1.0ms (p99 2.0ms), append 100 MB/s, 1000 files/s'))
+        self.assertNotIn('Warning', out.getvalue())
+        self.assertTrue(os.path.exists(
+            os.path.join(instance_home, 'etc', 'zeo.conf')))
+
+    def test_run_w_instances_probe(self):
+        import os
+
+        import zope.mkzeoinstance
+        from zope.mkzeoinstance import ZEOInstanceBuilder
+        home = os.path.join(self._makeTempDir(), 'fleet')
+        probe_filesystem, probed = self._probeStub(fsync_ms=60.0)
+        with TempStdout() as out:
+            with TempAttribute(zope.mkzeoinstance, 'probe_filesystem',
+                               probe_filesystem):
+                ZEOInstanceBuilder().run(
+                    [home, '0', '--instances', '3', '--probe',
+                     '-p', 'small'])
+        self.assertEqual(probed, [os.path.join(home, 'zeo1', 'var')])
+        output = out.getvalue()
+        self.assertEqual(output.count('Probed '), 1)
+        self.assertEqual(output.count('Warning: '), 1)
+        for i in range(3):
+            with open(os.path.join(home, 'zeo%d' % (i + 1), 'etc',
+                                   'zeo.conf')) as f:
+                # Tuned for the slow fsync.
+                self.assertIn('transaction-timeout 300', f.read())
+
+    def test_run_w_probe_too_slow(self):
+        import os
+
+        import zope.mkzeoinstance
+        from zope.mkzeoinstance import ZEOInstanceBuilder
+        instance_home = os.path.join(self._makeTempDir(), 'instance')
+        probe_filesystem, probed = self._probeStub(fsync_ms=200.0)
+        usage = UsageStub()
+        with TempStdout():
+            with TempAttribute(zope.mkzeoinstance, 'probe_filesystem',
+                               probe_filesystem):
+                self.assertRaises(
+                    UsageExit, ZEOInstanceBuilder().run,
+                    [instance_home, '--probe', '-p', 'small'], usage=usage)
+        self.assertEqual(usage._called_with, (
+            '%s is too slow for the small profile: fsync latency 200.0ms'
+            ' exceeds 50ms' % os.path.join(instance_home, 'var'), 1))
+        self.assertFalse(os.path.exists(instance_home))
+
+
 class TempStdout:
 
     def __enter__(self):
@@ -780,6 +2978,22 @@ class TempUmask:
         os.umask(self._old_umask)
 
 
+class TempAttribute:
+
+    def __init__(self, obj, name, value):
+        self._obj = obj
+        self._name = name
+        self._value = value
+
+    def __enter__(self):
+        self._old_value = getattr(self._obj, self._name)
+        setattr(self._obj, self._name, self._value)
+        return self._value
+
+    def __exit__(self, *err):
+        setattr(self._obj, self._name, self._old_value)
+
+
 class UsageExit(Exception):
     pass
 